@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del endpoint de login (/token).
+
+Simula una ráfaga de inicios de sesión (cambio de turno) contra un servidor
+en ejecución y reporta logins/segundo totales y por worker, latencias y
+errores. Mientras corre, mide también la latencia de un endpoint liviano
+(/) para comprobar que el worker no se congela durante la ráfaga.
+
+Uso:
+    python bench_login.py --url http://localhost:8000 --usuario admin --password secreto \\
+        --total 400 --concurrencia 32 --workers 4
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def login(url: str, usuario: str, password: str) -> tuple:
+    datos = urllib.parse.urlencode({"username": usuario, "password": password}).encode()
+    inicio = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(f"{url}/token", data=datos), timeout=60) as r:
+            ok = r.status == 200
+    except urllib.error.HTTPError as e:
+        ok = False
+        e.close()
+    except Exception:
+        ok = False
+    return ok, time.perf_counter() - inicio
+
+
+def sondear_latencia(url: str, detener: threading.Event, latencias: list):
+    """Consulta / continuamente para medir si el event loop sigue respondiendo."""
+    while not detener.is_set():
+        inicio = time.perf_counter()
+        try:
+            with urllib.request.urlopen(f"{url}/", timeout=60) as r:
+                r.read()
+            latencias.append(time.perf_counter() - inicio)
+        except Exception:
+            pass
+        time.sleep(0.05)
+
+
+def percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del login")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--usuario", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--total", type=int, default=200, help="Logins a enviar")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="Workers de gunicorn del servidor")
+    args = parser.parse_args()
+    url = args.url.rstrip("/")
+
+    print(f"\n🔐 {args.total} logins, concurrencia {args.concurrencia}, contra {url}")
+
+    detener = threading.Event()
+    latencias_sonda = []
+    sonda = threading.Thread(target=sondear_latencia, args=(url, detener, latencias_sonda), daemon=True)
+    sonda.start()
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as pool:
+        resultados = list(pool.map(lambda _: login(url, args.usuario, args.password), range(args.total)))
+    duracion = time.perf_counter() - inicio
+    detener.set()
+    sonda.join()
+
+    exitos = [t for ok, t in resultados if ok]
+    errores = len(resultados) - len(exitos)
+    por_segundo = len(exitos) / duracion if duracion else 0.0
+
+    print("-" * 60)
+    print(f"   Duración:                 {duracion:>8.2f} s")
+    print(f"   Logins exitosos:          {len(exitos):>8d}   (errores: {errores})")
+    print(f"   Logins/s (total):         {por_segundo:>8.1f}")
+    print(f"   Logins/s por worker:      {por_segundo / max(args.workers, 1):>8.1f}")
+    if exitos:
+        print(f"   Latencia login p50/p95:   {statistics.median(exitos) * 1000:>8.0f} / "
+              f"{percentil(exitos, 0.95) * 1000:.0f} ms")
+    if latencias_sonda:
+        print(f"   Latencia de / p50/max:    {statistics.median(latencias_sonda) * 1000:>8.0f} / "
+              f"{max(latencias_sonda) * 1000:.0f} ms  ({len(latencias_sonda)} sondeos)")
+    print("-" * 60)
+
+
+if __name__ == "__main__":
+    main()
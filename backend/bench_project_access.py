@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark: verificación de acceso a un proyecto con 1.000 colaboradores.
+
+Compara, por solicitud (sesión nueva en cada iteración, como en un endpoint):
+
+- legacy: cargar el proyecto y evaluar `user not in project.assigned_users`
+  (hidrata los 1.000 usuarios asignados).
+- EXISTS: project_access.consulta_acceso (una consulta indexada).
+- verificar_acceso_proyecto: conjunto cacheado en user_cache + EXISTS de respaldo.
+
+Por defecto usa una base SQLite temporal en memoria. Con --database-url se
+puede apuntar a un PostgreSQL DESECHABLE (crea las tablas users, projects y
+user_projects si no existen).
+
+Uso:
+    python bench_project_access.py --miembros 1000 --iteraciones 200
+"""
+
+import argparse
+import statistics
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import models
+from project_access import consulta_acceso, verificar_acceso_proyecto
+from user_cache import UserCache
+import project_access
+
+
+def preparar(url: str, miembros: int):
+    engine = create_engine(url)
+    for tabla in (models.User.__table__, models.Project.__table__, models.user_projects):
+        tabla.create(engine, checkfirst=True)
+    Session = sessionmaker(bind=engine)
+
+    db = Session()
+    usuarios = [
+        models.User(username=f"bench_{i}", email=f"bench_{i}@segmab.com", hashed_password="!")
+        for i in range(miembros)
+    ]
+    db.add_all(usuarios)
+    db.flush()
+    proyecto = models.Project(name="Proyecto benchmark", owner_id=usuarios[0].id)
+    proyecto.assigned_users = usuarios[1:]
+    db.add(proyecto)
+    db.commit()
+    ids = (proyecto.id, usuarios[-1].id)
+    db.close()
+    return Session, ids
+
+
+def medir(nombre: str, Session, fn, iteraciones: int):
+    tiempos = []
+    for _ in range(iteraciones):
+        db = Session()
+        inicio = time.perf_counter()
+        assert fn(db)
+        tiempos.append(time.perf_counter() - inicio)
+        db.close()
+    p50 = statistics.median(tiempos) * 1000
+    p95 = sorted(tiempos)[int(len(tiempos) * 0.95)] * 1000
+    print(f"   {nombre:<36} p50 {p50:>8.3f} ms   p95 {p95:>8.3f} ms")
+    return p50
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de verificación de acceso a proyectos")
+    parser.add_argument("--miembros", type=int, default=1000)
+    parser.add_argument("--iteraciones", type=int, default=200)
+    parser.add_argument("--database-url", default="sqlite://")
+    args = parser.parse_args()
+
+    print(f"\n📊 Proyecto con {args.miembros:,} colaboradores ({args.database_url.split('@')[-1]})")
+    Session, (project_id, user_id) = preparar(args.database_url, args.miembros)
+
+    # Caché local sin diskcache compartido para aislar la medición
+    project_access.user_cache = UserCache(None)
+
+    def legacy(db):
+        project = db.query(models.Project).filter(models.Project.id == project_id).first()
+        user = db.get(models.User, user_id)
+        return not (project.owner_id != user.id and user not in project.assigned_users)
+
+    def con_exists(db):
+        return db.execute(consulta_acceso(project_id, user_id)).scalar_one_or_none()
+
+    usuario = Session().get(models.User, user_id)
+
+    def con_cache(db):
+        verificar_acceso_proyecto(db, usuario, project_id)
+        return True
+
+    print("\n⏱️  Resultados (por solicitud)")
+    print("-" * 72)
+    t_legacy = medir("legacy (assigned_users)", Session, legacy, args.iteraciones)
+    t_exists = medir("EXISTS indexado", Session, con_exists, args.iteraciones)
+    t_cache = medir("conjunto cacheado (user_cache)", Session, con_cache, args.iteraciones)
+    print("-" * 72)
+    print(f"   EXISTS: x{t_legacy / t_exists:.0f} más rápido   conjunto cacheado: x{t_legacy / t_cache:.0f} más rápido")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark: conversión del reporte de registros a JSON.
+
+Compara el bucle original con df.iterrows() (usado antes en
+generar_reporte_registros) contra la ruta vectorizada de report_export,
+usando un DataFrame sintético con las mismas columnas del reporte.
+
+Uso:
+    python bench_report_serialization.py --filas 200000
+"""
+
+import argparse
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from report_export import registros_desde_dataframe, serializar_json, dataframe_a_arrow_ipc
+
+
+def generar_dataframe(filas: int) -> pd.DataFrame:
+    """Crea un DataFrame con la forma del reporte generado por generar_reporte."""
+    rng = np.random.default_rng(42)
+    lats = rng.uniform(4.5, 4.8, filas).round(6)
+    lons = rng.uniform(-74.2, -74.0, filas).round(6)
+    pids = [f"5f231f11682b965f98898{i % 50:03d}" for i in range(filas)]
+    ids = [f"6{i:023x}" for i in range(filas)]
+    clasif = rng.choice(["EN OBRA", "EN OFICINA", "UBICACIÓN EXTERNA"], filas)
+    fechas = pd.Timestamp(datetime(2025, 1, 1)) + pd.to_timedelta(rng.integers(0, 86400 * 365, filas), unit="s")
+
+    return pd.DataFrame({
+        "id": ids,
+        "project_id": pids,
+        "Proyecto": [f"Proyecto {i % 50}" for i in range(filas)],
+        "Colaborador": [f"Colaborador {i % 700}" for i in range(filas)],
+        "Cargo": "Inspector",
+        "Correo": [f"user{i % 700}@segmab.com" for i in range(filas)],
+        "Fecha del registro": fechas,
+        "Formato": "F-001",
+        "Norte (Lat)": lats,
+        "Este (Lon)": lons,
+        "Coordenadas_Google": [f"{a}, {b}" for a, b in zip(lats, lons)],
+        "Clasificación": clasif,
+        "URL Registro": [f"https://segmab.com/i40/home#!/proyecto/{p}/registro/{i}" for p, i in zip(pids, ids)],
+    })
+
+
+def registros_con_iterrows(df: pd.DataFrame) -> list:
+    """Copia del bucle original de generar_reporte_registros."""
+    records = []
+    for _, row in df.iterrows():
+        record = {}
+        for col in df.columns:
+            value = row[col]
+            if pd.isna(value):
+                record[col] = None
+            elif isinstance(value, (datetime, pd.Timestamp)):
+                record[col] = value.strftime("%Y-%m-%d %H:%M:%S")
+            elif isinstance(value, (int, float)):
+                record[col] = float(value)
+            else:
+                record[col] = str(value)
+
+        if "Coordenadas_Google" in record and record["Coordenadas_Google"]:
+            try:
+                parts = record["Coordenadas_Google"].split(",")
+                record["coords"] = {
+                    "lat": float(parts[0].strip()),
+                    "lon": float(parts[1].strip())
+                }
+            except:
+                pass
+
+        if "id" in record:
+            record["_id"] = record["id"]
+        records.append(record)
+    return records
+
+
+def medir(nombre: str, fn):
+    inicio = time.perf_counter()
+    resultado = fn()
+    duracion = time.perf_counter() - inicio
+    print(f"   {nombre:<38} {duracion * 1000:>10.1f} ms")
+    return resultado, duracion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de serialización de reportes")
+    parser.add_argument("--filas", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"\n📊 Generando DataFrame sintético de {args.filas:,} filas...")
+    df = generar_dataframe(args.filas)
+
+    print("\n⏱️  Resultados")
+    print("-" * 60)
+    legacy, t_legacy = medir("iterrows + dict por fila", lambda: registros_con_iterrows(df))
+    _, t_legacy_json = medir("json.dumps (legacy)", lambda: json.dumps({"records": legacy}, default=str))
+    nuevos, t_vect = medir("registros_desde_dataframe", lambda: registros_desde_dataframe(df))
+    _, t_orjson = medir("orjson (serializar_json)", lambda: serializar_json({"records": nuevos}))
+    arrow, t_arrow = medir("Arrow IPC (dataframe_a_arrow_ipc)", lambda: dataframe_a_arrow_ipc(df))
+    print("-" * 60)
+
+    # Verificar equivalencia de la salida
+    assert len(legacy) == len(nuevos)
+    for a, b in zip(legacy[:1000], nuevos[:1000]):
+        assert a == b, f"Diferencia en registro:\n{a}\n{b}"
+
+    total_legacy = t_legacy + t_legacy_json
+    total_nuevo = t_vect + t_orjson
+    print(f"   Total legacy:      {total_legacy * 1000:>10.1f} ms")
+    print(f"   Total vectorizado: {total_nuevo * 1000:>10.1f} ms  (x{total_legacy / total_nuevo:.1f})")
+    print(f"   Tamaño Arrow IPC:  {len(arrow) / 1e6:>10.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
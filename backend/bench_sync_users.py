@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark: costo de CPU de la sincronización MongoDB -> PostgreSQL por cada 1.000 usuarios.
+
+Mide, sin base de datos, el diff en memoria (MongoSyncEngine.calcular_plan)
+y la preparación de las filas de usuarios nuevos con dos estrategias:
+
+- bcrypt por usuario (comportamiento anterior, crud.create_user con
+  contraseña aleatoria): se mide sobre una muestra y se extrapola.
+- contraseña inutilizable (filas_usuarios_nuevos, lo que usa la sincronización).
+
+Uso:
+    python bench_sync_users.py --usuarios 5000 --muestra 20
+"""
+
+import argparse
+import time
+import uuid
+
+import crud
+from mongo_sync import EstadoPostgres, MongoSyncEngine, filas_usuarios_nuevos
+
+
+def generar_datos(usuarios: int, proyectos: int):
+    """Documentos de Mongo sintéticos: cada usuario pertenece a 3 proyectos."""
+    mongo_projects = [
+        {"_id": f"p{j:05d}", "name": f"Proyecto {j}", "description": "", "users": []}
+        for j in range(proyectos)
+    ]
+    mongo_users = []
+    for i in range(usuarios):
+        email = f"usuario{i}@segmab.com"
+        pids = [f"p{(i + k) % proyectos:05d}" for k in range(3)]
+        for pid in pids:
+            mongo_projects[int(pid[1:])]["users"].append({"email": email})
+        mongo_users.append({"_id": f"u{i:06d}", "email": email, "displayName": f"Usuario {i}", "projects": pids})
+    return mongo_projects, mongo_users
+
+
+def estado_vacio() -> EstadoPostgres:
+    """PostgreSQL sin usuarios ni proyectos (peor caso: todo es nuevo)."""
+    estado = EstadoPostgres.__new__(EstadoPostgres)
+    estado.proyectos_por_mongo = {}
+    estado.proyectos_por_nombre = {}
+    estado.usuarios_por_email = {}
+    estado.usuarios_por_mongo = {}
+    estado.usernames = set()
+    estado.asignaciones = set()
+    return estado
+
+
+def medir(nombre: str, fn, escala: float = 1.0):
+    inicio = time.perf_counter()
+    resultado = fn()
+    duracion = (time.perf_counter() - inicio) * escala
+    print(f"   {nombre:<44} {duracion:>10.3f} s / 1.000 usuarios")
+    return resultado, duracion
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de sincronización de usuarios")
+    parser.add_argument("--usuarios", type=int, default=5000)
+    parser.add_argument("--proyectos", type=int, default=200)
+    parser.add_argument("--muestra", type=int, default=20, help="Usuarios hasheados para medir bcrypt")
+    args = parser.parse_args()
+
+    print(f"\n📊 {args.usuarios:,} usuarios, {args.proyectos} proyectos "
+          f"(bcrypt rounds={crud.pwd_context.handler('bcrypt').default_rounds})")
+    mongo_projects, mongo_users = generar_datos(args.usuarios, args.proyectos)
+    por_mil = 1000 / args.usuarios
+
+    print("\n⏱️  Resultados")
+    print("-" * 72)
+    motor = MongoSyncEngine(db=None, owner_id=1)
+    plan, t_diff = medir(
+        "diff en memoria (calcular_plan)",
+        lambda: motor.calcular_plan(estado_vacio(), mongo_projects, mongo_users),
+        por_mil
+    )
+
+    contrasenas = [str(uuid.uuid4())[:12] for _ in range(args.muestra)]
+    escala_muestra = 1000 / args.muestra
+    _, t_serial = medir(
+        f"bcrypt por usuario (muestra de {args.muestra})",
+        lambda: [crud.get_password_hash(p) for p in contrasenas],
+        escala_muestra
+    )
+    filas, t_marcador = medir("contraseña inutilizable", lambda: filas_usuarios_nuevos(plan), por_mil)
+    print("-" * 72)
+
+    assert len(filas) == args.usuarios
+    assert not any(crud.has_usable_password(f["hashed_password"]) for f in filas)
+    assert not crud.verify_password("cualquiera", filas[0]["hashed_password"])
+
+    print(f"   Antes (bcrypt por usuario):  {t_diff + t_serial:>9.2f} s / 1.000 usuarios")
+    print(f"   Contraseña inutilizable:     {t_diff + t_marcador:>9.2f} s / 1.000 usuarios  "
+          f"(x{(t_diff + t_serial) / (t_diff + t_marcador):.0f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark: codificación de tiles por formato y perfil.
+
+Mide tiempo de codificación (p50) y tamaño de cada formato de
+tile_renderer.ENCODE_PROFILES (webp, png, jpeg, lossless) en sus perfiles
+"fast" (render bajo demanda) y "seed" (precarga de caché), sobre tiles con
+distinto contenido:
+
+- ortofoto: textura RGB con ruido (el caso más caro)
+- dem: rampa de elevación en escala de grises (normalizada como en el render)
+- borde: ortofoto con un 40 % transparente (borde del raster)
+- uniforme: un solo color (agua, zonas sin datos rellenas)
+
+Con --raster se usan además tiles reales leídos con tile_renderer.
+
+Uso:
+    python bench_tile_encoding.py --repeticiones 30
+    python bench_tile_encoding.py --raster uploads/ortofoto_cog.tif --zoom 18
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from tile_renderer import ENCODE_PROFILES, TILE_SIZE, TILE_FORMATS, encode_tile, tile_renderer
+
+
+def tiles_sinteticos() -> dict:
+    rng = np.random.default_rng(42)
+    yy, xx = np.mgrid[0:TILE_SIZE, 0:TILE_SIZE]
+    opaco = np.full((TILE_SIZE, TILE_SIZE), 255, np.uint8)
+
+    base = (np.sin(xx / 13) + np.cos(yy / 17)) * 40 + 128
+    rgb = np.clip(base[..., None] + rng.normal(0, 18, (TILE_SIZE, TILE_SIZE, 3)), 0, 255).astype(np.uint8)
+    ortofoto = np.dstack([rgb, opaco])
+
+    elevacion = np.clip(xx * 0.6 + yy * 0.3 + np.sin(xx / 20) * 10, 0, 255).astype(np.uint8)
+    dem = np.dstack([elevacion, elevacion, elevacion, opaco])
+
+    borde = ortofoto.copy()
+    borde[:, :100, 3] = 0
+
+    uniforme = np.dstack([np.full((TILE_SIZE, TILE_SIZE, 3), (38, 92, 140), np.uint8), opaco])
+    return {"ortofoto": ortofoto, "dem": dem, "borde": borde, "uniforme": uniforme}
+
+
+def tiles_raster(path: str, zoom: int, cantidad: int) -> dict:
+    import mercantile
+    from rasterio.warp import transform_bounds
+
+    b = tile_renderer.bounds_3857(path)
+    oeste, sur, este, norte = transform_bounds("EPSG:3857", "EPSG:4326", b.left, b.bottom, b.right, b.top)
+    tiles = {}
+    for t in mercantile.tiles(oeste, sur, este, norte, zoom):
+        rgba = tile_renderer.render_rgba(path, t.z, t.x, t.y)
+        if rgba is not None:
+            tiles[f"raster {t.z}/{t.x}/{t.y}"] = rgba
+        if len(tiles) >= cantidad:
+            break
+    return tiles
+
+
+def medir(rgba: np.ndarray, fmt: str, perfil: str, repeticiones: int):
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        datos = encode_tile(rgba, fmt, perfil)
+        tiempos.append(time.perf_counter() - inicio)
+    return statistics.median(tiempos), len(datos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de codificación de tiles")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--raster", help="COG para medir también tiles reales")
+    parser.add_argument("--zoom", type=int, default=18)
+    parser.add_argument("--tiles", type=int, default=3, help="Tiles reales a medir con --raster")
+    args = parser.parse_args()
+
+    tiles = tiles_sinteticos()
+    if args.raster:
+        tiles.update(tiles_raster(args.raster, args.zoom, args.tiles))
+
+    print("\n⏱️  Codificación de tiles (p50 por tile)")
+    print("-" * 72)
+    print(f"   {'contenido':<22} {'formato':<9} {'perfil':<6} {'ms':>8} {'KB':>8}")
+    for nombre, rgba in tiles.items():
+        for fmt in TILE_FORMATS:
+            for perfil in ENCODE_PROFILES:
+                # Los perfiles lentos (lossless seed) se miden con menos repeticiones
+                repeticiones = args.repeticiones if perfil == "fast" else max(3, args.repeticiones // 4)
+                t, tam = medir(rgba, fmt, perfil, repeticiones)
+                print(f"   {nombre:<22} {fmt:<9} {perfil:<6} {t * 1000:>8.2f} {tam / 1024:>8.1f}")
+        print()
+    print("-" * 72)
+    print("   jpeg con transparencia se codifica como png (ver encode_tile)")
+
+
+if __name__ == "__main__":
+    main()
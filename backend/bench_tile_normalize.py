@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark: normalización de tiles a RGBA uint8 por tipo de dato.
+
+Compara la ruta anterior de read_tile (np.nan_to_num + np.clip + aritmética
+float + astype + ensamblado RGB) contra tile_normalize.Normalizador (LUT para
+8/16 bits, in-place con búfer por hilo para float), con tiles sintéticos de
+1 y 3 bandas y, para una banda, también con colormap.
+
+Verifica que ambas rutas den el mismo resultado (diferencia máxima de 1 nivel
+por redondeo de float32).
+
+Uso:
+    python bench_tile_normalize.py --repeticiones 500
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from tile_normalize import Normalizador
+from tile_renderer import TILE_SIZE
+
+TIPOS = ("uint8", "uint16", "int16", "float32")
+
+
+def normalizar_legacy(data: np.ndarray, mask: np.ndarray, estiramiento) -> np.ndarray:
+    """Ruta anterior de VRTHandle.read_tile (antes de codificar)."""
+    data = np.nan_to_num(data)
+    if estiramiento is not None:
+        low, high = estiramiento
+        span = np.where(high > low, high - low, np.inf)
+        data = np.clip(data, low, high)
+        data = ((data - low) / span * 255).astype(np.uint8)
+    else:
+        data = data.astype(np.uint8)
+    rgba = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    if data.shape[0] >= 3:
+        rgba[..., :3] = np.transpose(data[:3], (1, 2, 0))
+    else:
+        rgba[..., :3] = data[0][..., None]
+    rgba[..., 3] = mask
+    return rgba
+
+
+def generar(dtype: str, bandas: int):
+    rng = np.random.default_rng(7)
+    if dtype == "uint8":
+        data = rng.integers(0, 256, (bandas, TILE_SIZE, TILE_SIZE)).astype(np.uint8)
+        estiramiento = None
+    else:
+        centro, escala = {"uint16": (3000, 800), "int16": (1500, 900), "float32": (2600.0, 400.0)}[dtype]
+        data = rng.normal(centro, escala, (bandas, TILE_SIZE, TILE_SIZE)).astype(dtype)
+        if dtype == "float32":
+            data[:, :8, :8] = np.nan
+        bajo = np.array([centro - 2 * escala] * bandas, np.float32).reshape(-1, 1, 1)
+        alto = np.array([centro + 2 * escala] * bandas, np.float32).reshape(-1, 1, 1)
+        estiramiento = (bajo, alto)
+    mask = np.full((TILE_SIZE, TILE_SIZE), 255, np.uint8)
+    mask[-20:, :] = 0
+    return data, mask, estiramiento
+
+
+def medir(funcion, repeticiones: int) -> float:
+    funcion()
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion()
+    return (time.perf_counter() - inicio) / repeticiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de normalización de tiles")
+    parser.add_argument("--repeticiones", type=int, default=300)
+    args = parser.parse_args()
+
+    print("\n⏱️  Normalización por tile (256x256)")
+    print("-" * 72)
+    print(f"   {'tipo':<9} {'bandas':>6} {'legacy (ms)':>12} {'motor (ms)':>11} {'colormap (ms)':>14} {'x':>6}")
+    for dtype in TIPOS:
+        for bandas in (1, 3):
+            data, mask, estiramiento = generar(dtype, bandas)
+            normalizador = Normalizador(dtype, bandas, estiramiento)
+
+            esperado = normalizar_legacy(data.copy(), mask, estiramiento)
+            obtenido = normalizador.aplicar(data, mask)
+            diferencia = np.abs(esperado.astype(np.int16) - obtenido.astype(np.int16)).max()
+            assert diferencia <= 1, f"{dtype}/{bandas}: diferencia máxima {diferencia}"
+
+            t_legacy = medir(lambda: normalizar_legacy(data, mask, estiramiento), args.repeticiones)
+            t_motor = medir(lambda: normalizador.aplicar(data, mask), args.repeticiones)
+            columna_color = ""
+            if bandas == 1:
+                con_color = Normalizador(dtype, bandas, estiramiento, "terrain")
+                t_color = medir(lambda: con_color.aplicar(data, mask), args.repeticiones)
+                columna_color = f"{t_color * 1000:>14.3f}"
+            print(f"   {dtype:<9} {bandas:>6} {t_legacy * 1000:>12.3f} {t_motor * 1000:>11.3f} "
+                  f"{columna_color or '-':>14} {t_legacy / t_motor:>5.1f}x")
+    print("-" * 72)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark: ingesta de capas vectoriales (SHP/GeoJSON/GPKG) y vector tiles.
+
+Si no se indica --shp, genera un shapefile catastral sintético (manzanas de
+predios rectangulares en MAGNA-SIRGAS / Colombia Bogotá, EPSG:3116).
+
+Etapas medidas:
+- lectura: fiona -> shapely (vector_tiles.fuentes_vector)
+- preparación: reproyección a EPSG:3857 + EWKB + CSV por lotes, con un cursor
+  que solo descarta el COPY (sin base de datos)
+- con --database-url (PostgreSQL/PostGIS DESECHABLE): ingesta completa con
+  COPY (ingerir_capa) y tiempos de ST_AsMVT por zoom y de GeoJSON por bbox
+
+Uso:
+    python bench_vector_ingest.py --predios 500000
+    python bench_vector_ingest.py --shp catastro.shp --database-url postgresql://u:p@localhost/bench
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import statistics
+from collections import namedtuple
+
+import mercantile
+
+import vector_tiles
+
+
+def generar_shapefile(path: str, predios: int):
+    import fiona
+
+    esquema = {"geometry": "Polygon", "properties": {"codigo": "str:20", "nombre": "str:40", "area": "float"}}
+    lado = int(predios ** 0.5) + 1
+    x0, y0, tam = 990000.0, 1000000.0, 20.0  # predios de 20 m en Bogotá (EPSG:3116)
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs="EPSG:3116", schema=esquema) as dst:
+        def registros():
+            for i in range(predios):
+                fila, col = divmod(i, lado)
+                x, y = x0 + col * tam, y0 + fila * tam
+                anillo = [(x, y), (x + tam * 0.9, y), (x + tam * 0.9, y + tam * 0.9), (x, y + tam * 0.9), (x, y)]
+                yield {
+                    "geometry": {"type": "Polygon", "coordinates": [anillo]},
+                    "properties": {"codigo": f"P{i:08d}", "nombre": f"Predio {i}", "area": (tam * 0.9) ** 2},
+                }
+        dst.writerecords(registros())
+
+
+class _CursorDescarte:
+    """Cursor falso: consume el CSV del COPY y cuenta bytes."""
+    bytes_copiados = 0
+
+    def copy_expert(self, sql, archivo):
+        _CursorDescarte.bytes_copiados += len(archivo.getvalue())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _SesionDescarte:
+    def connection(self):
+        conexion = namedtuple("C", "connection")
+        return conexion(namedtuple("D", "cursor")(lambda: _CursorDescarte()))
+
+
+def medir_sin_bd(path: str):
+    inicio = time.perf_counter()
+    leidos = sum(sum(1 for _ in features) for features, _ in vector_tiles.fuentes_vector(path))
+    t_lectura = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    preparados = sum(
+        vector_tiles.copiar_features(_SesionDescarte(), 1, features, crs)
+        for features, crs in vector_tiles.fuentes_vector(path)
+    )
+    t_total = time.perf_counter() - inicio
+
+    print(f"   Lectura fiona -> shapely:          {t_lectura:>7.2f} s   ({leidos / t_lectura:,.0f} elementos/s)")
+    print(f"   Lectura + 3857 + EWKB + CSV:       {t_total:>7.2f} s   ({preparados / t_total:,.0f} elementos/s)")
+    print(f"   CSV para COPY:                     {_CursorDescarte.bytes_copiados / 1e6:>7.1f} MB")
+
+
+def medir_con_bd(path: str, url: str):
+    from sqlalchemy import create_engine, func, select
+    from sqlalchemy.orm import sessionmaker
+    import models
+
+    engine = create_engine(url)
+    for tabla in (models.User.__table__, models.Project.__table__, models.Folder.__table__,
+                  models.Layer.__table__, models.VectorFeature.__table__):
+        tabla.create(engine, checkfirst=True)
+    Session = sessionmaker(bind=engine)
+    db = Session()
+
+    usuario = models.User(username=f"bench_vec_{int(time.time())}", email=f"bench_vec_{int(time.time())}@segmab.com",
+                          hashed_password="!")
+    db.add(usuario)
+    db.flush()
+    proyecto = models.Project(name="Benchmark vectorial", owner_id=usuario.id)
+    db.add(proyecto)
+    db.flush()
+    capa = models.Layer(name="catastro", layer_type="vector", file_path=path, project_id=proyecto.id, settings={})
+    db.add(capa)
+    db.commit()
+
+    inicio = time.perf_counter()
+    total = vector_tiles.ingerir_capa(db, capa, vector_tiles.fuentes_para_capa("vector", path))
+    t_ingesta = time.perf_counter() - inicio
+    print(f"   Ingesta COPY completa:             {t_ingesta:>7.2f} s   ({total / t_ingesta:,.0f} elementos/s)")
+
+    xmin, ymin, xmax, ymax = db.execute(
+        select(func.ST_XMin(func.ST_Extent(func.ST_Transform(models.VectorFeature.geom, 4326))),
+               func.ST_YMin(func.ST_Extent(func.ST_Transform(models.VectorFeature.geom, 4326))),
+               func.ST_XMax(func.ST_Extent(func.ST_Transform(models.VectorFeature.geom, 4326))),
+               func.ST_YMax(func.ST_Extent(func.ST_Transform(models.VectorFeature.geom, 4326))))
+        .where(models.VectorFeature.layer_id == capa.id)
+    ).one()
+    centro = ((xmin + xmax) / 2, (ymin + ymax) / 2)
+
+    print("\n   Zoom   ST_AsMVT p50 (ms)   tamaño (KB)")
+    for z in (10, 12, 14, 16, 18):
+        t = mercantile.tile(*centro, z)
+        tiempos, tam = [], 0
+        for _ in range(5):
+            inicio = time.perf_counter()
+            tile = vector_tiles.renderizar_tile(db, capa.id, z, t.x, t.y)
+            tiempos.append(time.perf_counter() - inicio)
+            tam = len(tile)
+        print(f"   {z:>4}   {statistics.median(tiempos) * 1000:>15.1f}   {tam / 1024:>11.1f}")
+
+    ancho = (xmax - xmin) / 50
+    bbox = (centro[0] - ancho, centro[1] - ancho, centro[0] + ancho, centro[1] + ancho)
+    inicio = time.perf_counter()
+    geojson = vector_tiles.features_geojson(db, capa.id, bbox=bbox, zoom=17)
+    print(f"\n   GeoJSON por bbox (zoom 17):        {(time.perf_counter() - inicio) * 1000:>7.1f} ms   "
+          f"({len(geojson) / 1024:,.0f} KB)")
+
+    db.delete(capa)
+    db.delete(proyecto)
+    db.delete(usuario)
+    db.commit()
+    db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de ingesta vectorial y vector tiles")
+    parser.add_argument("--shp", help="Shapefile/GeoJSON/GPKG a usar (si no, se genera uno sintético)")
+    parser.add_argument("--predios", type=int, default=500000)
+    parser.add_argument("--database-url", help="PostgreSQL/PostGIS desechable para la ingesta completa")
+    args = parser.parse_args()
+
+    path = args.shp
+    if not path:
+        path = os.path.join(tempfile.mkdtemp(prefix="bench_vec_"), "catastro.shp")
+        inicio = time.perf_counter()
+        generar_shapefile(path, args.predios)
+        print(f"\n🧱 Shapefile sintético: {args.predios:,} predios en {time.perf_counter() - inicio:.1f}s ({path})")
+
+    print(f"\n⏱️  Ingesta de {path}")
+    print("-" * 72)
+    medir_sin_bd(path)
+    if args.database_url:
+        medir_con_bd(path, args.database_url)
+    print("-" * 72)
+
+
+if __name__ == "__main__":
+    main()
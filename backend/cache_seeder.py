@@ -14,7 +14,7 @@ import mercantile
 from database import SessionLocal
 from shared import tile_cache, UPLOAD_DIR
 from convert_cogs import update_layer_progress, check_layer_status
-from tile_renderer import tile_renderer
+from tile_renderer import tile_renderer, tile_cache_key
 
 logger = logging.getLogger(__name__)
 
@@ -56,6 +56,10 @@ def seed_cache_for_layer(file_path, layer_id):
             tiles = list(mercantile.tiles(*wgs84_bounds, z))
             tiles_to_process.extend([(z, t.x, t.y) for t in tiles])
         
+        # Same format the tile endpoint negotiates for browsers (lossless WEBP for DEMs)
+        fmt = "lossless" if tile_renderer.is_dem(file_path) else "webp"
+        cache_name = tile_renderer.cache_name(file_path)
+        
         total_count = len(tiles_to_process)
         logger.info(f"Seeding {total_count} tiles for {filename} (zoom {min_zoom}-{max_zoom})")
         
@@ -65,7 +69,7 @@ def seed_cache_for_layer(file_path, layer_id):
         skipped = 0
         
         for z, x, y in tiles_to_process:
-            cache_key = f"{filename}-{z}-{x}-{y}"
+            cache_key = tile_cache_key(cache_name, z, x, y, fmt)
             
             # Skip if already cached
             if tile_cache.get(cache_key):
@@ -74,8 +78,9 @@ def seed_cache_for_layer(file_path, layer_id):
                 continue
             
             # Generate tile using the fast VRT renderer
+            # (seed profile: slower encode, smaller tiles served many times)
             try:
-                content = tile_renderer.render_tile(file_path, z, x, y)
+                content = tile_renderer.render_tile(file_path, z, x, y, fmt, profile="seed")
                 if content:
                     tile_cache.set(cache_key, content, expire=86400 * 30)  # 30 days
             except Exception as e:
@@ -8,6 +8,7 @@ import models
 import logging
 
 from shared import UPLOAD_DIR, BACKUP_DIR
+from raster_stats import guardar_estadisticas, STRETCH_PERCENTILES
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +38,38 @@ def check_layer_status(db, layer_id):
     layer = db.query(models.Layer).filter(models.Layer.id == layer_id).first()
     return layer.processing_status if layer else "cancelled"
 
+def registrar_estadisticas(db, filepath, layer_id):
+    """
+    Calcula las estadísticas por banda del raster, las escribe como metadatos
+    GDAL y las guarda en Layer.settings["stats"]. Un fallo aquí no invalida la
+    capa (el renderer las calcula al vuelo si faltan).
+    """
+    from tile_renderer import tile_renderer
+
+    # Cerrar el handle abierto (bloqueo de archivo en Windows); al reabrirse lee los metadatos nuevos
+    tile_renderer.invalidate(filepath)
+    try:
+        bandas = guardar_estadisticas(filepath)
+    except Exception as e:
+        logger.warning(f"No se pudieron calcular estadísticas de {filepath}: {e}")
+        return
+    finally:
+        tile_renderer.invalidate(filepath)
+
+    if not layer_id:
+        return
+    try:
+        layer = db.query(models.Layer).filter(models.Layer.id == layer_id).first()
+        if layer:
+            layer.settings = {
+                **(layer.settings or {}),
+                "stats": {"percentiles": list(STRETCH_PERCENTILES), "bands": bandas},
+            }
+            db.commit()
+    except Exception as e:
+        logger.error(f"Error guardando estadísticas de la capa {layer_id}: {e}")
+        db.rollback()
+
 def convert_to_cog(filepath, layer_id=None):
     """
     Convierte un archivo TIFF a un formato optimizado (COG-like):
@@ -58,12 +91,16 @@ def convert_to_cog(filepath, layer_id=None):
             # Check if already optimized (rough check)
             is_tiled = src.profile.get('tiled', False)
             has_overviews = len(src.overviews(1)) > 0
-            if is_tiled and has_overviews:
-                print(f"✅ {filepath} ya parece optimizado. Saltando.")
-                if layer_id:
-                    update_layer_progress(db, layer_id, "completed", 100)
-                return False
+            already_optimized = is_tiled and has_overviews
+            
+        if already_optimized:
+            print(f"✅ {filepath} ya parece optimizado. Saltando.")
+            registrar_estadisticas(db, filepath, layer_id)
+            if layer_id:
+                update_layer_progress(db, layer_id, "completed", 100)
+            return False
 
+        with rasterio.open(filepath) as src:
             print(f"🔄 Optimizando {filepath}...")
             if layer_id:
                 update_layer_progress(db, layer_id, "processing", 10)
@@ -176,6 +213,8 @@ def convert_to_cog(filepath, layer_id=None):
             
         print(f"✨ Optimizado: {filepath}")
         
+        registrar_estadisticas(db, filepath, layer_id)
+        
         if layer_id:
             update_layer_progress(db, layer_id, "completed", 100)
             
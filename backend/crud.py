@@ -1,10 +1,21 @@
-from sqlalchemy.orm import Session, joinedload, selectinload
-from sqlalchemy import func, or_, text
-from models import User, Project, Layer, Folder, Measurement
-from schemas import UserCreate, ProjectCreate, LayerCreate, FolderCreate, MeasurementCreate, MeasurementUpdate
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import func, or_, text, select, exists, tuple_, String, Text, JSON, cast, literal, literal_column
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from models import User, Project, Layer, Folder, Measurement, user_projects
+from user_cache import user_cache
+from layer_bounds import bounds_desde_metadatos, envolvente
+from shared import stats_cache
+from schemas import UserBase, UserCreate, ProjectCreate, LayerCreate, FolderCreate, MeasurementCreate, MeasurementUpdate
+import re
 import json
+import math
+import base64
 from passlib.context import CryptContext
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Set, Tuple, Union
 import os
+import asyncio
+import secrets
 import logging
 
 # Configurar logging para ver errores detallados en la terminal del usuario
@@ -13,12 +24,41 @@ logger = logging.getLogger(__name__)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Prefijo de contraseña inutilizable (cuentas sincronizadas o creadas vía Google):
+# no es un hash válido, así que ninguna contraseña coincide y no cuesta bcrypt.
+# El usuario entra con Google/SSO o cuando un administrador le asigna una contraseña.
+UNUSABLE_PASSWORD_PREFIX = "!"
+
+# Pool acotado para verificar contraseñas en el login sin bloquear el event loop
+# (bcrypt libera el GIL, así que los hilos verifican en paralelo)
+LOGIN_HASH_WORKERS = int(os.getenv("LOGIN_HASH_WORKERS", 2))
+_verify_pool = ThreadPoolExecutor(max_workers=LOGIN_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+# Vigencia de las estadísticas del dashboard en stats_cache
+DASHBOARD_STATS_TTL_SECONDS = float(os.getenv("DASHBOARD_STATS_TTL_SECONDS", 30))
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def make_unusable_password():
+    # Sufijo aleatorio para que dos cuentas no compartan el mismo valor
+    return UNUSABLE_PASSWORD_PREFIX + secrets.token_urlsafe(16)
+
+def has_usable_password(hashed_password):
+    return bool(hashed_password) and not hashed_password.startswith(UNUSABLE_PASSWORD_PREFIX)
+
 def verify_password(plain_password, hashed_password):
+    if not has_usable_password(hashed_password):
+        return False
     return pwd_context.verify(plain_password, hashed_password)
 
+async def verify_password_async(plain_password, hashed_password):
+    """verify_password en el pool acotado; las cuentas sin contraseña no ocupan el pool."""
+    if not has_usable_password(hashed_password):
+        return False
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_verify_pool, pwd_context.verify, plain_password, hashed_password)
+
 # --- USER CRUD ---
 def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(User).offset(skip).limit(limit).all()
@@ -32,8 +72,10 @@ def get_user_by_username(db: Session, username: str):
 def get_user(db: Session, user_id: int):
     return db.query(User).filter(User.id == user_id).first()
 
-def create_user(db: Session, user: UserCreate):
-    hashed_password = get_password_hash(user.password)
+def create_user(db: Session, user: Union[UserCreate, UserBase]):
+    # Sin contraseña (UserBase): cuenta con contraseña inutilizable, sin costo de bcrypt
+    password = getattr(user, "password", None)
+    hashed_password = get_password_hash(password) if password else make_unusable_password()
     user_data = user.dict(exclude={"password"})
     db_user = User(**user_data, hashed_password=hashed_password)
 
@@ -56,6 +98,7 @@ def update_user(db: Session, user_id: int, user_update: dict):
             
     db.commit()
     db.refresh(db_user)
+    user_cache.invalidar()
     return db_user
 
 def delete_user(db: Session, user_id: int):
@@ -63,6 +106,7 @@ def delete_user(db: Session, user_id: int):
     if db_user:
         db.delete(db_user)
         db.commit()
+        user_cache.invalidar()
     return db_user
 
 # --- PROJECT CRUD ---
@@ -88,6 +132,107 @@ def get_projects(db: Session, user_id: int, is_admin: bool = False):
         logger.error(f"Error en get_projects: {e}")
         return db.query(Project).filter(Project.owner_id == user_id).all()
 
+def _get_project_with_relations(db: Session, project_id: int):
+    """
+    Proyecto con las colecciones de ProjectRead cargadas.
+    selectinload emite una consulta por colección en lugar de un JOIN cartesiano
+    (usuarios x capas x carpetas) que multiplica las filas devueltas.
+    """
+    return db.query(Project).options(
+        selectinload(Project.assigned_users),
+        selectinload(Project.layers),
+        selectinload(Project.folders),
+        selectinload(Project.measurements)
+    ).filter(Project.id == project_id).first()
+
+# Inclusiones opcionales del listado resumido
+PROJECT_SUMMARY_INCLUDES = {"details", "members"}
+_BOX_RE = re.compile(r"BOX\(([-\d.eE+]+) ([-\d.eE+]+),([-\d.eE+]+) ([-\d.eE+]+)\)")
+
+def _encode_cursor(name: str, project_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([name, project_id]).encode()).decode()
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
+    name, project_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return str(name), int(project_id)
+
+def _parse_box(box: Optional[str]) -> Optional[List[float]]:
+    """Convierte el texto de ST_Extent ('BOX(xmin ymin,xmax ymax)') a [xmin, ymin, xmax, ymax]."""
+    match = _BOX_RE.match(box) if box else None
+    return [float(v) for v in match.groups()] if match else None
+
+def get_project_summaries(
+    db: Session,
+    user_id: int,
+    is_admin: bool = False,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    search: Optional[str] = None,
+    include: Optional[Set[str]] = None
+) -> dict:
+    """
+    Listado liviano de proyectos para el selector: id, nombre, conteos y bbox.
+    
+    Una sola consulta con subconsultas correlacionadas (sin hidratar
+    usuarios, capas ni carpetas) y paginación por cursor sobre (name, id),
+    estable aunque se creen proyectos entre páginas.
+    
+    Args:
+        include: 'details' (descripción, contrato, fechas, foto, dueño) y/o
+            'members' (ids de usuarios asignados)
+    
+    Returns:
+        {"items": [...], "next_cursor": str | None}
+    """
+    include = include or set()
+    layer_count = select(func.count(Layer.id)).where(Layer.project_id == Project.id).scalar_subquery()
+    member_count = select(func.count()).select_from(user_projects).where(
+        user_projects.c.project_id == Project.id
+    ).scalar_subquery()
+    bbox = select(cast(func.ST_Extent(Layer.bounds), String)).where(Layer.project_id == Project.id).scalar_subquery()
+
+    columns = [
+        Project.id, Project.name,
+        layer_count.label("layer_count"),
+        member_count.label("member_count"),
+        bbox.label("bbox"),
+    ]
+    if "details" in include:
+        columns += [
+            Project.description, Project.contract_number, Project.start_date,
+            Project.end_date, Project.photo_url, Project.owner_id,
+        ]
+    if "members" in include:
+        columns.append(
+            select(func.array_agg(user_projects.c.user_id)).where(
+                user_projects.c.project_id == Project.id
+            ).scalar_subquery().label("assigned_user_ids")
+        )
+
+    query = select(*columns)
+    if not is_admin:
+        query = query.where(or_(
+            Project.owner_id == user_id,
+            exists().where(user_projects.c.project_id == Project.id, user_projects.c.user_id == user_id)
+        ))
+    if search:
+        query = query.where(Project.name.ilike(f"%{search}%"))
+    if cursor:
+        query = query.where(tuple_(Project.name, Project.id) > _decode_cursor(cursor))
+
+    # Se pide una fila extra para saber si hay otra página
+    rows = db.execute(query.order_by(Project.name, Project.id).limit(limit + 1)).mappings().all()
+    items = []
+    for row in rows[:limit]:
+        item = dict(row)
+        item["bbox"] = _parse_box(item["bbox"])
+        if "members" in include:
+            item["assigned_user_ids"] = item["assigned_user_ids"] or []
+        items.append(item)
+
+    next_cursor = _encode_cursor(items[-1]["name"], items[-1]["id"]) if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
+
 def create_project(db: Session, project: ProjectCreate, user_id: int):
     """
     Crea un proyecto y asigna usuarios iniciales si se proporcionan.
@@ -105,13 +250,10 @@ def create_project(db: Session, project: ProjectCreate, user_id: int):
             
         db.add(db_project)
         db.commit()
+        user_cache.invalidar()
         
         # Recargar con relaciones para la respuesta
-        return db.query(Project).options(
-            joinedload(Project.assigned_users),
-            joinedload(Project.layers),
-            joinedload(Project.folders)
-        ).filter(Project.id == db_project.id).first()
+        return _get_project_with_relations(db, db_project.id)
     except Exception as e:
         db.rollback()
         logger.error(f"Error en create_project: {str(e)}")
@@ -127,7 +269,8 @@ def update_project(db: Session, project_id: int, project_data: dict):
         
     try:
         # 1. Tratar usuarios asignados si vienen en la data
-        if "assigned_user_ids" in project_data:
+        assigned_changed = "assigned_user_ids" in project_data
+        if assigned_changed:
             user_ids = project_data.pop("assigned_user_ids")
             
             # Limpiar colección actual
@@ -149,13 +292,11 @@ def update_project(db: Session, project_id: int, project_data: dict):
                 setattr(db_project, key, value)
         
         db.commit()
+        if "owner_id" in project_data or assigned_changed:
+            user_cache.invalidar()
         
         # 3. Respuesta final con relaciones cargadas
-        return db.query(Project).options(
-            joinedload(Project.assigned_users),
-            joinedload(Project.layers),
-            joinedload(Project.folders)
-        ).filter(Project.id == project_id).first()
+        return _get_project_with_relations(db, project_id)
         
     except Exception as e:
         db.rollback()
@@ -167,6 +308,7 @@ def delete_project(db: Session, project_id: int):
     if db_project:
         db.delete(db_project)
         db.commit()
+        user_cache.invalidar()
     return db_project
 
 def assign_user_to_project(db: Session, user_id: int, project_id: int):
@@ -177,6 +319,7 @@ def assign_user_to_project(db: Session, user_id: int, project_id: int):
             project.assigned_users.append(user)
             db.commit()
             db.refresh(project)
+            user_cache.invalidar()
     return project
 
 def remove_user_from_project(db: Session, user_id: int, project_id: int):
@@ -187,6 +330,7 @@ def remove_user_from_project(db: Session, user_id: int, project_id: int):
             project.assigned_users.remove(user)
             db.commit()
             db.refresh(project)
+            user_cache.invalidar()
     return project
 
 # --- FOLDER CRUD ---
@@ -235,6 +379,8 @@ def create_layer(db: Session, layer: LayerCreate):
             layer_data["settings"] = {}
             
         db_layer = Layer(**layer_data)
+        # Extensión EPSG:4326 desde los metadatos del archivo (KML/SHP/DXF la fijan al ingerir sus elementos)
+        db_layer.bounds = envolvente(bounds_desde_metadatos(db_layer.layer_type, layer_data["settings"]))
         db.add(db_layer)
         db.commit()
         db.refresh(db_layer)
@@ -265,40 +411,126 @@ def delete_layer(db: Session, layer_id: int):
         db.commit()
     return db_layer
 
+_JSON_VACIO = literal_column("'[]'::json")
+
+
+def _consulta_dashboard_stats(user_id: Optional[int], is_admin: bool):
+    """
+    SELECT único con subconsultas escalares: conteos, top 5 de proyectos/usuarios
+    (como JSON) y tamaño de la base de datos, en un solo viaje a PostgreSQL.
+    """
+    proyectos = select(Project.id, Project.name, func.coalesce(Project.visit_count, 0).label("visits"))
+    capas = select(func.count(Layer.id))
+    if user_id and not is_admin:
+        proyectos = proyectos.where(Project.owner_id == user_id)
+        capas = capas.join(Project, Layer.project_id == Project.id).where(Project.owner_id == user_id)
+    proyectos = proyectos.subquery()
+
+    top_proyectos = select(proyectos.c.name, proyectos.c.visits).order_by(
+        proyectos.c.visits.desc(), proyectos.c.id
+    ).limit(5).subquery()
+    json_proyectos = select(func.coalesce(
+        func.json_agg(aggregate_order_by(
+            func.json_build_object("name", top_proyectos.c.name, "visits", top_proyectos.c.visits),
+            top_proyectos.c.visits.desc(),
+        )),
+        _JSON_VACIO,
+    ))
+
+    if is_admin:
+        usuarios = select(func.count(User.id)).scalar_subquery()
+        top_usuarios = select(User.username, func.coalesce(User.login_count, 0).label("logins")).order_by(
+            func.coalesce(User.login_count, 0).desc(), User.id
+        ).limit(5).subquery()
+        json_usuarios = select(func.coalesce(
+            func.json_agg(aggregate_order_by(
+                func.json_build_object("name", top_usuarios.c.username, "logins", top_usuarios.c.logins),
+                top_usuarios.c.logins.desc(),
+            )),
+            _JSON_VACIO,
+        )).scalar_subquery()
+    else:
+        usuarios = literal(1)
+        json_usuarios = _JSON_VACIO
+
+    return select(
+        usuarios.label("users"),
+        select(func.count()).select_from(proyectos).scalar_subquery().label("projects"),
+        capas.scalar_subquery().label("layers"),
+        func.pg_size_pretty(func.pg_database_size(func.current_database())).label("db_size"),
+        json_proyectos.scalar_subquery().label("top_projects"),
+        json_usuarios.label("top_users"),
+    )
+
+
 def get_dashboard_stats(db: Session, user_id: int = None, is_admin: bool = False):
+    """
+    Estadísticas del dashboard. Se calculan con una sola consulta y se guardan
+    DASHBOARD_STATS_TTL_SECONDS en un diskcache compartido por los workers, así
+    las recargas del dashboard no vuelven a recorrer las tablas.
+    """
+    clave = "admin" if is_admin else f"user:{user_id}"
+    stats = stats_cache.get(clave)
+    if stats is not None:
+        return stats
+
+    stats = None
+    if db.get_bind().dialect.name == "postgresql":
+        try:
+            fila = db.execute(_consulta_dashboard_stats(user_id, is_admin)).one()
+            stats = {
+                "users": fila.users,
+                "projects": fila.projects,
+                "layers": fila.layers,
+                "db_size": fila.db_size or "N/A",
+                "top_projects": fila.top_projects or [],
+                "top_users": fila.top_users or [],
+            }
+        except Exception as e:
+            # p. ej. sin permiso para pg_database_size: se calculan por partes
+            db.rollback()
+            logger.warning(f"Estadísticas del dashboard en una consulta fallaron: {e}")
+    if stats is None:
+        stats = _dashboard_stats_por_partes(db, user_id, is_admin)
+    stats_cache.set(clave, stats, expire=DASHBOARD_STATS_TTL_SECONDS)
+    return stats
+
+def _dashboard_stats_por_partes(db: Session, user_id: Optional[int], is_admin: bool):
+    """
+    Consultas portables (SQLite, DATABASE_URL de respaldo) sin json_agg; el
+    tamaño de la base de datos solo se informa si pg_database_size responde.
+    """
     query_projects = db.query(Project)
     query_layers = db.query(Layer)
-    
     if user_id and not is_admin:
         query_projects = query_projects.filter(Project.owner_id == user_id)
         query_layers = query_layers.join(Project).filter(Project.owner_id == user_id)
-    
-    user_count = db.query(User).count() if is_admin else 1
-    project_count = query_projects.count()
-    layer_count = query_layers.count()
-    
-    top_projects = query_projects.order_by(Project.visit_count.desc()).limit(5).all()
-    
+
+    top_projects = query_projects.with_entities(Project.name, Project.visit_count).order_by(
+        func.coalesce(Project.visit_count, 0).desc(), Project.id
+    ).limit(5).all()
     top_users = []
     if is_admin:
-        top_users_raw = db.query(User.username, User.login_count).order_by(User.login_count.desc()).limit(5).all()
-        top_users = [{"name": u[0], "logins": u[1]} for u in top_users_raw]
-        
+        top_users = [
+            {"name": username, "logins": logins or 0}
+            for username, logins in db.query(User.username, User.login_count).order_by(
+                func.coalesce(User.login_count, 0).desc(), User.id
+            ).limit(5)
+        ]
+
     db_size = "N/A"
     try:
-        from database import settings
-        size_query = db.execute(text(f"SELECT pg_size_pretty(pg_database_size('{settings.POSTGRES_DB}'))"))
-        db_size = size_query.scalar() or "N/A"
-    except:
-        pass
+        db_size = db.execute(text("SELECT pg_size_pretty(pg_database_size(current_database()))")).scalar() or "N/A"
+    except Exception:
+        db.rollback()
 
     return {
-        "users": user_count,
-        "projects": project_count,
-        "layers": layer_count,
+        "users": db.query(User).count() if is_admin else 1,
+        "projects": query_projects.count(),
+        "layers": query_layers.count(),
         "db_size": db_size,
-        "top_projects": [{"name": p.name, "visits": p.visit_count or 0} for p in top_projects],
-        "top_users": top_users
+        "top_projects": [{"name": name, "visits": visits or 0} for name, visits in top_projects],
+        "top_users": top_users,
     }
 
 # --- MEASUREMENT CRUD ---
@@ -332,33 +564,102 @@ def create_measurement(db: Session, measurement: MeasurementCreate):
         logger.error(f"Error al crear medida: {e}")
         raise e
 
+# Columnas escalares de Measurement (todas menos la geometría, que se serializa en PostGIS)
+_COLUMNAS_MEDICION = [c for c in Measurement.__table__.columns if c.name != "geometry"]
+
+def _select_mediciones():
+    """SELECT de columnas con la geometría ya convertida a GeoJSON (sin hidratar el ORM)."""
+    return select(
+        *_COLUMNAS_MEDICION,
+        cast(func.ST_AsGeoJSON(Measurement.geometry), JSON).label("geometry")
+    )
+
 def get_measurement(db: Session, measurement_id: int):
     # Usamos ST_AsGeoJSON para devolver la geometría en formato legible por el frontend
-    result = db.query(
-        Measurement,
-        func.ST_AsGeoJSON(Measurement.geometry).label("geometry_geojson")
-    ).filter(Measurement.id == measurement_id).first()
-    
-    if result:
-        measurement, geojson = result
-        # Convertir el string de GeoJSON a dict
-        measurement_dict = {c.name: getattr(measurement, c.name) for c in measurement.__table__.columns}
-        measurement_dict["geometry"] = json.loads(geojson)
-        return measurement_dict
-    return None
+    row = db.execute(_select_mediciones().where(Measurement.id == measurement_id)).first()
+    return dict(row._mapping) if row else None
 
 def get_measurements_by_project(db: Session, project_id: int):
-    results = db.query(
-        Measurement,
-        func.ST_AsGeoJSON(Measurement.geometry).label("geometry_geojson")
-    ).filter(Measurement.project_id == project_id).order_by(Measurement.created_at.desc()).all()
+    rows = db.execute(
+        _select_mediciones()
+        .where(Measurement.project_id == project_id)
+        .order_by(Measurement.created_at.desc())
+    )
+    return [dict(row._mapping) for row in rows]
+
+def parse_bbox(bbox: Optional[str]) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Convierte 'minx,miny,maxx,maxy' (EPSG:4326) en tupla. Lanza ValueError si es inválido
+    o si sale de [-180,180]×[-90,90].
+    """
+    if not bbox:
+        return None
+    valores = [float(v) for v in bbox.split(",")]
+    if len(valores) != 4 or not all(math.isfinite(v) for v in valores):
+        raise ValueError("bbox debe ser minx,miny,maxx,maxy")
+    minx, miny, maxx, maxy = valores
+    if not (-180 <= minx <= maxx <= 180 and -90 <= miny <= maxy <= 90):
+        raise ValueError("bbox debe ser minx,miny,maxx,maxy")
+    return tuple(valores)
+
+def tolerancia_por_zoom(zoom: int) -> float:
+    """Medio píxel de un tile de 256 px en grados a ese zoom (tolerancia de simplificación)."""
+    return 360.0 / (256 * 2 ** zoom) / 2
+
+def get_measurements_geojson(
+    db: Session,
+    project_id: int,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    zoom: Optional[int] = None,
+    measurement_ids: Optional[List[int]] = None
+) -> str:
+    """
+    FeatureCollection de las medidas de un proyecto construida por PostGIS.
     
-    measurements = []
-    for measurement, geojson in results:
-        m_dict = {c.name: getattr(measurement, c.name) for c in measurement.__table__.columns}
-        m_dict["geometry"] = json.loads(geojson)
-        measurements.append(m_dict)
-    return measurements
+    json_agg/json_build_object arman el documento completo en la base de datos
+    y se devuelve como texto, listo para enviarse sin pasar por objetos Python.
+    
+    Args:
+        bbox: (minx, miny, maxx, maxy) en EPSG:4326; solo medidas que lo intersecten (índice GiST)
+        zoom: simplifica las geometrías a medio píxel de ese zoom y recorta decimales
+    """
+    geom = Measurement.geometry
+    decimales = 9
+    if zoom is not None:
+        tolerancia = tolerancia_por_zoom(zoom)
+        geom = func.ST_SimplifyPreserveTopology(geom, tolerancia)
+        # Un decimal más que la tolerancia basta para no perder forma visible
+        decimales = max(1, min(9, math.ceil(math.log10(1 / tolerancia)) + 1))
+
+    propiedades = func.json_build_object(*[
+        arg for c in _COLUMNAS_MEDICION for arg in (c.name, c)
+    ])
+    feature = func.json_build_object(
+        "type", "Feature",
+        "id", Measurement.id,
+        "geometry", cast(func.ST_AsGeoJSON(geom, decimales), JSON),
+        "properties", propiedades,
+    )
+    features = (
+        select(feature.label("feature"), Measurement.created_at, Measurement.id)
+        .where(Measurement.project_id == project_id)
+    )
+    if bbox:
+        features = features.where(Measurement.geometry.op("&&")(func.ST_MakeEnvelope(*bbox, 4326)))
+    if measurement_ids:
+        features = features.where(Measurement.id.in_(measurement_ids))
+    features = features.subquery()
+
+    coleccion = func.json_build_object(
+        "type", "FeatureCollection",
+        "features", func.coalesce(
+            func.json_agg(aggregate_order_by(
+                features.c.feature, features.c.created_at.desc(), features.c.id
+            )),
+            _JSON_VACIO,
+        ),
+    )
+    return db.execute(select(cast(coleccion, Text))).scalar_one()
 
 def update_measurement(db: Session, measurement_id: int, measurement_update: MeasurementUpdate):
     db_measurement = db.query(Measurement).filter(Measurement.id == measurement_id).first()
@@ -257,14 +257,24 @@ class FileProcessor:
             ext = Path(file_path).suffix.lower()
             
             if ext == '.dxf':
-                doc = ezdxf.readfile(file_path)
+                from ezdxf.addons import iterdxf
                 
-                info = {
-                    'format': 'dxf',
-                    'version': doc.dxfversion,
-                    'layer_count': len(doc.layers),
-                    'entity_count': sum(1 for _ in doc.modelspace()),
-                }
+                # Solo se indexa el archivo: cargar un DXF de cientos de MB con
+                # readfile bloqueaba la subida. Las entidades se leen en
+                # segundo plano al generar los vector tiles.
+                try:
+                    doc = iterdxf.opendxf(file_path)
+                    info = {'format': 'dxf', 'version': doc.dxfversion}
+                    doc.close()
+                except (ezdxf.DXFStructureError, UnicodeDecodeError):
+                    # DXF binario: iterdxf no lo soporta
+                    doc = ezdxf.readfile(file_path)
+                    info = {
+                        'format': 'dxf',
+                        'version': doc.dxfversion,
+                        'layer_count': len(doc.layers),
+                        'entity_count': sum(1 for _ in doc.modelspace()),
+                    }
                 
                 return info
             else:
@@ -0,0 +1,233 @@
+"""
+Caché de geocercas compiladas a nivel de proceso.
+
+Parsear un KML/KMZ con fastkml en cada reporte es costoso. Este módulo
+compila cada archivo una sola vez a una geometría shapely (todos los
+polígonos, multipolígonos y huecos unidos con unary_union, luego preparada
+para consultas punto-en-polígono) y la guarda:
+
+1. En memoria del proceso (LRU), clave = ruta absoluta + mtime + tamaño.
+2. En disco como WKB (diskcache), para que los workers de gunicorn arranquen
+   en caliente sin volver a parsear.
+
+Si el archivo cambia (mtime/tamaño), la clave cambia y se vuelve a compilar.
+"""
+
+import os
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+from zipfile import ZipFile
+
+import shapely
+from shapely import wkb
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
+from diskcache import Cache
+
+from shared import geofence_disk_cache
+
+logger = logging.getLogger(__name__)
+
+# Los archivos sin polígonos se guardan con este marcador para no re-parsearlos
+_SIN_GEOMETRIA = b""
+
+
+def leer_contenido_kml(path: str) -> Optional[bytes]:
+    """Lee el KML (o el primer KML dentro de un KMZ, preferiblemente doc.kml)."""
+    if path.lower().endswith('.kmz'):
+        with ZipFile(path, 'r') as z:
+            kml_files = [f for f in z.namelist() if f.lower().endswith('.kml')]
+            if not kml_files:
+                return None
+            nombre = next((f for f in kml_files if f.lower() == 'doc.kml'), kml_files[0])
+            return z.read(nombre)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def iterar_placemarks_kml(content: bytes) -> Iterator[Tuple[object, BaseGeometry]]:
+    """
+    Recorre recursivamente Documents/Folders y entrega (placemark, geometría shapely).
+
+    Las geometrías de fastkml (pygeoif) se convierten vía __geo_interface__.
+    """
+    from fastkml import kml
+
+    k = kml.KML()
+    k.from_string(content)
+
+    pendientes = list(k.features())
+    while pendientes:
+        feature = pendientes.pop(0)
+        if hasattr(feature, 'features'):
+            pendientes[0:0] = list(feature.features())
+            continue
+        geometria = getattr(feature, 'geometry', None)
+        if geometria is None:
+            continue
+        try:
+            yield feature, shape(geometria.__geo_interface__)
+        except Exception as e:
+            logger.debug(f"Geometría KML no convertible en '{getattr(feature, 'name', '')}': {e}")
+
+
+def _partes_poligonales(geom: BaseGeometry) -> List[BaseGeometry]:
+    """Extrae Polygon/MultiPolygon (incluso dentro de GeometryCollection)."""
+    if geom is None or geom.is_empty:
+        return []
+    if geom.geom_type in ('Polygon', 'MultiPolygon'):
+        return [geom]
+    if hasattr(geom, 'geoms'):
+        partes = []
+        for g in geom.geoms:
+            partes.extend(_partes_poligonales(g))
+        return partes
+    return []
+
+
+def compilar_geocerca(path: str) -> Optional[BaseGeometry]:
+    """
+    Parsea un KML/KMZ y devuelve la unión de todas sus áreas (con huecos).
+
+    Returns:
+        Polygon/MultiPolygon en 2D, o None si el archivo no tiene polígonos
+    """
+    content = leer_contenido_kml(path)
+    if not content:
+        return None
+
+    poligonos = []
+    for _, geom in iterar_placemarks_kml(content):
+        for parte in _partes_poligonales(geom):
+            parte = shapely.force_2d(parte)
+            if not parte.is_valid:
+                parte = shapely.make_valid(parte)
+            poligonos.extend(_partes_poligonales(parte))
+
+    if not poligonos:
+        return None
+    return shapely.unary_union(poligonos)
+
+
+class GeofenceCache:
+    """Caché de geocercas compiladas (memoria LRU + WKB en disco) con métricas."""
+
+    def __init__(self, disk_cache: Optional[Cache], max_items: int = 256):
+        self._disk = disk_cache
+        self._memoria: "OrderedDict[str, Optional[BaseGeometry]]" = OrderedDict()
+        self._max_items = max_items
+        self._lock = Lock()
+        self._metricas = {
+            "hits_memoria": 0,
+            "hits_disco": 0,
+            "parseos": 0,
+            "errores": 0,
+            "tiempo_parseo_ms": 0.0,
+            "tiempo_disco_ms": 0.0,
+            "tiempo_memoria_ms": 0.0,
+        }
+
+    @staticmethod
+    def clave(path: str) -> Optional[str]:
+        """Clave de versión del archivo: ruta absoluta + mtime + tamaño."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}"
+
+    def _registrar(self, metrica: str, tiempo_metrica: str, inicio: float):
+        with self._lock:
+            self._metricas[metrica] += 1
+            self._metricas[tiempo_metrica] += (time.perf_counter() - inicio) * 1000
+
+    def _guardar_memoria(self, clave: str, geom: Optional[BaseGeometry]):
+        with self._lock:
+            self._memoria[clave] = geom
+            self._memoria.move_to_end(clave)
+            while len(self._memoria) > self._max_items:
+                self._memoria.popitem(last=False)
+
+    def obtener(self, path: str) -> Optional[BaseGeometry]:
+        """
+        Devuelve la geocerca preparada del archivo, compilándola solo si cambió.
+
+        Args:
+            path: Ruta al archivo KML/KMZ
+
+        Returns:
+            Geometría preparada (Polygon/MultiPolygon) o None
+        """
+        inicio = time.perf_counter()
+        clave = self.clave(path)
+        if clave is None:
+            logger.debug(f"Archivo no encontrado: {path}")
+            return None
+
+        # 1. Memoria del proceso
+        with self._lock:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                geom = self._memoria[clave]
+                encontrado = True
+            else:
+                encontrado = False
+        if encontrado:
+            self._registrar("hits_memoria", "tiempo_memoria_ms", inicio)
+            return geom
+
+        # 2. WKB en disco (compartido entre workers)
+        if self._disk is not None:
+            datos = self._disk.get(clave)
+            if datos is not None:
+                geom = wkb.loads(datos) if datos != _SIN_GEOMETRIA else None
+                if geom is not None:
+                    shapely.prepare(geom)
+                self._guardar_memoria(clave, geom)
+                self._registrar("hits_disco", "tiempo_disco_ms", inicio)
+                return geom
+
+        # 3. Parseo completo
+        try:
+            geom = compilar_geocerca(path)
+        except Exception as e:
+            with self._lock:
+                self._metricas["errores"] += 1
+            logger.error(f"Error cargando geocerca {path}: {str(e)}", exc_info=True)
+            return None
+
+        if geom is not None:
+            shapely.prepare(geom)
+        if self._disk is not None:
+            self._disk.set(clave, wkb.dumps(geom) if geom is not None else _SIN_GEOMETRIA, expire=86400 * 30)
+        self._guardar_memoria(clave, geom)
+        self._registrar("parseos", "tiempo_parseo_ms", inicio)
+        logger.info(
+            f"Geocerca compilada: {os.path.basename(path)} "
+            f"({geom.geom_type if geom is not None else 'sin polígonos'}) "
+            f"en {(time.perf_counter() - inicio) * 1000:.1f} ms"
+        )
+        return geom
+
+    def metricas(self) -> Dict[str, float]:
+        """Contadores y tiempos promedio de parseo vs. aciertos de caché."""
+        with self._lock:
+            m = dict(self._metricas)
+            m["entradas_memoria"] = len(self._memoria)
+        for tipo, tiempo in (("parseos", "tiempo_parseo_ms"), ("hits_disco", "tiempo_disco_ms"),
+                             ("hits_memoria", "tiempo_memoria_ms")):
+            m[f"promedio_{tiempo}"] = round(m[tiempo] / m[tipo], 3) if m[tipo] else None
+            m[tiempo] = round(m[tiempo], 3)
+        return m
+
+    def limpiar(self):
+        """Vacía la memoria del proceso (el WKB en disco se conserva)."""
+        with self._lock:
+            self._memoria.clear()
+
+
+# Singleton a nivel de proceso
+geofence_cache = GeofenceCache(geofence_disk_cache)
@@ -0,0 +1,126 @@
+"""
+Índice espacial de geocercas para clasificar registros de varios proyectos.
+
+En lugar de consultar el polígono de cada proyecto registro por registro
+(obtener_poligono_trabajo(pid) dentro del bucle), todas las geocercas de los
+proyectos del reporte se descomponen en polígonos simples y se indexan en un
+único STRtree. Cada polígono lleva como atributos el proyecto al que
+pertenece y su tipo (obra/oficina), de modo que la clasificación de todos los
+puntos es una sola consulta vectorizada `query(..., predicate="intersects")`
+seguida de un filtro por proyecto con NumPy.
+"""
+
+import logging
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import shapely
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+
+logger = logging.getLogger(__name__)
+
+EN_OBRA = "EN OBRA"
+EN_OFICINA = "EN OFICINA"
+UBICACION_EXTERNA = "UBICACIÓN EXTERNA"
+
+TIPO_OBRA = 0
+TIPO_OFICINA = 1
+
+# Código de proyecto para geocercas que aplican a todos los puntos
+# (polígonos explícitos pasados al reporte)
+_TODOS = -1
+
+
+class GeofenceIndex:
+    """STRtree sobre las geocercas de obra/oficina de varios proyectos."""
+
+    def __init__(self):
+        self._codigos: Dict[str, int] = {}
+        self._partes: List[BaseGeometry] = []
+        self._proyecto: List[int] = []
+        self._tipo: List[int] = []
+        self._arbol: Optional[STRtree] = None
+
+    def __len__(self) -> int:
+        return len(self._partes)
+
+    def _codigo(self, pid: Optional[str]) -> int:
+        if pid is None:
+            return _TODOS
+        return self._codigos.setdefault(str(pid), len(self._codigos))
+
+    def agregar(self, pid: Optional[str], tipo: int, geometria: Optional[BaseGeometry]):
+        """
+        Agrega una geocerca al índice.
+
+        Args:
+            pid: ID del proyecto (Mongo); None para que aplique a todos los puntos
+            tipo: TIPO_OBRA o TIPO_OFICINA
+            geometria: Polygon/MultiPolygon (se descompone en partes simples)
+        """
+        if geometria is None or geometria.is_empty:
+            return
+        codigo = self._codigo(pid)
+        # Partes simples: cajas más ajustadas en el árbol que un MultiPolygon completo
+        for parte in shapely.get_parts(geometria):
+            self._partes.append(parte)
+            self._proyecto.append(codigo)
+            self._tipo.append(tipo)
+        self._arbol = None
+
+    def construir(self) -> "GeofenceIndex":
+        """Construye el STRtree (se llama automáticamente al clasificar)."""
+        self._arbol = STRtree(self._partes)
+        self._proyecto_arr = np.asarray(self._proyecto, dtype=np.int64)
+        self._tipo_arr = np.asarray(self._tipo, dtype=np.int8)
+        logger.debug(f"Índice de geocercas: {len(self._partes)} polígonos, {len(self._codigos)} proyectos")
+        return self
+
+    def clasificar(
+        self,
+        pids: Sequence[str],
+        lons: Iterable[float],
+        lats: Iterable[float]
+    ) -> np.ndarray:
+        """
+        Clasifica todos los puntos en una sola pasada.
+
+        Un punto está EN OBRA si intersecta (incluye el borde) una geocerca de
+        obra de su proyecto; si no, EN OFICINA si intersecta una de oficina;
+        en otro caso UBICACIÓN EXTERNA.
+
+        Args:
+            pids: Proyecto de cada punto
+            lons: Longitudes WGS84
+            lats: Latitudes WGS84
+
+        Returns:
+            Arreglo de strings (object) con la clasificación de cada punto
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        resultado = np.full(len(lons), UBICACION_EXTERNA, dtype=object)
+        if not len(lons) or not self._partes:
+            return resultado
+
+        if self._arbol is None:
+            self.construir()
+
+        # Proyecto de cada punto como entero (-2 si el proyecto no tiene geocercas)
+        codigos_punto = np.fromiter(
+            (self._codigos.get(str(pid), -2) for pid in pids), dtype=np.int64, count=len(lons)
+        )
+
+        puntos = shapely.points(lons, lats)
+        idx_punto, idx_parte = self._arbol.query(puntos, predicate="intersects")
+
+        proyecto_parte = self._proyecto_arr[idx_parte]
+        validos = (proyecto_parte == codigos_punto[idx_punto]) | (proyecto_parte == _TODOS)
+        idx_punto = idx_punto[validos]
+        tipos = self._tipo_arr[idx_parte[validos]]
+
+        # Oficina primero; obra sobrescribe porque tiene prioridad
+        resultado[idx_punto[tipos == TIPO_OFICINA]] = EN_OFICINA
+        resultado[idx_punto[tipos == TIPO_OBRA]] = EN_OBRA
+        return resultado
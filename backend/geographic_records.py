@@ -5,19 +5,37 @@ Integra datos con análisis de ubicación usando geocercas en formato KML/KMZ.
 
 import os
 import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Optional, Dict, Any
+from typing import Callable, List, Optional, Dict, Any, Iterable, Tuple
 from pathlib import Path
-from zipfile import ZipFile
-from fastkml import kml
 from shapely.geometry import Point, Polygon, MultiPolygon, shape
 from shapely.geometry.base import BaseGeometry
 from sshtunnel import SSHTunnelForwarder
 from pymongo import MongoClient
+from geofence_cache import geofence_cache
+from geofence_index import GeofenceIndex, TIPO_OBRA, TIPO_OFICINA
+from report_export import EscritorExcelStreaming, EscritorKMLStreaming, iterar_lotes
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Campos leídos de MongoDB para la sincronización con PostgreSQL
+PROYECCION_PROYECTOS = {"name": 1, "description": 1, "owner": 1, "users": 1}
+PROYECCION_USUARIOS = {"email": 1, "displayName": 1, "organizations": 1, "projects": 1}
+
+
+def normalizar_proyecto_mongodb(p: Dict[str, Any]) -> Dict[str, Any]:
+    p["_id"] = str(p["_id"])
+    return p
+
+
+def normalizar_usuario_mongodb(u: Dict[str, Any]) -> Dict[str, Any]:
+    u["_id"] = str(u["_id"])
+    if "projects" in u and isinstance(u["projects"], list):
+        u["projects"] = [str(pid) for pid in u["projects"]]
+    return u
+
 
 class GeographicRecordsAnalyzer:
     """Analizador de registros geográficos con autenticación SSH y MongoDB."""
@@ -52,7 +70,8 @@ class GeographicRecordsAnalyzer:
         self.db_name = db_name
         self.kml_base_path = kml_base_path
         
-        # Cachés para evitar cargar polígonos múltiples veces
+        # Cachés por proyecto (pid -> geometría); la compilación de los archivos
+        # se comparte entre instancias mediante geofence_cache
         self.cache_obra: Dict[str, Optional[Polygon]] = {}
         self.cache_oficina: Dict[str, Optional[Polygon]] = {}
     
@@ -60,47 +79,17 @@ class GeographicRecordsAnalyzer:
         """
         Carga y combina todos los polígonos desde un archivo KML o KMZ.
         
+        Usa la caché de geocercas del proceso (geofence_cache): el archivo solo
+        se parsea cuando cambia su versión (mtime/tamaño); el resultado incluye
+        todos los polígonos y multipolígonos (con huecos) unidos y preparados.
+        
         Args:
             path: Ruta al archivo KML/KMZ
             
         Returns:
             shapely geometry (Polygon, MultiPolygon or any result of unary_union)
         """
-        if not os.path.exists(path):
-            logger.debug(f"Archivo no encontrado: {path}")
-            return None
-        
-        try:
-            if path.lower().endswith('.kmz'):
-                with ZipFile(path, 'r') as z:
-                    kml_files = [f for f in z.namelist() if f.lower().endswith('.kml')]
-                    if not kml_files: return None
-                    content = z.read(kml_files[0])
-            else:
-                with open(path, 'rb') as f:
-                    content = f.read()
-            
-            k = kml.KML()
-            k.from_string(content)
-            
-            features = list(k.features())
-            if not features: return None
-            placemarks = list(features[0].features())
-            for p in placemarks:
-                if hasattr(p, 'geometry') and hasattr(p.geometry, 'exterior'):
-                    return Polygon(p.geometry.exterior.coords)
-                elif hasattr(p, 'features'):
-                    for sub_p in p.features():
-                        if hasattr(sub_p.geometry, 'exterior'):
-                            return Polygon(sub_p.geometry.exterior.coords)
-            
-            return None
-        
-        except Exception as e:
-            logger.error(f"Error avanzado cargando geocerca {path}: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return None
+        return geofence_cache.obtener(path)
     
     def obtener_poligono_trabajo(self, pid: str) -> Optional[Polygon]:
         """
@@ -160,16 +149,55 @@ class GeographicRecordsAnalyzer:
         
         # 1. Verificar polígono de obra (Prioridad: override -> file)
         p_obra = p_obra_override or self.obtener_poligono_trabajo(pid)
-        if p_obra and (p_obra.contains(punto) or p_obra.intersects(punto)):
+        # intersects incluye el borde; con la geometría preparada es una sola consulta
+        if p_obra and p_obra.intersects(punto):
             return "EN OBRA"
         
         # 2. Verificar polígono de oficina (Prioridad: override -> file)
         p_ofi = p_ofi_override or self.obtener_poligono_oficina(pid)
-        if p_ofi and (p_ofi.contains(punto) or p_ofi.intersects(punto)):
+        if p_ofi and p_ofi.intersects(punto):
             return "EN OFICINA"
         
         return "UBICACIÓN EXTERNA"
     
+    def construir_indice_geocercas(
+        self,
+        pids: Iterable[str],
+        geocercas_proyectos: Optional[Dict[str, Tuple[Optional[BaseGeometry], Optional[BaseGeometry]]]] = None,
+        p_obra_override: Optional[BaseGeometry] = None,
+        p_ofi_override: Optional[BaseGeometry] = None
+    ) -> GeofenceIndex:
+        """
+        Construye un índice espacial con las geocercas de todos los proyectos.
+        
+        Prioridad por tipo (igual que clasificar_ubicacion): polígono explícito
+        -> geocercas de capas del proyecto -> archivo {pid}.kml / {pid}_oficina.kml.
+        
+        Args:
+            pids: Proyectos presentes en el reporte
+            geocercas_proyectos: pid -> (obra, oficina) cargadas desde capas
+            p_obra_override: Polígono de obra aplicado a todos los proyectos
+            p_ofi_override: Polígono de oficina aplicado a todos los proyectos
+            
+        Returns:
+            GeofenceIndex listo para clasificar
+        """
+        geocercas_proyectos = geocercas_proyectos or {}
+        indice = GeofenceIndex()
+        
+        # Los polígonos explícitos aplican a todos los puntos (pid=None)
+        indice.agregar(None, TIPO_OBRA, p_obra_override)
+        indice.agregar(None, TIPO_OFICINA, p_ofi_override)
+        
+        for pid in set(pids):
+            capa_obra, capa_ofi = geocercas_proyectos.get(pid, (None, None))
+            if p_obra_override is None:
+                indice.agregar(pid, TIPO_OBRA, capa_obra or self.obtener_poligono_trabajo(pid))
+            if p_ofi_override is None:
+                indice.agregar(pid, TIPO_OFICINA, capa_ofi or self.obtener_poligono_oficina(pid))
+        
+        return indice.construir()
+    
     def generar_reporte(
         self,
         fecha_inicio: datetime,
@@ -178,7 +206,10 @@ class GeographicRecordsAnalyzer:
         user_filtro: Optional[str] = None,
         nombre_proyecto_filtro: Optional[str] = None,
         p_obra_explicit: Optional[BaseGeometry] = None,
-        p_ofi_explicit: Optional[BaseGeometry] = None
+        p_ofi_explicit: Optional[BaseGeometry] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+        geocercas_proyectos: Optional[Dict[str, Tuple[Optional[BaseGeometry], Optional[BaseGeometry]]]] = None,
+        cargar_geocercas_proyectos: Optional[Callable[[List[str]], Dict[str, Tuple[Optional[BaseGeometry], Optional[BaseGeometry]]]]] = None
     ) -> pd.DataFrame:
         """
         Genera un reporte de registros geográficos con clasificación de ubicación.
@@ -189,6 +220,13 @@ class GeographicRecordsAnalyzer:
             pid_filtro: ID del proyecto (opcional, filtra a un solo proyecto)
             user_filtro: Email del usuario (opcional, filtra a un solo usuario)
             nombre_proyecto_filtro: Nombre del proyecto (opcional, filtra por nombre)
+            progress_callback: Función (procesados, total) invocada periódicamente
+                durante la clasificación; puede lanzar una excepción para cancelar
+            geocercas_proyectos: pid -> (obra, oficina) desde capas de PostgreSQL,
+                para reportes de varios proyectos
+            cargar_geocercas_proyectos: Alternativa perezosa a geocercas_proyectos;
+                se invoca con los pids presentes en los registros, así solo se
+                cargan las geocercas de proyectos que aparecen en el reporte
             
         Returns:
             DataFrame con los registros procesados
@@ -295,8 +333,15 @@ class GeographicRecordsAnalyzer:
                 records_data = list(db.records.aggregate(pipeline))
                 logger.info(f"📍 Procesando {len(records_data)} registros...")
                 
+                total_docs = len(records_data)
+                if progress_callback:
+                    progress_callback(0, total_docs)
+                
                 # Procesar cada registro
-                for doc in records_data:
+                for i, doc in enumerate(records_data):
+                    if progress_callback and i and i % 5000 == 0:
+                        progress_callback(i, total_docs)
+                    
                     pid = str(doc.get('pid'))
                     id_reg = str(doc.get('_id'))
                     coord_list = doc.get('coords', [])
@@ -313,9 +358,6 @@ class GeographicRecordsAnalyzer:
                         logger.debug(f"Registro {id_reg} con coordenadas inválidas, omitido")
                         continue
                     
-                    # Clasificar ubicación pasándole los polígonos explícitos si existen
-                    status = self.clasificar_ubicacion(pid, lat, lon, p_obra_explicit, p_ofi_explicit)
-                    
                     # Agregar al resultado
                     results.append({
                         "id": id_reg,
@@ -329,7 +371,7 @@ class GeographicRecordsAnalyzer:
                         "Norte (Lat)": lat,
                         "Este (Lon)": lon,
                         "Coordenadas_Google": f"{lat}, {lon}",
-                        "Clasificación": status,
+                        "Clasificación": None,
                         "URL Registro": f"https://segmab.com/i40/home#!/proyecto/{pid}/registro/{id_reg}"
                     })
                 
@@ -342,6 +384,20 @@ class GeographicRecordsAnalyzer:
         # Crear DataFrame
         if results:
             df = pd.DataFrame(results)
+            
+            pids = df["project_id"].unique()
+            if cargar_geocercas_proyectos is not None:
+                geocercas_proyectos = cargar_geocercas_proyectos(list(pids))
+            
+            # Clasificar todos los puntos en una sola pasada sobre el índice espacial
+            indice = self.construir_indice_geocercas(
+                pids, geocercas_proyectos, p_obra_explicit, p_ofi_explicit
+            )
+            df["Clasificación"] = indice.clasificar(
+                df["project_id"].to_numpy(),
+                pd.to_numeric(df["Este (Lon)"], errors="coerce").to_numpy(),
+                pd.to_numeric(df["Norte (Lat)"], errors="coerce").to_numpy()
+            )
             logger.info(f"✅ Reporte generado con {len(df)} registros")
             return df
         else:
@@ -356,6 +412,9 @@ class GeographicRecordsAnalyzer:
         """
         Exporta el DataFrame a un archivo Excel.
         
+        Usa un escritor write-only (memoria constante) que vuelca las filas
+        por lotes en lugar de construir el libro completo en memoria.
+        
         Args:
             df: DataFrame con los registros
             output_path: Ruta donde guardar el archivo
@@ -363,8 +422,10 @@ class GeographicRecordsAnalyzer:
         Returns:
             Ruta al archivo creado
         """
-        os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
-        df.to_excel(output_path, index=False, sheet_name='Registros')
+        escritor = EscritorExcelStreaming(output_path)
+        for lote in iterar_lotes(df):
+            escritor.agregar_lote(lote)
+        escritor.cerrar()
         logger.info(f"✅ Archivo Excel guardado: {output_path}")
         return output_path
     
@@ -372,6 +433,9 @@ class GeographicRecordsAnalyzer:
         """
         Exporta el DataFrame a un archivo KML con estilos de colores basados en la clasificación.
         
+        Los Placemark se escriben incrementalmente por lotes. Si la ruta
+        termina en .kmz el documento se comprime directamente en el ZIP.
+        
         Args:
             df: DataFrame con los registros
             output_path: Ruta donde guardar el archivo KML
@@ -379,85 +443,15 @@ class GeographicRecordsAnalyzer:
         Returns:
             Ruta al archivo KML creado
         """
-        import codecs
-        os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
-        
-        kml_content = [
-            '<?xml version="1.0" encoding="UTF-8"?>',
-            '<kml xmlns="http://www.opengis.net/kml/2.2">',
-            '  <Document>',
-            '    <name>Reporte de Registros SEGMAB</name>',
-            '    <Style id="style-obra">',
-            '      <IconStyle>',
-            '        <color>ff00ff00</color> <!-- Verde -->',
-            '        <scale>1.2</scale>',
-            '        <Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon>',
-            '      </IconStyle>',
-            '    </Style>',
-            '    <Style id="style-oficina">',
-            '      <IconStyle>',
-            '        <color>ff00ffff</color> <!-- Amarillo -->',
-            '        <scale>1.2</scale>',
-            '        <Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon>',
-            '      </IconStyle>',
-            '    </Style>',
-            '    <Style id="style-externa">',
-            '      <IconStyle>',
-            '        <color>ff0000ff</color> <!-- Rojo -->',
-            '        <scale>1.2</scale>',
-            '        <Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon>',
-            '      </IconStyle>',
-            '    </Style>'
-        ]
-        
-        for _, row in df.iterrows():
-            clasif = str(row.get('Clasificación', 'UBICACIÓN EXTERNA')).upper()
-            if 'OBRA' in clasif:
-                style_id = '#style-obra'
-            elif 'OFICINA' in clasif:
-                style_id = '#style-oficina'
-            else:
-                style_id = '#style-externa'
-                
-            lat = row.get('Norte (Lat)')
-            lon = row.get('Este (Lon)')
-            if pd.isna(lat) or pd.isna(lon):
-                continue
-                
-            name = f"{row.get('Fecha del registro', 'Sin fecha')} - {row.get('Colaborador', 'Desconocido')}"
-            desc = f"""<![CDATA[
-            <b>Proyecto:</b> {row.get('Proyecto', 'N/A')}<br>
-            <b>Colaborador:</b> {row.get('Colaborador', 'N/A')}<br>
-            <b>Cargo:</b> {row.get('Cargo', 'N/A')}<br>
-            <b>Correo:</b> {row.get('Correo', 'N/A')}<br>
-            <b>Fecha:</b> {row.get('Fecha del registro', 'N/A')}<br>
-            <b>Formato:</b> {row.get('Formato', 'N/A')}<br>
-            <b>Clasificación:</b> {clasif}<br>
-            <br>
-            <a href="{row.get('URL Registro', '#')}">Ver registro en SEGMAB</a>
-            ]]>"""
-            
-            kml_content.extend([
-                '    <Placemark>',
-                f'      <name><![CDATA[{name}]]></name>',
-                f'      <description>{desc}</description>',
-                f'      <styleUrl>{style_id}</styleUrl>',
-                '      <Point>',
-                f'        <coordinates>{lon},{lat},0</coordinates>',
-                '      </Point>',
-                '    </Placemark>'
-            ])
-            
-        kml_content.extend(['  </Document>', '</kml>'])
-        
-        with codecs.open(output_path, 'w', encoding='utf-8') as f:
-            f.write('\\n'.join(kml_content))
-            
+        escritor = EscritorKMLStreaming(output_path, kmz=output_path.lower().endswith('.kmz'))
+        for lote in iterar_lotes(df):
+            escritor.agregar_lote(lote)
+        escritor.cerrar()
         logger.info(f"✅ Archivo KML guardado: {output_path}")
         return output_path
     
     def limpiar_cache(self):
-        """Limpia los cachés de polígonos en memoria."""
+        """Limpia los cachés de polígonos por proyecto (las geocercas compiladas se conservan)."""
         self.cache_obra.clear()
         self.cache_oficina.clear()
         logger.info("Cache de geocercas limpiado")
@@ -479,9 +473,7 @@ class GeographicRecordsAnalyzer:
                 client = MongoClient('127.0.0.1', server.local_bind_port)
                 db = client[self.db_name]
                 
-                projects = list(db.projects.find({}, {"name": 1, "description": 1, "owner": 1, "users": 1}))
-                for p in projects:
-                    p["_id"] = str(p["_id"])
+                projects = [normalizar_proyecto_mongodb(p) for p in db.projects.find({}, PROYECCION_PROYECTOS)]
                 
                 client.close()
                 return projects
@@ -509,17 +501,7 @@ class GeographicRecordsAnalyzer:
                 db = client[self.db_name]
                 
                 # Obtener usuarios con sus campos básicos y lista de proyectos
-                users = list(db.users.find({}, {
-                    "email": 1, 
-                    "displayName": 1, 
-                    "organizations": 1,
-                    "projects": 1  
-                }))
-                
-                for u in users:
-                    u["_id"] = str(u["_id"])
-                    if "projects" in u and isinstance(u["projects"], list):
-                        u["projects"] = [str(pid) for pid in u["projects"]]
+                users = [normalizar_usuario_mongodb(u) for u in db.users.find({}, PROYECCION_USUARIOS)]
                 
                 client.close()
                 return users
@@ -527,6 +509,70 @@ class GeographicRecordsAnalyzer:
             logger.error(f"Error obteniendo usuarios de MongoDB: {str(e)}")
             return []
 
+    @contextmanager
+    def conexion_mongodb(self):
+        """Abre el túnel SSH y entrega la base de datos MongoDB (se cierra al salir)."""
+        with SSHTunnelForwarder(
+            (self.ssh_host, 22),
+            ssh_username=self.ssh_user,
+            ssh_pkey=self.ssh_key_path,
+            ssh_private_key_password=self.ssh_passphrase.encode() 
+                if isinstance(self.ssh_passphrase, str) else self.ssh_passphrase,
+            remote_bind_address=('127.0.0.1', self.mongo_port),
+            set_keepalive=30.0
+        ) as server:
+            client = MongoClient(
+                '127.0.0.1',
+                server.local_bind_port,
+                connectTimeoutMS=30000,
+                serverSelectionTimeoutMS=30000
+            )
+            try:
+                yield client[self.db_name]
+            finally:
+                client.close()
+
+    def obtener_documentos_modificados(
+        self,
+        coleccion: str,
+        campo: str,
+        desde: Any = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Obtiene los documentos de una colección posteriores a una marca de agua.
+        
+        Args:
+            coleccion: 'projects' o 'users'
+            campo: Campo ordenable usado como marca de agua ('_id' o una fecha de actualización)
+            desde: Último valor procesado (None = colección completa)
+            
+        Returns:
+            Documentos crudos ordenados por `campo` (sin normalizar, con el valor del campo)
+        """
+        proyeccion = dict(PROYECCION_PROYECTOS if coleccion == "projects" else PROYECCION_USUARIOS)
+        proyeccion[campo] = 1
+        # Una fecha puede repetirse entre documentos: con $gte se vuelve a leer
+        # el último procesado (la sincronización es idempotente) pero no se
+        # pierde uno guardado en el mismo milisegundo después de la lectura
+        operador = "$gt" if campo == "_id" else "$gte"
+        filtro = {campo: {operador: desde}} if desde is not None else {}
+        
+        with self.conexion_mongodb() as db:
+            return list(db[coleccion].find(filtro, proyeccion).sort(campo, 1))
+
+    def obtener_usuarios_por_email(self, emails: List[str]) -> List[Dict[str, Any]]:
+        """
+        Obtiene los perfiles de la colección users con los emails indicados.
+        
+        Args:
+            emails: Emails tal como aparecen en la membresía de los proyectos
+            
+        Returns:
+            Documentos crudos (sin normalizar)
+        """
+        with self.conexion_mongodb() as db:
+            return list(db.users.find({"email": {"$in": emails}}, PROYECCION_USUARIOS))
+
 
 def crear_analizador_desde_env(kml_base_path: str = "uploads") -> GeographicRecordsAnalyzer:
     """
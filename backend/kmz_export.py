@@ -0,0 +1,116 @@
+"""
+Exportación de medidas a KMZ en streaming.
+
+Antes se cargaban todas las medidas como objetos ORM, se pedía a PostGIS el
+GeoJSON de cada una por separado (una consulta por medida) y se armaba el
+documento completo con fastkml en memoria antes de comprimirlo.
+
+Aquí una sola consulta con ST_AsKML recorre las medidas con un cursor del
+servidor (yield_per) y cada Placemark se escribe directamente dentro del
+doc.kml de un ZIP que se va entregando al cliente por bloques. La memoria se
+mantiene constante sin importar cuántas medidas tenga el proyecto.
+"""
+
+import logging
+import zipfile
+from typing import Callable, Iterator, List, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from sqlalchemy import func, select
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# Filas por lote del cursor del servidor
+KMZ_FILAS_POR_LOTE = 1000
+# Tamaño aproximado de cada bloque enviado al cliente
+KMZ_TAMANO_BLOQUE = 64 * 1024
+
+_ENCABEZADO = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+    '<Document id="docid">\n'
+    '<name>{nombre}</name>\n'
+    '<description>Medidas del proyecto</description>\n'
+)
+_PLACEMARK = (
+    '<Placemark id={id}><name>{nombre}</name>'
+    '<description>Tipo: {tipo}</description>{geometria}</Placemark>\n'
+)
+_CIERRE = '</Document>\n</kml>\n'
+
+
+class _SalidaZip:
+    """
+    Destino sin seek para ZipFile: acumula los bytes comprimidos hasta que se
+    entregan. Al no poder retroceder, zipfile escribe los tamaños en un
+    descriptor de datos al final de cada entrada (formato válido para KMZ).
+    """
+
+    def __init__(self):
+        self._partes: List[bytes] = []
+        self.tamano = 0
+
+    def write(self, datos) -> int:
+        self._partes.append(bytes(datos))
+        self.tamano += len(datos)
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def extraer(self) -> bytes:
+        datos = b"".join(self._partes)
+        self._partes = []
+        self.tamano = 0
+        return datos
+
+
+def consulta_placemarks(project_id: int, measurement_ids: Optional[List[int]] = None):
+    """id, nombre, tipo y geometría KML de las medidas, en una sola consulta."""
+    m = models.Measurement
+    consulta = (
+        select(m.id, m.name, m.measurement_type, func.ST_AsKML(m.geometry).label("kml"))
+        .where(m.project_id == project_id)
+        .order_by(m.id)
+    )
+    if measurement_ids:
+        consulta = consulta.where(m.id.in_(measurement_ids))
+    return consulta.execution_options(yield_per=KMZ_FILAS_POR_LOTE)
+
+
+def generar_kmz(
+    session_factory: Callable,
+    project_id: int,
+    project_name: str,
+    measurement_ids: Optional[List[int]] = None
+) -> Iterator[bytes]:
+    """
+    Generador de bloques del KMZ (ZIP con un doc.kml).
+
+    Usa su propia sesión: StreamingResponse consume el generador después de
+    que la sesión de la solicitud ya se cerró.
+    """
+    salida = _SalidaZip()
+    db = session_factory()
+    total = 0
+    try:
+        with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as zf:
+            with zf.open("doc.kml", "w") as doc:
+                doc.write(_ENCABEZADO.format(nombre=escape(project_name or "")).encode("utf-8"))
+                for fila in db.execute(consulta_placemarks(project_id, measurement_ids)):
+                    doc.write(_PLACEMARK.format(
+                        id=quoteattr(str(fila.id)),
+                        nombre=escape(fila.name or ""),
+                        tipo=escape(fila.measurement_type or ""),
+                        geometria=fila.kml or "",
+                    ).encode("utf-8"))
+                    total += 1
+                    if salida.tamano >= KMZ_TAMANO_BLOQUE:
+                        yield salida.extraer()
+                doc.write(_CIERRE.encode("utf-8"))
+        yield salida.extraer()
+        logger.info(f"📦 KMZ del proyecto {project_id}: {total} medidas exportadas")
+    finally:
+        db.close()
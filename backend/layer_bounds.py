@@ -0,0 +1,193 @@
+"""
+Extensión geográfica (Layer.bounds) de las capas.
+
+La columna bounds (POLYGON EPSG:4326, índice GiST) existía pero nunca se
+llenaba, así que no se podía consultar qué capas caen en la vista actual.
+Aquí se calcula para cada tipo de capa:
+
+- raster / vector: bounds_wgs84 que FileProcessor ya guarda en settings.
+- nube de puntos: bounds del encabezado LAS, reproyectados desde su CRS.
+- KML/KMZ, SHP, DXF con vector tiles: ST_Extent de sus vector_features.
+- KML/KMZ sin ingerir: extensión de sus placemarks.
+- modelos 3D: solo si settings trae bounds_wgs84 (OBJ/GLB no están georreferenciados).
+
+rellenar_bounds() es el trabajo de backfill para las capas existentes
+(python layer_bounds.py o POST /layers/bounds/backfill).
+"""
+
+import os
+import logging
+from typing import Callable, Optional, Tuple
+
+from sqlalchemy import func, select, text, update
+from sqlalchemy.orm import Session
+
+import models
+
+logger = logging.getLogger(__name__)
+
+Bounds = Tuple[float, float, float, float]
+
+# Capas por lote del backfill (un commit por lote)
+BACKFILL_LOTE = 200
+
+
+def _bounds_validos(minx, miny, maxx, maxy) -> Optional[Bounds]:
+    try:
+        bounds = tuple(float(v) for v in (minx, miny, maxx, maxy))
+    except (TypeError, ValueError):
+        return None
+    minx, miny, maxx, maxy = bounds
+    if not (-180 <= minx <= maxx <= 180 and -90 <= miny <= maxy <= 90):
+        return None
+    return bounds
+
+
+def _bounds_dict(datos) -> Optional[Bounds]:
+    if not isinstance(datos, dict):
+        return None
+    return _bounds_validos(datos.get("minx"), datos.get("miny"), datos.get("maxx"), datos.get("maxy"))
+
+
+def _bounds_nube_puntos(settings: dict) -> Optional[Bounds]:
+    """Encabezado LAS (en su CRS) reproyectado a EPSG:4326."""
+    bounds = settings.get("bounds")
+    if not isinstance(bounds, dict):
+        return None
+    crs = settings.get("crs")
+    if not crs or crs == "None":
+        # Sin CRS: solo se acepta si ya son coordenadas geográficas
+        return _bounds_dict(bounds)
+    try:
+        from pyproj import CRS, Transformer
+        transformador = Transformer.from_crs(CRS.from_user_input(crs), CRS.from_epsg(4326), always_xy=True)
+        return _bounds_validos(*transformador.transform_bounds(
+            bounds["minx"], bounds["miny"], bounds["maxx"], bounds["maxy"]
+        ))
+    except Exception as e:
+        logger.debug(f"No se pudo reproyectar bounds de nube de puntos ({crs}): {e}")
+        return None
+
+
+def _bounds_kml(path: str) -> Optional[Bounds]:
+    from geofence_cache import leer_contenido_kml, iterar_placemarks_kml
+    import shapely
+
+    if not path or not os.path.exists(path):
+        return None
+    contenido = leer_contenido_kml(path)
+    if not contenido:
+        return None
+    geometrias = [geometria for _, geometria in iterar_placemarks_kml(contenido)]
+    if not geometrias:
+        return None
+    return _bounds_validos(*shapely.total_bounds(geometrias))
+
+
+def bounds_desde_metadatos(layer_type: str, settings: Optional[dict], file_path: Optional[str] = None) -> Optional[Bounds]:
+    """Extensión en EPSG:4326 a partir de los metadatos guardados al subir la capa."""
+    settings = settings or {}
+    bounds = _bounds_dict(settings.get("bounds_wgs84"))
+    if bounds:
+        return bounds
+    if layer_type == "point_cloud":
+        return _bounds_nube_puntos(settings)
+    if layer_type == "kml":
+        return _bounds_kml(file_path)
+    return None
+
+
+def envolvente(bounds: Optional[Bounds]):
+    """Expresión SQL del polígono de la extensión (o None)."""
+    if bounds is None:
+        return None
+    return func.ST_MakeEnvelope(*bounds, 4326)
+
+
+def _extension_4326(geom_3857):
+    """
+    ST_Extent (EPSG:3857) como polígono EPSG:4326. ST_MakeEnvelope siempre da
+    POLYGON, incluso si la capa es un único punto (ST_Envelope daría POINT).
+    """
+    extension = func.ST_Extent(geom_3857)
+    return func.ST_Transform(func.ST_MakeEnvelope(
+        func.ST_XMin(extension), func.ST_YMin(extension),
+        func.ST_XMax(extension), func.ST_YMax(extension), 3857
+    ), 4326)
+
+
+def extension_vector_features(layer_id: int):
+    """Extensión de los elementos de una capa (subconsulta escalar)."""
+    f = models.VectorFeature
+    return select(_extension_4326(f.geom)).where(f.layer_id == layer_id).scalar_subquery()
+
+
+def rellenar_bounds(session_factory: Callable[[], Session], solo_vacios: bool = True) -> dict:
+    """
+    Backfill de Layer.bounds para capas existentes.
+
+    1. Capas con vector tiles: un único UPDATE desde ST_Extent(vector_features).
+    2. El resto: bounds calculados desde settings/archivo, por lotes.
+    """
+    resumen = {"vector_tiles": 0, "metadatos": 0, "sin_extension": 0}
+    db = session_factory()
+    try:
+        # El índice GiST ya lo crea create_all en tablas nuevas; en bases antiguas puede faltar
+        db.execute(text("CREATE INDEX IF NOT EXISTS idx_layers_bounds ON layers USING gist (bounds)"))
+        db.commit()
+
+        L = models.Layer
+        f = models.VectorFeature
+        extension = (
+            select(f.layer_id, _extension_4326(f.geom).label("bounds"))
+            .group_by(f.layer_id)
+            .subquery()
+        )
+        consulta = update(L).where(L.id == extension.c.layer_id).values(bounds=extension.c.bounds)
+        if solo_vacios:
+            consulta = consulta.where(L.bounds.is_(None))
+        resumen["vector_tiles"] = db.execute(consulta).rowcount
+        db.commit()
+
+        ultimo_id = 0
+        while True:
+            filtro = [L.id > ultimo_id]
+            if solo_vacios:
+                filtro.append(L.bounds.is_(None))
+            capas = db.execute(
+                select(L.id, L.layer_type, L.settings, L.file_path)
+                .where(*filtro).order_by(L.id).limit(BACKFILL_LOTE)
+            ).all()
+            if not capas:
+                break
+            for capa in capas:
+                bounds = bounds_desde_metadatos(capa.layer_type, capa.settings, capa.file_path)
+                if bounds is None:
+                    resumen["sin_extension"] += 1
+                    continue
+                db.execute(update(L).where(L.id == capa.id).values(bounds=envolvente(bounds)))
+                resumen["metadatos"] += 1
+            db.commit()
+            ultimo_id = capas[-1].id
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    logger.info(
+        f"🧭 Bounds de capas: {resumen['vector_tiles']} desde vector tiles, "
+        f"{resumen['metadatos']} desde metadatos, {resumen['sin_extension']} sin extensión conocida"
+    )
+    return resumen
+
+
+if __name__ == "__main__":
+    import argparse
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Rellenar Layer.bounds de las capas existentes")
+    parser.add_argument("--todas", action="store_true", help="Recalcular también las capas que ya tienen bounds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print(rellenar_bounds(SessionLocal, solo_vacios=not args.todas))
@@ -0,0 +1,109 @@
+"""
+Registro diferido de métricas de inicio de sesión (login_count / last_login).
+
+Actualizar la fila del usuario y hacer commit dentro de cada login serializa
+los inicios de sesión en ráfaga (cambio de turno) contra PostgreSQL. Aquí los
+logins se acumulan en memoria por usuario y un hilo de fondo los aplica cada
+pocos segundos con un único UPDATE ejecutado en lote (executemany).
+
+Si el proceso muere antes de volcar, se pierden como máximo los logins del
+último intervalo; son métricas, no datos de negocio.
+"""
+
+import os
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Tuple
+
+from sqlalchemy import bindparam, func, update
+
+import models
+
+logger = logging.getLogger(__name__)
+
+LOGIN_METRICS_FLUSH_SECONDS = float(os.getenv("LOGIN_METRICS_FLUSH_SECONDS", 5))
+# Se vuelca antes del intervalo si se acumulan tantos usuarios distintos
+LOGIN_METRICS_MAX_PENDING = int(os.getenv("LOGIN_METRICS_MAX_PENDING", 500))
+
+_users = models.User.__table__
+_UPDATE_METRICAS = (
+    update(_users)
+    .where(_users.c.id == bindparam("b_id"))
+    .values(
+        login_count=func.coalesce(_users.c.login_count, 0) + bindparam("b_logins"),
+        last_login=bindparam("b_ultimo"),
+    )
+)
+
+
+class LoginMetricsBuffer:
+    """Acumula logins por usuario y los vuelca a PostgreSQL en lote."""
+
+    def __init__(self, session_factory, intervalo: float = LOGIN_METRICS_FLUSH_SECONDS,
+                 max_pendientes: int = LOGIN_METRICS_MAX_PENDING):
+        self._session_factory = session_factory
+        self._intervalo = intervalo
+        self._max_pendientes = max_pendientes
+        self._pendientes: Dict[int, Tuple[int, datetime]] = {}
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def registrar(self, user_id: int):
+        """Registra un login (no toca la base de datos)."""
+        with self._lock:
+            logins, _ = self._pendientes.get(user_id, (0, None))
+            self._pendientes[user_id] = (logins + 1, datetime.utcnow())
+            lleno = len(self._pendientes) >= self._max_pendientes
+        if lleno:
+            self._despertar.set()
+
+    def volcar(self) -> int:
+        """Aplica los logins pendientes con un UPDATE en lote. Devuelve usuarios actualizados."""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+        if not pendientes:
+            return 0
+
+        filas = [
+            {"b_id": user_id, "b_logins": logins, "b_ultimo": ultimo}
+            for user_id, (logins, ultimo) in pendientes.items()
+        ]
+        db = self._session_factory()
+        try:
+            db.connection().execute(_UPDATE_METRICAS, filas)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error guardando métricas de login: {e}")
+            # Reintentar en el siguiente ciclo sin perder los conteos; un login
+            # registrado mientras tanto es más reciente que el lote fallido
+            with self._lock:
+                for user_id, (logins, ultimo) in pendientes.items():
+                    previos, ultimo_nuevo = self._pendientes.get(user_id, (0, None))
+                    self._pendientes[user_id] = (previos + logins, max(ultimo, ultimo_nuevo or ultimo))
+            return 0
+        finally:
+            db.close()
+        return len(filas)
+
+    def iniciar(self):
+        if self._hilo is not None:
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="login-metrics", daemon=True)
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        self._despertar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=10)
+        self.volcar()
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            self._despertar.wait(self._intervalo)
+            self._despertar.clear()
+            self.volcar()
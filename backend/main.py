@@ -2,6 +2,8 @@ import os
 import sys
 import shutil
 import io
+import time
+import json
 import numpy as np
 import pandas as pd
 from typing import List, Optional
@@ -23,14 +25,15 @@ try:
 except Exception:
     pass
 
-from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Form, BackgroundTasks, Response, Query, status
-from convert_cogs import convert_to_cog
+from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Form, BackgroundTasks, Response, Query, Header, status
+from convert_cogs import convert_to_cog, update_layer_progress
 from convert_3d import convert_point_cloud, convert_obj_to_glb
 from fastapi.responses import Response, FileResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from sqlalchemy import func, or_
 from jose import JWTError, jwt
 from PIL import Image
 import rasterio
@@ -52,6 +55,9 @@ from rasterio.errors import NodataShadowWarning
 warnings.filterwarnings("ignore", category=NodataShadowWarning)
 
 from database import engine, get_db, settings, SessionLocal
+from kmz_export import generar_kmz
+import vector_tiles
+from layer_bounds import rellenar_bounds
 from gis_service import gis_service
 
 # --- AUTH CONFIG ---
@@ -59,6 +65,8 @@ from gis_service import gis_service
 SECRET_KEY = settings.SECRET_KEY
 ALGORITHM = settings.ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
+# Vigencia de los tokens de tiles (?token=), limitados a un proyecto
+TILE_TOKEN_EXPIRE_MINUTES = int(os.getenv("TILE_TOKEN_EXPIRE_MINUTES", ACCESS_TOKEN_EXPIRE_MINUTES))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -83,6 +91,10 @@ app.add_middleware(
 )
 
 from shared import UPLOAD_DIR, tile_cache
+from starlette.concurrency import run_in_threadpool
+from login_metrics import LoginMetricsBuffer
+from user_cache import user_cache
+from project_access import tiene_acceso_proyecto, verificar_acceso_proyecto
 
 # Middleware para Cache-Control en archivos estáticos
 @app.middleware("http")
@@ -113,15 +125,22 @@ async def get_current_user(db: Session = Depends(get_db), token: str = Depends(o
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    # Token ya validado en este worker: evita decodificar el JWT de nuevo
+    username = user_cache.username_de_token(token)
+    if username is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+            token_data = schemas.TokenData(email=username)
+        except JWTError:
             raise credentials_exception
-        token_data = schemas.TokenData(email=username)
-    except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_username(db, username=token_data.email)
+        username = token_data.email
+        user_cache.guardar_token(token, username, payload.get("exp"))
+    
+    # Usuario desde la caché de corta duración (sin SELECT en cada solicitud)
+    user = user_cache.obtener_usuario(db, username)
     if user is None:
         raise credentials_exception
     
@@ -150,6 +169,48 @@ def check_role(required_roles: list):
         return current_user
     return role_checker
 
+def require_project_access(
+    project_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """
+    Dependencia para endpoints con {project_id} en la ruta: dueño o asignado.
+    404 si el proyecto no existe, 403 si no tiene acceso. No carga el proyecto.
+    """
+    verificar_acceso_proyecto(db, current_user, project_id)
+    return current_user
+
+def create_tile_token(user: models.User, project_id: int) -> str:
+    """
+    Token para las rutas de tiles por id (los clientes de mapas piden las
+    imágenes sin encabezados). Sin "sub": no sirve como token de acceso a la API.
+    """
+    return create_access_token(
+        data={"tiles": user.username, "pid": project_id},
+        expires_delta=timedelta(minutes=TILE_TOKEN_EXPIRE_MINUTES)
+    )
+
+def verificar_token_tiles(db: Session, token: Optional[str], project_id: int):
+    """
+    Valida el token de tiles para el proyecto y vuelve a verificar el acceso
+    del usuario (un usuario desasignado deja de ver los tiles sin esperar a
+    que el token expire). 401 sin token válido, 403/404 como el resto de la API.
+    """
+    credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token de tiles inválido")
+    if not token:
+        raise credentials_exception
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise credentials_exception
+    if not payload.get("tiles") or payload.get("pid") != project_id:
+        raise credentials_exception
+    user = user_cache.obtener_usuario(db, payload["tiles"])
+    if user is None or not user.is_active:
+        raise credentials_exception
+    verificar_acceso_proyecto(db, user, project_id)
+
 # --- ENDPOINTS ---
 
 @app.get("/")
@@ -158,14 +219,34 @@ async def root():
     return {"message": "GIS Geovisor API is running", "status": "healthy"}
 
 # --- AUTH ENDPOINTS ---
-@app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+# login_count/last_login se acumulan en memoria y se vuelcan en lote
+login_metrics = LoginMetricsBuffer(SessionLocal)
+
+
+@app.on_event("startup")
+def iniciar_login_metrics():
+    login_metrics.iniciar()
+
+
+@app.on_event("shutdown")
+def detener_login_metrics():
+    login_metrics.detener()
+
+
+def _buscar_usuario_login(db: Session, username_or_email: str):
     # Permitir login por username o por email
-    user = crud.get_user_by_username(db, username=form_data.username)
+    user = crud.get_user_by_username(db, username=username_or_email)
     if not user:
-        user = crud.get_user_by_email(db, email=form_data.username)
+        user = crud.get_user_by_email(db, email=username_or_email)
+    return user
+
+
+@app.post("/token", response_model=schemas.Token)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # La consulta y bcrypt corren fuera del event loop para no congelar el worker
+    user = await run_in_threadpool(_buscar_usuario_login, db, form_data.username)
 
-    if not user or not crud.verify_password(form_data.password, user.hashed_password):
+    if not user or not await crud.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username, email or password",
@@ -178,10 +259,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Su usuario está desactivado. Contacte a soporte en soporte@mabtec.com.co para restaurar su acceso."
         )
-    # Actualizar contador de inicios de sesión
-    user.login_count = (user.login_count or 0) + 1
-    user.last_login = datetime.utcnow()
-    db.commit()
+    # Actualizar contador de inicios de sesión (en lote, fuera de la solicitud)
+    login_metrics.registrar(user.id)
 
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -190,7 +269,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/auth/google", response_model=schemas.Token)
-async def google_auth(login_data: schemas.GoogleLogin, db: Session = Depends(get_db)):
+def google_auth(login_data: schemas.GoogleLogin, db: Session = Depends(get_db)):
+    # Síncrona: FastAPI la corre en el threadpool (verificación de Google + SQLAlchemy)
     try:
         # Verificar el token de Google
         # El CLIENT_ID debe estar en el .env
@@ -219,16 +299,11 @@ async def google_auth(login_data: schemas.GoogleLogin, db: Session = Depends(get
                 counter += 1
             username = temp_username
             
-            import secrets
-            import string
-            # Generar una contraseña aleatoria segura (aunque no se usará)
-            random_password = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
-            
-            user_in = schemas.UserCreate(
+            # Sin contraseña: solo puede entrar con Google hasta que se le asigne una
+            user_in = schemas.UserBase(
                 username=username,
                 email=email,
                 full_name=full_name,
-                password=random_password,
                 role="usuario"
             )
             user = crud.create_user(db, user_in)
@@ -241,9 +316,7 @@ async def google_auth(login_data: schemas.GoogleLogin, db: Session = Depends(get
             )
 
         # Actualizar métricas
-        user.login_count = (user.login_count or 0) + 1
-        user.last_login = datetime.utcnow()
-        db.commit()
+        login_metrics.registrar(user.id)
 
         access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
         access_token = create_access_token(
@@ -315,13 +388,39 @@ def read_projects(db: Session = Depends(get_db), current_user: models.User = Dep
     is_admin = current_user.role == "administrador" or current_user.is_superuser
     return crud.get_projects(db, user_id=current_user.id, is_admin=is_admin)
 
+@app.get("/projects/summary", response_model=schemas.ProjectSummaryPage, response_model_exclude_unset=True)
+def read_project_summaries(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    include: Optional[str] = Query(None, description="Lista separada por comas: details, members"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """
+    Listado resumido y paginado para el selector de proyectos (id, nombre,
+    número de capas y miembros, bbox). Usar next_cursor para la siguiente página.
+    """
+    includes = {i.strip() for i in include.split(",") if i.strip()} if include else set()
+    invalid = includes - crud.PROJECT_SUMMARY_INCLUDES
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"include no soportado: {sorted(invalid)}")
+    is_admin = current_user.role == "administrador" or current_user.is_superuser
+    try:
+        return crud.get_project_summaries(
+            db, user_id=current_user.id, is_admin=is_admin,
+            limit=limit, cursor=cursor, search=q, include=includes
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
 @app.get("/projects/by-id/{project_id}", response_model=schemas.ProjectRead)
 def read_project(project_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     project = db.query(models.Project).filter(models.Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=404, detail="Project not found")
     is_admin_or_super = current_user.role == 'administrador' or getattr(current_user, 'is_superuser', False)
-    if not is_admin_or_super and project.owner_id != current_user.id and current_user not in project.assigned_users:
+    if not is_admin_or_super and not tiene_acceso_proyecto(db, current_user, project.id):
         raise HTTPException(status_code=403, detail="Access denied")
     # Incrementar contador de visitas
     project.visit_count = (project.visit_count or 0) + 1
@@ -373,24 +472,30 @@ def delete_project(project_id: int, db: Session = Depends(get_db), current_user:
 
 # --- MEASUREMENT ENDPOINTS ---
 @app.get("/projects/{project_id}/measurements", response_model=List[schemas.MeasurementRead])
-def get_project_measurements(project_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def get_project_measurements(project_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(require_project_access)):
     """Obtener todas las medidas de un proyecto"""
-    project = db.query(models.Project).filter(models.Project.id == project_id).first()
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
     return crud.get_measurements_by_project(db, project_id)
 
+@app.get("/projects/{project_id}/measurements/geojson")
+def get_project_measurements_geojson(
+    project_id: int,
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy en EPSG:4326"),
+    zoom: Optional[int] = Query(None, ge=0, le=24, description="Simplificar geometrías para este zoom"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(require_project_access)
+):
+    """Medidas del proyecto como FeatureCollection GeoJSON generada en PostGIS"""
+    try:
+        limites = crud.parse_bbox(bbox)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox debe ser minx,miny,maxx,maxy")
+    geojson = crud.get_measurements_geojson(db, project_id, bbox=limites, zoom=zoom)
+    return Response(content=geojson, media_type="application/geo+json")
+
 @app.post("/measurements", response_model=schemas.MeasurementRead)
 def create_measurement(measurement: schemas.MeasurementCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     """Crear una nueva medida"""
-    project = db.query(models.Project).filter(models.Project.id == measurement.project_id).first()
-    if not project:
-         raise HTTPException(status_code=404, detail="Project not found")
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    verificar_acceso_proyecto(db, current_user, measurement.project_id)
     
     return crud.create_measurement(db, measurement)
 
@@ -401,9 +506,7 @@ def update_measurement(measurement_id: int, measurement_update: schemas.Measurem
     if not db_measurement:
         raise HTTPException(status_code=404, detail="Measurement not found")
     
-    project = db_measurement.project
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    verificar_acceso_proyecto(db, current_user, db_measurement.project_id)
     
     return crud.update_measurement(db, measurement_id, measurement_update)
 
@@ -414,9 +517,7 @@ def delete_measurement(measurement_id: int, db: Session = Depends(get_db), curre
     if not db_measurement:
         raise HTTPException(status_code=404, detail="Measurement not found")
     
-    project = db_measurement.project
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    verificar_acceso_proyecto(db, current_user, db_measurement.project_id)
     
     crud.delete_measurement(db, measurement_id)
     return {"message": "Measurement deleted successfully"}
@@ -428,69 +529,29 @@ def export_measurements_kmz(
     db: Session = Depends(get_db), 
     current_user: models.User = Depends(get_current_user)
 ):
-    """Exportar medidas de un proyecto a formato KMZ"""
-    try:
-        from fastkml import kml
-        from shapely.geometry import shape
-        import zipfile
-        import json
-        from sqlalchemy.sql import func
-        
-        project = db.query(models.Project).filter(models.Project.id == project_id).first()
-        if not project:
-            raise HTTPException(status_code=404, detail="Project not found")
-        
-        if project.owner_id != current_user.id and current_user not in project.assigned_users:
-            raise HTTPException(status_code=403, detail="Access denied")
+    """Exportar medidas de un proyecto a formato KMZ (una consulta, ZIP en streaming)"""
+    verificar_acceso_proyecto(db, current_user, project_id)
+    project = db.query(models.Project.id, models.Project.name).filter(models.Project.id == project_id).first()
 
-        query = db.query(models.Measurement).filter(models.Measurement.project_id == project_id)
-        
-        if measurement_ids:
+    ids = None
+    if measurement_ids:
+        try:
             ids = [int(x) for x in measurement_ids.split(',')]
-            query = query.filter(models.Measurement.id.in_(ids))
-            
-        measurements = query.all()
-        
-        k = kml.KML()
-        ns = '{http://www.opengis.net/kml/2.2}'
-        d = kml.Document(ns, 'docid', project.name, 'Medidas del proyecto')
-        k.add_element(d)
-        
-        for m in measurements:
-            p = kml.Placemark(ns, str(m.id), m.name, f"Tipo: {m.measurement_type}")
-            # Convertir geometría de PostGIS a GeoJSON dict
-            geom_json = json.loads(db.scalar(func.ST_AsGeoJSON(m.geometry)))
-            geom = shape(geom_json)
-            p.geometry = geom
-            d.add_element(p)
-        
-        kml_str = k.to_string(prettyprint=True)
-        
-        # Crear ZIP (KMZ es un ZIP con un doc.kml)
-        kmz_io = io.BytesIO()
-        with zipfile.ZipFile(kmz_io, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            zip_file.writestr('doc.kml', kml_str)
-        
-        kmz_io.seek(0)
-        
-        filename = f"medidas_{project.name.replace(' ', '_')}.kmz"
-        
-        logging.info(f"KMZ exported successfully for project {project_id}")
-        
-        return StreamingResponse(
-            kmz_io,
-            media_type="application/vnd.google-earth.kmz",
-            headers={
-                "Content-Disposition": f"attachment; filename={filename}",
-                "Access-Control-Expose-Headers": "Content-Disposition",
-                "Access-Control-Allow-Origin": "http://localhost:4200",
-                "Access-Control-Allow-Credentials": "true"
-            }
-        )
-    except Exception as e:
-        import traceback
-        logging.error(f"Error exporting KMZ: {e}\n{traceback.format_exc()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="measurement_ids inválido")
+
+    filename = f"medidas_{project.name.replace(' ', '_')}.kmz"
+
+    return StreamingResponse(
+        generar_kmz(SessionLocal, project_id, project.name, ids),
+        media_type="application/vnd.google-earth.kmz",
+        headers={
+            "Content-Disposition": f"attachment; filename={filename}",
+            "Access-Control-Expose-Headers": "Content-Disposition",
+            "Access-Control-Allow-Origin": "http://localhost:4200",
+            "Access-Control-Allow-Credentials": "true"
+        }
+    )
 
 @app.get("/dashboard/stats")
 def get_stats(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
@@ -501,8 +562,7 @@ def get_stats(db: Session = Depends(get_db), current_user: models.User = Depends
 # --- FOLDER ENDPOINTS ---
 @app.post("/folders/", response_model=schemas.FolderRead)
 def create_folder(folder: schemas.FolderCreate, db: Session = Depends(get_db), current_user: models.User = Depends(check_role(['administrador', 'director']))):
-    project = db.query(models.Project).filter(models.Project.id == folder.project_id).first()
-    if not project or (project.owner_id != current_user.id and current_user not in project.assigned_users):
+    if not tiene_acceso_proyecto(db, current_user, folder.project_id):
          raise HTTPException(status_code=403, detail="Access denied to project")
     return crud.create_folder(db, folder)
 
@@ -521,9 +581,7 @@ def update_folder(folder_id: int, folder_update: schemas.FolderUpdate, db: Sessi
     if not db_folder:
         raise HTTPException(status_code=404, detail="Folder not found")
     
-    project = db_folder.project
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    verificar_acceso_proyecto(db, current_user, db_folder.project_id)
     
     return crud.update_folder(db, folder_id, folder_update.model_dump(exclude_unset=True))
 
@@ -542,6 +600,46 @@ def process_raster_pipeline(file_path: str, layer_id: int):
         # 2. Seed (warm up) cache for common zoom levels
         seed_cache_for_layer(file_path, layer_id)
 
+def process_vector_pipeline(file_path: str, layer_id: int):
+    """
+    Carga los elementos de una capa vectorial (KML/KMZ, SHP/GeoJSON/GPKG, DXF)
+    en PostGIS para servirla como vector tiles. El archivo original se conserva
+    (geocercas, descarga).
+    
+    Las capas CAD reportan su avance en processing_status/processing_progress
+    (un DXF de cientos de MB tarda minutos); el avance se guarda con otra
+    sesión porque la ingesta ocurre dentro de una sola transacción. Si la
+    ingesta falla, cualquier tipo de capa queda en processing_status "failed".
+    """
+    db = SessionLocal()
+    progreso_db = SessionLocal()
+    layer = None
+    try:
+        layer = db.query(models.Layer).filter(models.Layer.id == layer_id).first()
+        if not layer:
+            return
+        es_cad = layer.layer_type == 'cad'
+        progreso = None
+        if es_cad:
+            update_layer_progress(progreso_db, layer_id, "processing", 0)
+            # Lectura del DXF = 0-90 %, el resto es el commit y el ANALYZE
+            progreso = lambda fraccion: update_layer_progress(progreso_db, layer_id, None, min(90, int(fraccion * 90)))
+
+        inicio = time.perf_counter()
+        fuentes = vector_tiles.fuentes_para_capa(layer.layer_type, file_path, crs=layer.crs, progreso=progreso)
+        total = vector_tiles.ingerir_capa(db, layer, fuentes)
+        # También para KML/SHP/GeoJSON: una re-ingesta exitosa limpia un "failed" anterior
+        update_layer_progress(progreso_db, layer_id, "completed", 100)
+        logger.info(f"🗺️ Capa {layer_id}: {total} elementos cargados para vector tiles en {time.perf_counter() - inicio:.1f}s")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"❌ Error cargando vector tiles de la capa {layer_id}: {e}")
+        if layer:
+            update_layer_progress(progreso_db, layer_id, "failed", 0)
+    finally:
+        progreso_db.close()
+        db.close()
+
 def process_3d_pipeline(file_path: str, layer_id: int):
     """
     Pipeline para procesar archivos 3D en segundo plano.
@@ -668,8 +766,7 @@ async def upload_files(
     if not db_project:
         raise HTTPException(status_code=404, detail=f"Project with ID {project_id} not found")
     
-    if db_project.owner_id != current_user.id and current_user not in db_project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied to this project")
+    verificar_acceso_proyecto(db, current_user, db_project.id, detail="Access denied to this project")
 
     # Obtener el pid de MongoDB para el nombre del archivo si es geocerca
     # Si no tiene mongo_id, usamos el ID de postgres como fallback
@@ -816,8 +913,8 @@ async def upload_files(
                 z_index=0,
                 geofence_type=geofence_type if geofence_type in ["intervencion", "oficina"] else "ninguno",
                 settings={**metadata, "original_path": file_path},
-                processing_status="processing" if layer_type in ['point_cloud', '3d_model'] else ("pending" if layer_type == 'raster' else "completed"),
-                processing_progress=0 if layer_type in ['point_cloud', '3d_model', 'raster'] else 100
+                processing_status="processing" if layer_type in ['point_cloud', '3d_model'] else ("pending" if layer_type in ['raster', 'cad'] else "completed"),
+                processing_progress=0 if layer_type in ['point_cloud', '3d_model', 'raster', 'cad'] else 100
             )
             created_layer = crud.create_layer(db=db, layer=layer_in)
             
@@ -826,6 +923,8 @@ async def upload_files(
                 background_tasks.add_task(process_raster_pipeline, file_path, created_layer.id)
             elif layer_type == 'point_cloud' or (layer_type == '3d_model' and file_format == 'obj'):
                 background_tasks.add_task(process_3d_pipeline, file_path, created_layer.id)
+            elif layer_type in ('kml', 'vector') or (layer_type == 'cad' and file_format == 'dxf'):
+                background_tasks.add_task(process_vector_pipeline, file_path, created_layer.id)
                 
         except Exception as e:
             print(f"Error processing file {filename}: {e}")
@@ -841,18 +940,33 @@ async def upload_files(
 @app.get("/projects/{project_id}/layers", response_model=List[schemas.LayerRead])
 def get_project_layers(
     project_id: int, 
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy en EPSG:4326: solo capas que intersectan la vista"),
+    include_unbounded: bool = Query(True, description="Con bbox, incluir capas sin extensión conocida"),
     db: Session = Depends(get_db), 
-    current_user: models.User = Depends(get_current_user)
+    current_user: models.User = Depends(require_project_access)
 ):
-    """Obtener todas las capas de un proyecto"""
-    project = db.query(models.Project).filter(models.Project.id == project_id).first()
-    if not project:
-        raise HTTPException(status_code=404, detail="Project not found")
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
-    
-    layers = db.query(models.Layer).filter(models.Layer.project_id == project_id).order_by(models.Layer.z_index).all()
-    return layers
+    """Obtener las capas de un proyecto (opcionalmente solo las visibles en un bbox)"""
+    try:
+        limites = crud.parse_bbox(bbox)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox debe ser minx,miny,maxx,maxy")
+
+    query = db.query(models.Layer).filter(models.Layer.project_id == project_id)
+    if limites:
+        # && usa el índice GiST de layers.bounds
+        intersecta = models.Layer.bounds.op("&&")(func.ST_MakeEnvelope(*limites, 4326))
+        query = query.filter(or_(intersecta, models.Layer.bounds.is_(None)) if include_unbounded else intersecta)
+    return query.order_by(models.Layer.z_index).all()
+
+@app.post("/layers/bounds/backfill", status_code=202)
+def backfill_layer_bounds(
+    background_tasks: BackgroundTasks,
+    recalcular: bool = Query(False, description="Recalcular también las capas que ya tienen bounds"),
+    current_user: models.User = Depends(check_role(['administrador']))
+):
+    """Calcular Layer.bounds de las capas existentes en segundo plano"""
+    background_tasks.add_task(rellenar_bounds, SessionLocal, not recalcular)
+    return {"status": "queued"}
 
 @app.delete("/layers/{layer_id}")
 def delete_layer(layer_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(check_role(['administrador', 'director']))):
@@ -860,10 +974,10 @@ def delete_layer(layer_id: int, db: Session = Depends(get_db), current_user: mod
     layer = db.query(models.Layer).filter(models.Layer.id == layer_id).first()
     if not layer:
         raise HTTPException(status_code=404, detail="Layer not found")
-    project = layer.project
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    project_id = layer.project_id
+    verificar_acceso_proyecto(db, current_user, project_id)
     crud.delete_layer(db, layer_id)
+    compositor.invalidar(project_id)
     return {"message": "Layer deleted successfully", "id": layer_id}
 
 @app.patch("/layers/{layer_id}", response_model=schemas.LayerRead)
@@ -880,9 +994,7 @@ def update_layer(
     if not layer:
         raise HTTPException(status_code=404, detail="Layer not found")
     
-    project = layer.project
-    if project.owner_id != current_user.id and current_user not in project.assigned_users:
-        raise HTTPException(status_code=403, detail="Access denied")
+    verificar_acceso_proyecto(db, current_user, layer.project_id)
     
     # Actualizar campos
     update_data = layer_update.model_dump(exclude_unset=True)
@@ -891,6 +1003,7 @@ def update_layer(
     
     db.commit()
     db.refresh(layer)
+    compositor.invalidar(layer.project_id)
     return layer
 
 @app.post("/layers/{layer_id}/toggle-visibility")
@@ -906,6 +1019,7 @@ def toggle_layer_visibility(
     
     layer.visible = not layer.visible
     db.commit()
+    compositor.invalidar(layer.project_id)
     return {"layer_id": layer_id, "visible": layer.visible}
 
 @app.post("/layers/{layer_id}/set-opacity")
@@ -925,43 +1039,153 @@ def set_layer_opacity(
     
     layer.opacity = opacity
     db.commit()
+    compositor.invalidar(layer.project_id)
     return {"layer_id": layer_id, "opacity": opacity}
 
 
-# --- TILING SERVICE (High-Performance VRT-based) ---
-from tile_renderer import tile_renderer, EMPTY_TILE_BYTES, EMPTY_TILE_PNG
+@app.post("/layers/{layer_id}/vector-tiles", status_code=202)
+def regenerate_vector_tiles(
+    layer_id: int,
+    background_tasks: BackgroundTasks,
+    crs: Optional[str] = Query(None, description="CRS de las coordenadas del dibujo CAD, ej. EPSG:9377"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(check_role(['administrador', 'director']))
+):
+    """(Re)cargar en PostGIS los elementos de una capa vectorial o CAD (DXF) para servirla como vector tiles"""
+    layer = db.query(models.Layer).filter(models.Layer.id == layer_id).first()
+    if not layer:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    verificar_acceso_proyecto(db, current_user, layer.project_id)
+    if layer.layer_type not in ('kml', 'vector', 'cad'):
+        raise HTTPException(status_code=400, detail="La capa no es vectorial (KML/KMZ, SHP, GeoJSON, GPKG, DXF)")
+    if crs:
+        try:
+            pyproj.CRS.from_user_input(crs)
+        except pyproj.exceptions.CRSError:
+            raise HTTPException(status_code=400, detail=f"CRS inválido: {crs}")
+        layer.crs = crs
+        db.commit()
+    if layer.layer_type == 'cad':
+        layer.processing_status = "pending"
+        layer.processing_progress = 0
+        db.commit()
+    background_tasks.add_task(process_vector_pipeline, layer.file_path, layer.id)
+    return {"layer_id": layer_id, "status": "queued"}
+
+@app.get("/layers/{layer_id}/features")
+def get_layer_features(
+    layer_id: int,
+    bbox: Optional[str] = Query(None, description="minx,miny,maxx,maxy en EPSG:4326"),
+    zoom: Optional[int] = Query(None, ge=0, le=24, description="Simplificar geometrías para este zoom"),
+    limit: int = Query(10000, ge=1, le=100000),
+    cursor: Optional[int] = Query(None, ge=0, description="next_cursor de la página anterior"),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """
+    Elementos de una capa vectorial como GeoJSON (EPSG:4326), filtrados por bbox.
+    Si el resultado supera `limit`, la FeatureCollection trae truncated=true y
+    next_cursor para pedir la página siguiente.
+    """
+    layer = db.query(models.Layer.id, models.Layer.project_id).filter(models.Layer.id == layer_id).first()
+    if not layer:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    verificar_acceso_proyecto(db, current_user, layer.project_id)
+    try:
+        limites = crud.parse_bbox(bbox)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox debe ser minx,miny,maxx,maxy")
+    geojson = vector_tiles.features_geojson(db, layer_id, bbox=limites, zoom=zoom, limite=limit, cursor=cursor)
+    return Response(content=geojson, media_type="application/geo+json")
+
+@app.get("/vtiles/{layer_id}/{z}/{x}/{y}.mvt")
+def get_vector_tile(
+    layer_id: int, z: int, x: int, y: int,
+    token: Optional[str] = Query(None, description="Token de /projects/{project_id}/tile-token"),
+    db: Session = Depends(get_db)
+):
+    """
+    Vector tile (MVT) de una capa vectorial generado con ST_AsMVT.
+    Solo incluye la geometría del tile, simplificada para el zoom; se cachea en disco.
+    Requiere el token de tiles del proyecto de la capa.
+    """
+    if not (0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Coordenadas de tile inválidas")
+    project_id = db.query(models.Layer.project_id).filter(models.Layer.id == layer_id).scalar()
+    if project_id is None:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    verificar_token_tiles(db, token, project_id)
+    tile = vector_tiles.obtener_tile(db, layer_id, z, x, y)
+    return Response(
+        content=tile,
+        media_type="application/vnd.mapbox-vector-tile",
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
 
-@app.get("/tiles/{filename}/{z}/{x}/{y}.png")
-async def get_tile(filename: str, z: int, x: int, y: int):
+# --- TILING SERVICE (High-Performance VRT-based) ---
+from tile_renderer import (
+    tile_renderer, tile_cache_key, encode_tile, negotiate_format, media_type_for, empty_tile,
+    MEDIA_TYPES, TILE_FORMATS, FORMAT_ALIASES,
+)
+from tile_normalize import COLORMAPS
+from tile_composite import compositor, resolver_archivo
+import terrain_tiles
+import raster_sampling
+
+@app.get("/tiles/{filename}/{z}/{x}/{y}.{ext}")
+def get_tile(
+    filename: str, z: int, x: int, y: int, ext: str,
+    fmt: Optional[str] = Query(None, alias="format", description="webp, png, jpeg o lossless"),
+    colormap: Optional[str] = Query(None, description="Rampa de color para rasters de una banda (DEM): terrain, viridis, rdylgn, gray"),
+    accept: Optional[str] = Header(None)
+):
     """
     High-performance tile endpoint.
     Uses WarpedVRT + COG overviews for instant tile reads.
-    Output format: WEBP (smaller than PNG, faster to transfer).
-    Falls back to cached PNG tiles from older cache if present.
+    Output format is negotiated from the extension / ?format= and the Accept header:
+    WEBP by default (.png keeps working for older clients), PNG when WEBP is not
+    accepted, JPEG for opaque tiles on request and lossless WEBP for DEMs.
     """
+    requested = FORMAT_ALIASES.get(fmt or ext, fmt or ext)
+    if requested not in TILE_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato de tile no soportado")
+    if colormap is not None and colormap not in COLORMAPS:
+        raise HTTPException(status_code=400, detail=f"Colormap no soportado. Opciones: {', '.join(COLORMAPS)}")
+
+    # Locate the raster file
+    file_path = os.path.join(UPLOAD_DIR, filename)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+
+    # Only the historical .png route without ?format= is negotiated
+    negotiated = fmt is None and requested == "png"
+    try:
+        dem = negotiated and tile_renderer.is_dem(file_path)
+    except Exception as e:
+        logger.error(f"Tile render error {filename}/{z}/{x}/{y}: {e}")
+        dem = False
+    out_fmt = negotiate_format(None if negotiated else requested, accept, dem)
+    headers = {"Vary": "Accept"} if negotiated else {}
+
     # 1. Check disk cache first
-    cache_key = f"{filename}-{z}-{x}-{y}"
+    try:
+        cache_name = tile_renderer.cache_name(file_path, colormap)
+    except Exception as e:
+        logger.error(f"Tile render error {filename}/{z}/{x}/{y}: {e}")
+        cache_name = f"{filename}~{colormap}" if colormap else filename
+    cache_key = tile_cache_key(cache_name, z, x, y, out_fmt)
     cached_tile = tile_cache.get(cache_key)
     if cached_tile:
         # Detect format from cached data (old cache may have PNG)
-        if cached_tile[:4] == b'RIFF':
-            media = "image/webp"
-        else:
-            media = "image/png"
         return Response(
             content=cached_tile, 
-            media_type=media, 
-            headers={"Cache-Control": "public, max-age=31536000"}
+            media_type=media_type_for(cached_tile), 
+            headers={**headers, "Cache-Control": "public, max-age=31536000"}
         )
-
-    # 2. Locate the raster file
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Archivo no encontrado")
     
-    # 3. Render the tile using VRT (reads from COG overviews automatically)
+    # 2. Render the tile using VRT (reads from COG overviews automatically)
     try:
-        tile_bytes = tile_renderer.render_tile(file_path, z, x, y)
+        tile_bytes = tile_renderer.render_tile(file_path, z, x, y, out_fmt, profile="fast", colormap=colormap)
     except Exception as e:
         logger.error(f"Tile render error {filename}/{z}/{x}/{y}: {e}")
         tile_bytes = None
@@ -969,20 +1193,216 @@ async def get_tile(filename: str, z: int, x: int, y: int):
     if tile_bytes is None:
         # Empty/out-of-bounds tile — return transparent, don't cache
         return Response(
-            content=EMPTY_TILE_BYTES,
-            media_type="image/webp",
-            headers={"Cache-Control": "public, max-age=86400"}
+            content=empty_tile(out_fmt),
+            media_type=MEDIA_TYPES["png" if out_fmt == "jpeg" else out_fmt],
+            headers={**headers, "Cache-Control": "public, max-age=86400"}
         )
     
-    # 4. Cache the rendered tile for 30 days
+    # 3. Cache the rendered tile for 30 days
     tile_cache.set(cache_key, tile_bytes, expire=86400 * 30)
     
     return Response(
         content=tile_bytes,
-        media_type="image/webp",
-        headers={"Cache-Control": "public, max-age=31536000"}
+        media_type=media_type_for(tile_bytes),
+        headers={**headers, "Cache-Control": "public, max-age=31536000"}
     )
 
+@app.get("/projects/{project_id}/tile-token")
+def get_tile_token(
+    project_id: int,
+    current_user: models.User = Depends(require_project_access)
+):
+    """Token de corta duración para las rutas de tiles del proyecto (se envía como ?token=)."""
+    return {
+        "token": create_tile_token(current_user, project_id),
+        "expires_in": TILE_TOKEN_EXPIRE_MINUTES * 60
+    }
+
+@app.get("/tiles/composite/{project_id}/{z}/{x}/{y}")
+def get_composite_tile(
+    project_id: int, z: int, x: int, y: int,
+    fmt: Optional[str] = Query(None, alias="format", description="webp, png o jpeg"),
+    token: Optional[str] = Query(None, description="Token de /projects/{project_id}/tile-token"),
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Tile compuesto de todas las ortofotos visibles del proyecto (orden z_index y opacidad de la BD).
+    Un solo flujo de tiles en lugar de uno por capa; se cachea por versión del conjunto de capas.
+    Formato negociado con ?format= o el encabezado Accept (WEBP por defecto).
+    Requiere el token de tiles del proyecto.
+    """
+    if not (0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Coordenadas de tile inválidas")
+    verificar_token_tiles(db, token, project_id)
+    requested = FORMAT_ALIASES.get(fmt, fmt)
+    if requested is not None and requested not in TILE_FORMATS:
+        raise HTTPException(status_code=400, detail="Formato de tile no soportado")
+    out_fmt = negotiate_format(requested, accept)
+
+    indice = compositor.indice(db, project_id)
+    encabezados = {"Cache-Control": "private, max-age=60", "ETag": f'"{indice.version}"', "Vary": "Accept"}
+
+    cache_key = tile_cache_key(f"composite-{project_id}-{indice.version}", z, x, y, out_fmt)
+    cached_tile = tile_cache.get(cache_key)
+    if cached_tile:
+        return Response(content=cached_tile, media_type=media_type_for(cached_tile), headers=encabezados)
+
+    rgba = compositor.componer(indice.capas_en_tile(z, x, y), z, x, y)
+    if rgba is None:
+        return Response(
+            content=empty_tile(out_fmt),
+            media_type=MEDIA_TYPES["png" if out_fmt == "jpeg" else out_fmt],
+            headers=encabezados
+        )
+
+    tile_bytes = encode_tile(rgba, out_fmt, profile="fast")
+    tile_cache.set(cache_key, tile_bytes, expire=86400 * 30)
+    return Response(content=tile_bytes, media_type=media_type_for(tile_bytes), headers=encabezados)
+
+@app.get("/layers/{layer_id}/terrain/{mode}/{z}/{x}/{y}")
+def get_terrain_tile(
+    layer_id: int, mode: str, z: int, x: int, y: int,
+    fmt: Optional[str] = Query(None, alias="format", description="hillshade/slope: webp, png o jpeg; terrain-rgb: png o lossless"),
+    token: Optional[str] = Query(None, description="Token de /projects/{project_id}/tile-token"),
+    accept: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Tiles de terreno de una capa de elevación (DEM/DSM de una banda):
+    terrain-rgb (elevación codificada, para terreno 3D), hillshade o slope.
+    Se cachean por versión del archivo (un DEM reprocesado no sirve tiles viejos).
+    Requiere el token de tiles del proyecto de la capa.
+    """
+    if mode not in terrain_tiles.MODOS:
+        raise HTTPException(status_code=400, detail=f"Modo no soportado. Opciones: {', '.join(terrain_tiles.MODOS)}")
+    if not (0 <= z <= 24 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Coordenadas de tile inválidas")
+    requested = FORMAT_ALIASES.get(fmt, fmt)
+    if mode == "terrain-rgb":
+        # La elevación va codificada en los colores: solo formatos sin pérdida
+        if requested not in (None, "png", "lossless"):
+            raise HTTPException(status_code=400, detail="terrain-rgb solo se sirve en png o lossless")
+        out_fmt = requested or "png"
+    else:
+        if requested is not None and requested not in TILE_FORMATS:
+            raise HTTPException(status_code=400, detail="Formato de tile no soportado")
+        out_fmt = negotiate_format(requested, accept)
+
+    layer = db.query(
+        models.Layer.file_path, models.Layer.layer_type, models.Layer.project_id
+    ).filter(models.Layer.id == layer_id).first()
+    if not layer:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    verificar_token_tiles(db, token, layer.project_id)
+    if layer.layer_type != 'raster':
+        raise HTTPException(status_code=400, detail="La capa no es raster")
+    file_path = resolver_archivo(layer.file_path)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+
+    headers = {"Cache-Control": "private, max-age=86400", "Vary": "Accept"}
+    version = terrain_tiles.version_archivo(file_path)
+    cache_key = tile_cache_key(f"terrain-{layer_id}-{mode}-{version}", z, x, y, out_fmt)
+    cached_tile = tile_cache.get(cache_key)
+    if cached_tile:
+        return Response(content=cached_tile, media_type=media_type_for(cached_tile), headers=headers)
+
+    try:
+        if tile_renderer.band_count(file_path) != 1:
+            raise HTTPException(status_code=400, detail="La capa no es un modelo de elevación (una banda)")
+        rgba = terrain_tiles.renderizar(tile_renderer, file_path, mode, z, x, y)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Terrain tile error {layer_id}/{mode}/{z}/{x}/{y}: {e}")
+        rgba = None
+
+    if rgba is None:
+        return Response(
+            content=empty_tile(out_fmt),
+            media_type=MEDIA_TYPES["png" if out_fmt == "jpeg" else out_fmt],
+            headers=headers
+        )
+
+    tile_bytes = encode_tile(rgba, out_fmt, profile="fast")
+    tile_cache.set(cache_key, tile_bytes, expire=86400 * 30)
+    return Response(content=tile_bytes, media_type=media_type_for(tile_bytes), headers=headers)
+
+def _raster_de_capa(db: Session, current_user: models.User, layer_id: int) -> str:
+    """Ruta del raster de una capa a la que el usuario tiene acceso."""
+    layer = db.query(
+        models.Layer.file_path, models.Layer.layer_type, models.Layer.project_id
+    ).filter(models.Layer.id == layer_id).first()
+    if not layer:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    verificar_acceso_proyecto(db, current_user, layer.project_id)
+    if layer.layer_type != 'raster':
+        raise HTTPException(status_code=400, detail="La capa no es raster")
+    file_path = resolver_archivo(layer.file_path)
+    if not os.path.exists(file_path):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    return file_path
+
+@app.post("/layers/{layer_id}/sample")
+def sample_layer(
+    layer_id: int,
+    request: schemas.RasterSampleRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Valores del raster en una lista de puntos [lon, lat] (null = sin dato o fuera del raster)"""
+    file_path = _raster_de_capa(db, current_user, layer_id)
+    if not request.points:
+        return {"count": 0, "values": []}
+    if len(request.points) > raster_sampling.MUESTREO_MAX_PUNTOS:
+        raise HTTPException(status_code=400, detail=f"Máximo {raster_sampling.MUESTREO_MAX_PUNTOS} puntos por solicitud")
+    if any(len(p) < 2 for p in request.points):
+        raise HTTPException(status_code=400, detail="Cada punto debe ser [lon, lat]")
+    if request.bands and not all(1 <= b <= tile_renderer.band_count(file_path) for b in request.bands):
+        raise HTTPException(status_code=400, detail="Banda inválida")
+    try:
+        return raster_sampling.valores_en_puntos(file_path, request.points, request.bands)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/layers/{layer_id}/profile")
+def profile_layer(
+    layer_id: int,
+    request: schemas.RasterProfileRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Perfil de valores (p. ej. elevación de un DEM) a lo largo de una línea o de una medida"""
+    file_path = _raster_de_capa(db, current_user, layer_id)
+    if not 2 <= request.samples <= raster_sampling.PERFIL_MAX_MUESTRAS:
+        raise HTTPException(status_code=400, detail=f"samples debe estar entre 2 y {raster_sampling.PERFIL_MAX_MUESTRAS}")
+    if not 1 <= request.band <= tile_renderer.band_count(file_path):
+        raise HTTPException(status_code=400, detail="Banda inválida")
+
+    coordenadas = request.coordinates
+    if request.measurement_id is not None:
+        medida = db.query(
+            models.Measurement.project_id, func.ST_AsGeoJSON(models.Measurement.geometry).label("geojson")
+        ).filter(models.Measurement.id == request.measurement_id).first()
+        if not medida:
+            raise HTTPException(status_code=404, detail="Measurement not found")
+        verificar_acceso_proyecto(db, current_user, medida.project_id)
+        geometria = json.loads(medida.geojson)
+        if geometria["type"] == "LineString":
+            coordenadas = geometria["coordinates"]
+        elif geometria["type"] == "Polygon":
+            coordenadas = geometria["coordinates"][0]
+        else:
+            raise HTTPException(status_code=400, detail="La medida debe ser una línea o un polígono")
+    if not coordenadas or len(coordenadas) < 2 or any(len(c) < 2 for c in coordenadas):
+        raise HTTPException(status_code=400, detail="Se requiere una línea (coordinates) o measurement_id")
+
+    try:
+        return raster_sampling.perfil(file_path, coordenadas, request.samples, request.band)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/files/{filename:path}")
 async def get_file(filename: str):
     file_path = os.path.join(UPLOAD_DIR, filename)
@@ -1106,6 +1526,14 @@ async def download_layer_file(layer_id: int, db: Session = Depends(get_db)):
 # ============================================================================
 
 from geographic_records import crear_analizador_desde_env
+from report_export import (
+    registros_desde_dataframe, serializar_json, dataframe_a_arrow_ipc, exportar_reporte,
+    leer_registros_parquet, media_type_para, MEDIA_TYPE_ARROW, FORMATOS_EXPORTACION
+)
+from report_jobs import report_jobs
+from geofence_cache import geofence_cache
+from mongo_sync import MongoSyncEngine, MongoSyncScheduler, sincronizar_incremental, marcas_de_agua, MONGO_SYNC_INTERVAL_MINUTES
+from shared import sync_cache
 from pydantic import BaseModel
 from datetime import date
 
@@ -1116,6 +1544,205 @@ class GenerarReporteRequest(BaseModel):
     pid_filtro: Optional[str] = None
     user_filtro: Optional[str] = None
     nombre_proyecto_filtro: Optional[str] = None
+    # Formato de los registros: 'json' (por defecto) o 'arrow' (stream Arrow IPC)
+    formato: str = "json"
+    # Paginación opcional de los registros devueltos
+    offset: int = 0
+    limit: Optional[int] = None
+    # Archivos a generar: xlsx, kml, kmz, csv, parquet (csv/parquet para rangos muy grandes)
+    formatos_exportacion: List[str] = ["xlsx", "kml"]
+
+
+def _resolver_parametros_reporte(request: GenerarReporteRequest, db: Session, current_user: models.User) -> dict:
+    """
+    Resuelve el proyecto, los permisos y los filtros efectivos de un reporte.
+    
+    Devuelve un diccionario serializable (usado también como clave de
+    deduplicación de los trabajos asíncronos). Lanza HTTPException si el
+    usuario no tiene acceso a los registros solicitados.
+    """
+    formatos_invalidos = [f for f in request.formatos_exportacion if f not in FORMATOS_EXPORTACION]
+    if formatos_invalidos:
+        raise HTTPException(status_code=400, detail=f"Formatos no soportados: {formatos_invalidos}")
+    
+    logger.info(f"Generando reporte: {request.fecha_inicio} - {request.fecha_fin} (usuario: {current_user.username})")
+    
+    # 1. Resolver Proyecto en PostgreSQL para obtener geocercas
+    db_project = None
+    mongo_pid = None
+    nombre_proyecto_filtro = request.nombre_proyecto_filtro
+    
+    if request.pid_filtro:
+        pid_str = str(request.pid_filtro)
+        if pid_str.isdigit():
+            db_project = db.query(models.Project).filter(models.Project.id == int(pid_str)).first()
+        else:
+            db_project = db.query(models.Project).filter(models.Project.mongodb_id == pid_str).first()
+    
+    if db_project:
+        nombre_proyecto_filtro = db_project.name
+        mongo_pid = db_project.mongodb_id
+        logger.info(f"Proyecto identificado: {db_project.name} (DB ID: {db_project.id}, Mongo ID: {mongo_pid})")
+
+    # --- VERIFICACIÓN DE PERMISOS (Director solo ve sus proyectos) ---
+    is_admin_or_super = current_user.role == 'administrador' or getattr(current_user, 'is_superuser', False)
+    if not is_admin_or_super:
+        allowed_pids = [p.mongodb_id for p in current_user.assigned_projects if p.mongodb_id] + \
+                       [p.mongodb_id for p in current_user.owned_projects if p.mongodb_id]
+        
+        if not allowed_pids:
+            raise HTTPException(status_code=403, detail="No tienes proyectos asignados para consultar registros.")
+            
+        if mongo_pid and mongo_pid not in allowed_pids:
+            raise HTTPException(status_code=403, detail="No tienes acceso a los registros de este proyecto.")
+        
+        # Si no solicitó un proyecto específico, restringir la búsqueda a solo sus proyectos permitidos
+        if not mongo_pid:
+            mongo_pid = sorted(set(allowed_pids))
+    
+    # Si no se encontró proyecto en DB pero se tiene un ID directo (fallback)
+    if (not mongo_pid or isinstance(mongo_pid, list)) and request.pid_filtro and not str(request.pid_filtro).isdigit():
+        pid_str = str(request.pid_filtro)
+        if not is_admin_or_super and pid_str not in allowed_pids:
+            raise HTTPException(status_code=403, detail="No tienes acceso a los registros de este proyecto.")
+        mongo_pid = pid_str
+    
+    return {
+        "fecha_inicio": request.fecha_inicio.isoformat(),
+        "fecha_fin": request.fecha_fin.isoformat(),
+        "pid_filtro": mongo_pid,
+        "user_filtro": request.user_filtro,
+        "nombre_proyecto_filtro": nombre_proyecto_filtro,
+        "db_project_id": db_project.id if db_project else None,
+        "formatos_exportacion": sorted(set(request.formatos_exportacion)),
+    }
+
+
+def _cargar_geocerca_capa(analizador, layer: models.Layer):
+    """Carga el polígono de una capa de geocerca buscando su archivo en kml_proyectos o uploads."""
+    posibles_rutas = [
+        os.path.join("kml_proyectos", layer.file_path),
+        os.path.join("uploads", layer.file_path),
+        layer.file_path # Ruta absoluta si existe
+    ]
+    
+    for ruta in posibles_rutas:
+        if os.path.exists(ruta):
+            poly = analizador.cargar_poligono_geocerca(ruta)
+            if poly:
+                return poly
+    return None
+
+
+def _cargar_geocercas_capas(db: Session, analizador, project_id: int):
+    """Carga las geocercas de obra/oficina marcadas en las capas del proyecto."""
+    p_obra = None
+    p_ofi = None
+    
+    # Buscar capas marcadas como intervención u oficina para este proyecto
+    layers_geofence = db.query(models.Layer).filter(
+        models.Layer.project_id == project_id,
+        models.Layer.geofence_type.in_(['intervencion', 'oficina'])
+    ).all()
+    
+    for l in layers_geofence:
+        poly = _cargar_geocerca_capa(analizador, l)
+        if poly:
+            if l.geofence_type == 'intervencion':
+                p_obra = poly
+                logger.info(f"Geocerca de OBRA cargada desde capa: {l.name}")
+            elif l.geofence_type == 'oficina':
+                p_ofi = poly
+                logger.info(f"Geocerca de OFICINA cargada desde capa: {l.name}")
+    
+    return p_obra, p_ofi
+
+
+def _cargar_geocercas_proyectos(db: Session, analizador, mongo_pids: List[str]) -> dict:
+    """
+    Carga las geocercas de capas de varios proyectos en una sola consulta.
+    
+    Args:
+        mongo_pids: Proyectos presentes en los registros del reporte
+    
+    Returns:
+        Diccionario mongodb_id -> (poligono_obra, poligono_oficina)
+    """
+    if not mongo_pids:
+        return {}
+    query = db.query(models.Project.mongodb_id, models.Layer).join(
+        models.Layer, models.Layer.project_id == models.Project.id
+    ).filter(
+        models.Project.mongodb_id.in_(mongo_pids),
+        models.Layer.geofence_type.in_(['intervencion', 'oficina'])
+    )
+    
+    geocercas = {}
+    for mongo_pid, layer in query.all():
+        poly = _cargar_geocerca_capa(analizador, layer)
+        if not poly:
+            continue
+        p_obra, p_ofi = geocercas.get(mongo_pid, (None, None))
+        if layer.geofence_type == 'intervencion':
+            p_obra = poly
+        else:
+            p_ofi = poly
+        geocercas[mongo_pid] = (p_obra, p_ofi)
+    
+    logger.info(f"Geocercas de capas cargadas para {len(geocercas)} proyectos")
+    return geocercas
+
+
+def _generar_dataframe_reporte(parametros: dict, progress_callback=None) -> pd.DataFrame:
+    """
+    Consulta MongoDB y clasifica los registros según los parámetros resueltos.
+    
+    Corre fuera del hilo de la petición (threadpool o pool de report_jobs),
+    por eso abre su propia sesión en lugar de recibir la de `get_db`.
+    """
+    analizador = crear_analizador_desde_env(kml_base_path="kml_proyectos")
+    
+    # --- CARGAR GEOCERCAS DINÁMICAS DESDE LA DB ---
+    p_obra, p_ofi = None, None
+    cargar_geocercas = None
+    if parametros["db_project_id"]:
+        db = SessionLocal()
+        try:
+            p_obra, p_ofi = _cargar_geocercas_capas(db, analizador, parametros["db_project_id"])
+        finally:
+            db.close()
+    elif not isinstance(parametros["pid_filtro"], str):
+        # Reporte de varios proyectos (lista de pids o todos): solo se cargan
+        # las geocercas de los proyectos que aparecen en los registros
+        def cargar_geocercas(mongo_pids):
+            db = SessionLocal()
+            try:
+                return _cargar_geocercas_proyectos(db, analizador, mongo_pids)
+            finally:
+                db.close()
+    
+    # Generar reporte con polígonos explícitos (si se encontraron)
+    df = analizador.generar_reporte(
+        fecha_inicio=datetime.fromisoformat(parametros["fecha_inicio"]),
+        fecha_fin=datetime.fromisoformat(parametros["fecha_fin"]),
+        pid_filtro=parametros["pid_filtro"],
+        user_filtro=parametros["user_filtro"],
+        nombre_proyecto_filtro=parametros["nombre_proyecto_filtro"],
+        p_obra_explicit=p_obra,
+        p_ofi_explicit=p_ofi,
+        progress_callback=progress_callback,
+        cargar_geocercas_proyectos=cargar_geocercas
+    )
+    analizador.limpiar_cache()
+    return df
+
+
+def _estadisticas_reporte(df: pd.DataFrame) -> dict:
+    return {
+        "EN OBRA": int((df["Clasificación"] == "EN OBRA").sum()),
+        "EN OFICINA": int((df["Clasificación"] == "EN OFICINA").sum()),
+        "UBICACIÓN EXTERNA": int((df["Clasificación"] == "UBICACIÓN EXTERNA").sum())
+    }
 
 
 @app.post("/api/v1/geographic-records/generar-reporte")
@@ -1138,6 +1765,9 @@ async def generar_reporte_registros(
     - `pid_filtro`: (Opcional) Filtrar por ID de proyecto (PostgreSQL ID)
     - `user_filtro`: (Opcional) Filtrar por email del usuario
     - `nombre_proyecto_filtro`: (Opcional) Filtrar por nombre de proyecto (regex)
+    - `formato`: (Opcional) `json` (por defecto) o `arrow` para recibir los registros como stream Arrow IPC
+    - `offset` / `limit`: (Opcional) Paginación de los registros devueltos
+    - `formatos_exportacion`: (Opcional) Archivos a generar: `xlsx`, `kml`, `kmz`, `csv`, `parquet`
     
     **Criterios de clasificación:**
     - Carga polígonos de obra: `{pid}.kml` o `{pid}.kmz`
@@ -1153,98 +1783,10 @@ async def generar_reporte_registros(
     - `url_descarga`: URL para descargar el Excel (si se completó)
     """
     try:
-        # Convertir date a datetime
-        fecha_inicio = datetime.combine(request.fecha_inicio, datetime.min.time())
-        fecha_fin = datetime.combine(request.fecha_fin, datetime.min.time())
-        
-        logger.info(f"Generando reporte: {fecha_inicio} - {fecha_fin} (usuario: {current_user.username})")
-        
-        # 1. Resolver Proyecto en PostgreSQL para obtener geocercas
-        db_project = None
-        mongo_pid = None
-        nombre_proyecto_filtro = request.nombre_proyecto_filtro
-        
-        if request.pid_filtro:
-            pid_str = str(request.pid_filtro)
-            if pid_str.isdigit():
-                db_project = db.query(models.Project).filter(models.Project.id == int(pid_str)).first()
-            else:
-                db_project = db.query(models.Project).filter(models.Project.mongodb_id == pid_str).first()
-        
-        if db_project:
-            nombre_proyecto_filtro = db_project.name
-            mongo_pid = db_project.mongodb_id
-            logger.info(f"Proyecto identificado: {db_project.name} (DB ID: {db_project.id}, Mongo ID: {mongo_pid})")
-
-        # --- VERIFICACIÓN DE PERMISOS (Director solo ve sus proyectos) ---
-        is_admin_or_super = current_user.role == 'administrador' or getattr(current_user, 'is_superuser', False)
-        if not is_admin_or_super:
-            allowed_pids = [p.mongodb_id for p in current_user.assigned_projects if p.mongodb_id] + \
-                           [p.mongodb_id for p in current_user.owned_projects if p.mongodb_id]
-            
-            if not allowed_pids:
-                raise HTTPException(status_code=403, detail="No tienes proyectos asignados para consultar registros.")
-                
-            if mongo_pid and mongo_pid not in allowed_pids:
-                raise HTTPException(status_code=403, detail="No tienes acceso a los registros de este proyecto.")
-            
-            # Si no solicitó un proyecto específico, restringir la búsqueda a solo sus proyectos permitidos
-            if not mongo_pid:
-                mongo_pid = allowed_pids
-
-        # Crear analizador
-        analizador = crear_analizador_desde_env(kml_base_path="kml_proyectos")
-        
-        # --- CARGAR GEOCERCAS DINÁMICAS DESDE LA DB ---
-        p_obra = None
-        p_ofi = None
-        
-        if db_project:
-            # Buscar capas marcadas como intervención u oficina para este proyecto
-            layers_geofence = db.query(models.Layer).filter(
-                models.Layer.project_id == db_project.id,
-                models.Layer.geofence_type.in_(['intervencion', 'oficina'])
-            ).all()
-            
-            for l in layers_geofence:
-                # Buscar archivo en kml_proyectos o uploads
-                posibles_rutas = [
-                    os.path.join("kml_proyectos", l.file_path),
-                    os.path.join("uploads", l.file_path),
-                    l.file_path # Ruta absoluta si existe
-                ]
-                
-                poly = None
-                for ruta in posibles_rutas:
-                    if os.path.exists(ruta):
-                        poly = analizador.cargar_poligono_geocerca(ruta)
-                        if poly: break
-                
-                if poly:
-                    if l.geofence_type == 'intervencion':
-                        p_obra = poly
-                        logger.info(f"Geocerca de OBRA cargada desde capa: {l.name}")
-                    elif l.geofence_type == 'oficina':
-                        p_ofi = poly
-                        logger.info(f"Geocerca de OFICINA cargada desde capa: {l.name}")
-        
-        # Si no se encontró proyecto en DB pero se tiene un ID directo (fallback)
-        if (not mongo_pid or isinstance(mongo_pid, list)) and request.pid_filtro and not str(request.pid_filtro).isdigit():
-            pid_str = str(request.pid_filtro)
-            if not is_admin_or_super and pid_str not in allowed_pids:
-                raise HTTPException(status_code=403, detail="No tienes acceso a los registros de este proyecto.")
-            mongo_pid = pid_str
-
-        # Generar reporte con polígonos explícitos (si se encontraron)
-        df = analizador.generar_reporte(
-            fecha_inicio=fecha_inicio,
-            fecha_fin=fecha_fin,
-            pid_filtro=mongo_pid,
-            user_filtro=request.user_filtro,
-            nombre_proyecto_filtro=nombre_proyecto_filtro,
-            p_obra_explicit=p_obra,
-            p_ofi_explicit=p_ofi
-        )
+        # Consultas a la BD, MongoDB, clasificación y serialización corren en el
+        # threadpool: el handler es async y no debe bloquear el event loop
+        parametros = await run_in_threadpool(_resolver_parametros_reporte, request, db, current_user)
+        df = await run_in_threadpool(_generar_dataframe_reporte, parametros)
         
         if len(df) == 0:
             return {
@@ -1254,77 +1796,53 @@ async def generar_reporte_registros(
                 "records": []
             }
         
-        # Generar nombre de archivo
+        # Generar nombre base de los archivos
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        nombre_archivo = f"Reporte_Registros_{timestamp}.xlsx"
-        ruta_archivo = os.path.join("report", nombre_archivo)
-        
-        nombre_archivo_kml = f"Reporte_Registros_{timestamp}.kml"
-        ruta_archivo_kml = os.path.join("report", nombre_archivo_kml)
+        ruta_base = os.path.join("report", f"Reporte_Registros_{timestamp}")
         
-        # Guardar Excel y KML
-        analizador.exportar_a_excel(df, ruta_archivo)
-        analizador.exportar_a_kml(df, ruta_archivo_kml)
+        # Escribir los archivos por lotes en un hilo del threadpool (no bloquea el event loop)
+        rutas = await run_in_threadpool(exportar_reporte, df, ruta_base, parametros["formatos_exportacion"])
+        archivos = {fmt: f"/files/{os.path.basename(ruta)}" for fmt, ruta in rutas.items()}
         
         # Generar estadísticas rápidas
-        stats = {
-            "EN OBRA": int((df["Clasificación"] == "EN OBRA").sum()),
-            "EN OFICINA": int((df["Clasificación"] == "EN OFICINA").sum()),
-            "UBICACIÓN EXTERNA": int((df["Clasificación"] == "UBICACIÓN EXTERNA").sum())
-        }
+        stats = await run_in_threadpool(_estadisticas_reporte, df)
         
-        # Convertir DataFrame a registros para el frontend
-        records = []
-        for _, row in df.iterrows():
-            record = {}
-            # Primero pasar todos los campos originales del DF
-            for col in df.columns:
-                value = row[col]
-                if pd.isna(value):
-                    record[col] = None
-                elif isinstance(value, (datetime, pd.Timestamp)):
-                    record[col] = value.strftime("%Y-%m-%d %H:%M:%S")
-                elif isinstance(value, (int, float)):
-                    record[col] = float(value)
-                else:
-                    record[col] = str(value)
-            
-            # Especiales para el mapeo geoespacial del frontend
-            # Si tiene Coordenadas_Google, intentamos crear el objeto coords
-            if "Coordenadas_Google" in record and record["Coordenadas_Google"]:
-                try:
-                    parts = record["Coordenadas_Google"].split(",")
-                    record["coords"] = {
-                        "lat": float(parts[0].strip()),
-                        "lon": float(parts[1].strip())
-                    }
-                except:
-                    pass
-            
-            # Asegurar que project_id y _id estén presentes para el link
-            if "project_id" in record:
-                record["project_id"] = record["project_id"]
-            if "id" in record:
-                record["_id"] = record["id"] # El frontend usa _id a veces
-                
-            records.append(record)
+        if request.formato == "arrow":
+            # Stream Arrow IPC: los metadatos del reporte viajan en cabeceras
+            return Response(
+                content=await run_in_threadpool(dataframe_a_arrow_ipc, df, request.offset, request.limit),
+                media_type=MEDIA_TYPE_ARROW,
+                headers={
+                    "X-Total-Registros": str(len(df)),
+                    "X-Archivos": ",".join(archivos.values()),
+                    "Access-Control-Expose-Headers": "X-Total-Registros, X-Archivos"
+                }
+            )
         
-        # Limpiar cache
-        analizador.limpiar_cache()
+        # Convertir DataFrame a registros para el frontend (columna por columna)
+        records = await run_in_threadpool(registros_desde_dataframe, df, request.offset, request.limit)
         
-        return {
-            "status": "success",
-            "mensaje": f"Reporte generado exitosamente con {len(df)} registros",
-            "archivo": ruta_archivo,
-            "archivo_kml": ruta_archivo_kml,
-            "total_registros": len(df),
-            "estadisticas": stats,
-            "records": records,
-            "url_descarga": f"/files/{nombre_archivo}",
-            "url_descarga_kml": f"/files/{nombre_archivo_kml}",
-            "timestamp": timestamp
-        }
-    
+        return Response(
+            content=await run_in_threadpool(serializar_json, {
+                "status": "success",
+                "mensaje": f"Reporte generado exitosamente con {len(df)} registros",
+                "archivo": rutas.get("xlsx"),
+                "archivo_kml": rutas.get("kml") or rutas.get("kmz"),
+                "archivos": archivos,
+                "total_registros": len(df),
+                "offset": request.offset,
+                "limit": request.limit,
+                "estadisticas": stats,
+                "records": records,
+                "url_descarga": archivos.get("xlsx"),
+                "url_descarga_kml": archivos.get("kml") or archivos.get("kmz"),
+                "timestamp": timestamp
+            }),
+            media_type="application/json"
+        )
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error generando reporte: {str(e)}", exc_info=True)
         return {
@@ -1345,10 +1863,10 @@ async def descargar_reporte(
     **Seguridad:** Solo archivos en la carpeta `/report/` son accesibles.
     
     Args:
-        filename: Nombre del archivo Excel
+        filename: Nombre del archivo (xlsx, kml, kmz, csv, parquet)
         
     Returns:
-        El archivo Excel para descarga
+        El archivo para descarga
     """
     # Validar que el archivo esté en la carpeta de reportes
     ruta_archivo = os.path.join("report", filename)
@@ -1365,7 +1883,146 @@ async def descargar_reporte(
     return FileResponse(
         path=ruta_absoluta,
         filename=filename,
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        media_type=media_type_para(filename)
+    )
+
+
+# --- TRABAJOS ASÍNCRONOS DE REPORTE ---
+
+def _ejecutar_job_reporte(job_id: str, parametros: dict) -> dict:
+    """
+    Ejecuta un reporte dentro del pool de report_jobs.
+    
+    Progreso: 0-10 consulta MongoDB, 10-60 clasificación, 60-95 escritura de archivos.
+    Siempre se escribe además un Parquet con los registros, que alimenta
+    la consulta paginada de registros del trabajo.
+    """
+    report_jobs.actualizar_progreso(job_id, 2, "Consultando registros en MongoDB")
+    
+    def progreso_clasificacion(hechos, total):
+        report_jobs.actualizar_progreso(job_id, 10 + 50 * hechos // max(total, 1), f"Clasificando registros ({hechos}/{total})")
+    
+    df = _generar_dataframe_reporte(parametros, progress_callback=progreso_clasificacion)
+    if len(df) == 0:
+        return {"total_registros": 0, "mensaje": "No se encontraron registros para los criterios especificados"}
+    
+    def progreso_exportacion(hechos, total):
+        report_jobs.actualizar_progreso(job_id, 60 + 35 * hechos // max(total, 1), f"Escribiendo archivos ({hechos}/{total})")
+    
+    report_jobs.actualizar_progreso(job_id, 60, "Escribiendo archivos")
+    ruta_base = os.path.join("report", f"Reporte_Registros_{job_id}")
+    rutas = exportar_reporte(
+        df, ruta_base, parametros["formatos_exportacion"] + ["parquet"],
+        progress_callback=progreso_exportacion
+    )
+    
+    return {
+        "total_registros": len(df),
+        "mensaje": f"Reporte generado exitosamente con {len(df)} registros",
+        "estadisticas": _estadisticas_reporte(df),
+        "archivos": {
+            fmt: f"/api/v1/geographic-records/descargar/{os.path.basename(ruta)}"
+            for fmt, ruta in rutas.items()
+        },
+        "ruta_registros": rutas["parquet"]
+    }
+
+
+def _obtener_job_autorizado(job_id: str, current_user: models.User) -> dict:
+    job = report_jobs.obtener(job_id)
+    is_admin_or_super = current_user.role == 'administrador' or getattr(current_user, 'is_superuser', False)
+    if not job or (not is_admin_or_super and current_user.id not in job["usuarios"]):
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return job
+
+
+def _job_publico(job: dict) -> dict:
+    """Vista del trabajo para el cliente (sin datos internos)."""
+    resultado = dict(job["resultado"] or {})
+    resultado.pop("ruta_registros", None)
+    return {
+        "job_id": job["id"],
+        "estado": job["estado"],
+        "progreso": job["progreso"],
+        "mensaje": job["mensaje"],
+        "deduplicado": job.get("deduplicado", False),
+        "creado": datetime.utcfromtimestamp(job["creado"]).isoformat(),
+        "actualizado": datetime.utcfromtimestamp(job["actualizado"]).isoformat(),
+        "duracion_segundos": job.get("duracion_segundos"),
+        "resultado": resultado or None
+    }
+
+
+@app.post("/api/v1/geographic-records/reportes", status_code=202)
+def crear_trabajo_reporte(
+    request: GenerarReporteRequest,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(check_role(['administrador', 'director']))
+):
+    """
+    Encola la generación de un reporte como trabajo en segundo plano.
+    
+    Si ya existe un trabajo (en curso o terminado) con los mismos parámetros
+    efectivos se devuelve ese mismo trabajo (`deduplicado: true`).
+    Consultar el estado con `GET /api/v1/geographic-records/reportes/{job_id}`;
+    los archivos terminados se descargan desde `/api/v1/geographic-records/descargar/{filename}`.
+    """
+    parametros = _resolver_parametros_reporte(request, db, current_user)
+    job = report_jobs.enviar(parametros, _ejecutar_job_reporte, current_user.id)
+    return _job_publico(job)
+
+
+@app.get("/api/v1/geographic-records/reportes/{job_id}")
+def estado_trabajo_reporte(job_id: str, current_user: models.User = Depends(get_current_user)):
+    """Estado, progreso (0-100) y resultado de un trabajo de reporte."""
+    return _job_publico(_obtener_job_autorizado(job_id, current_user))
+
+
+@app.delete("/api/v1/geographic-records/reportes/{job_id}")
+def cancelar_trabajo_reporte(job_id: str, current_user: models.User = Depends(get_current_user)):
+    """Solicita la cancelación de un trabajo pendiente o en proceso."""
+    _obtener_job_autorizado(job_id, current_user)
+    report_jobs.cancelar(job_id)
+    return _job_publico(report_jobs.obtener(job_id))
+
+
+@app.get("/api/v1/geographic-records/reportes/{job_id}/registros")
+def registros_trabajo_reporte(
+    job_id: str,
+    offset: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1),
+    formato: str = Query("json"),
+    current_user: models.User = Depends(get_current_user)
+):
+    """Registros de un trabajo terminado, paginados (JSON o Arrow IPC)."""
+    job = _obtener_job_autorizado(job_id, current_user)
+    if job["estado"] != "completado":
+        raise HTTPException(status_code=409, detail=f"El trabajo está en estado '{job['estado']}'")
+    
+    # Un trabajo sin registros termina sin archivo de registros: página vacía
+    ruta_registros = (job.get("resultado") or {}).get("ruta_registros")
+    if ruta_registros is None:
+        df, total = pd.DataFrame(), 0
+    elif not os.path.exists(ruta_registros):
+        raise HTTPException(status_code=410, detail="Los registros del trabajo ya no están disponibles")
+    else:
+        df, total = leer_registros_parquet(ruta_registros, offset, limit)
+    
+    if formato == "arrow":
+        return Response(
+            content=dataframe_a_arrow_ipc(df),
+            media_type=MEDIA_TYPE_ARROW,
+            headers={"X-Total-Registros": str(total), "Access-Control-Expose-Headers": "X-Total-Registros"}
+        )
+    
+    return Response(
+        content=serializar_json({
+            "total_registros": total,
+            "offset": offset,
+            "limit": limit,
+            "records": registros_desde_dataframe(df)
+        }),
+        media_type="application/json"
     )
 
 
@@ -1390,6 +2047,7 @@ async def obtener_info_analizador():
             "db_name": db_name,
             "mongo_port": mongo_port,
             "kml_base_path": "uploads",
+            "geocercas": geofence_cache.metricas(),
             "mensaje": "Sistema de análisis geográfico configurado"
         }
     except Exception as e:
@@ -1412,6 +2070,8 @@ async def get_mongodb_projects(
 
 @app.post("/api/v1/geographic-records/sync-mongodb-data")
 async def sync_mongodb_data(
+    dry_run: bool = False,
+    incremental: bool = False,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(check_role(['administrador']))
 ):
@@ -1419,144 +2079,71 @@ async def sync_mongodb_data(
     Sincroniza proyectos y usuarios de MongoDB a PostgreSQL (Geovisor).
     Crea los proyectos si no existen e importa los usuarios asignándoles acceso.
     Utiliza mongodb_id para evitar duplicados.
+    
+    El diff se calcula en memoria y se aplica en una sola transacción con
+    inserciones masivas (ON CONFLICT). Con dry_run=true solo devuelve el diff.
+    Con incremental=true solo se leen los documentos posteriores a la última
+    marca de agua de cada colección.
     """
-    try:
+    def ejecutar():
         analizador = crear_analizador_desde_env()
+        if incremental:
+            return sincronizar_incremental(analizador, db, owner_id=current_user.id, dry_run=dry_run)
         
         # 1. Obtener datos de MongoDB
+        t = time.perf_counter()
         mongo_projects = analizador.obtener_proyectos_mongodb()
         mongo_users = analizador.obtener_usuarios_y_proyectos()
+        tiempos = {"lectura_mongodb_s": round(time.perf_counter() - t, 3)}
         
-        results = {
-            "projects_created": 0,
-            "projects_updated": 0,
-            "users_created": 0,
-            "users_updated": 0,
-            "assignments_created": 0,
-            "errors": []
-        }
-        
-        # Map to store mongo_project_id -> postgres_project_id
-        project_map = {}
-        
-        # 2. Sincronizar Proyectos y sus Usuarios internos
-        for m_proy in mongo_projects:
-            m_id = str(m_proy["_id"])
-            name = m_proy.get("name", "Sin nombre")
-            description = m_proy.get("description", "")
-            m_users = m_proy.get("users", []) # Lista de usuarios dentro del proyecto
-            
-            # Buscar por mongodb_id preferiblemente, luego por nombre (migración)
-            db_proy = db.query(models.Project).filter(
-                (models.Project.mongodb_id == m_id) | (models.Project.name == name)
-            ).first()
-            
-            if not db_proy:
-                # Crear proyecto
-                new_proy = models.Project(
-                    name=name,
-                    description=description,
-                    owner_id=current_user.id,
-                    mongodb_id=m_id
-                )
-                db.add(new_proy)
-                db.flush() 
-                db_proy = new_proy
-                results["projects_created"] += 1
-            else:
-                # Actualizar si ya existe
-                db_proy.mongodb_id = m_id
-                if not db_proy.description:
-                    db_proy.description = description
-                results["projects_updated"] += 1
-            
-            project_map[m_id] = db_proy.id
-
-            # Sincronizar usuarios LISTADOS DENTRO del proyecto
-            for m_u in m_users:
-                u_email = m_u.get("email")
-                if not u_email: continue
-                
-                u_email = u_email.strip().lower()
-                if not u_email or '@' not in u_email: continue
-
-                # Buscar por email primero
-                db_user = db.query(models.User).filter(models.User.email == u_email).first()
-                if not db_user:
-                    # Si no existe por email, verificar si el username está tomado
-                    base_username = u_email.split('@')[0]
-                    u_count = 0
-                    final_username = base_username
-                    while db.query(models.User).filter(models.User.username == final_username).first():
-                        u_count += 1
-                        final_username = f"{base_username}{u_count}"
-                    
-                    import uuid
-                    user_in = schemas.UserCreate(
-                        email=u_email,
-                        username=final_username,
-                        full_name=base_username,
-                        password=str(uuid.uuid4())[:12],
-                        role="usuario"
-                    )
-                    db_user = crud.create_user(db, user_in)
-                    results["users_created"] += 1
-                
-                # Asignar al proyecto si no está
-                is_assigned = db.query(models.user_projects).filter(
-                    models.user_projects.c.user_id == db_user.id,
-                    models.user_projects.c.project_id == db_proy.id
-                ).first()
-                
-                if not is_assigned:
-                    crud.assign_user_to_project(db, db_user.id, db_proy.id)
-                    results["assignments_created"] += 1
-
-        # 3. Sincronizar resto de Usuarios desde la colección users (Opcional, para asegurar perfiles completos)
-        for m_user in mongo_users:
-            email = m_user.get("email")
-            display_name = m_user.get("displayName", "")
-            m_projects = m_user.get("projects", [])
-            m_u_id = str(m_user.get("_id", ""))
-            
-            if not email: continue
-            email = email.strip().lower()
-            if not email or '@' not in email: continue
-                
-            db_user = db.query(models.User).filter(
-                (models.User.mongodb_id == m_u_id) | (models.User.email == email)
-            ).first()
-            
-            if db_user:
-                db_user.mongodb_id = m_u_id
-                if not db_user.full_name or db_user.full_name == db_user.username:
-                    db_user.full_name = display_name
-                
-                # También asignar proyectos que el usuario diga tener
-                for m_pid in m_projects:
-                    m_pid_str = str(m_pid)
-                    if m_pid_str in project_map:
-                        p_id = project_map[m_pid_str]
-                        is_assigned = db.query(models.user_projects).filter(
-                            models.user_projects.c.user_id == db_user.id,
-                            models.user_projects.c.project_id == p_id
-                        ).first()
-                        if not is_assigned:
-                            crud.assign_user_to_project(db, db_user.id, p_id)
-                            results["assignments_created"] += 1
-        
-        db.commit()
+        # 2. Diff y aplicación en bloque
+        motor = MongoSyncEngine(db, owner_id=current_user.id)
+        return motor.sincronizar(mongo_projects, mongo_users, dry_run=dry_run, tiempos=tiempos)
+    
+    try:
+        resultado = await run_in_threadpool(ejecutar)
         return {
             "status": "success",
-            "message": "Sincronización completada exitosamente",
-            "results": results
+            "message": "Diff calculado (sin cambios aplicados)" if dry_run else "Sincronización completada exitosamente",
+            **resultado
         }
-        
     except Exception as e:
         db.rollback()
         logger.error(f"Error en sincronización: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/api/v1/geographic-records/sync-mongodb-data/estado")
+def estado_sync_mongodb(current_user: models.User = Depends(check_role(['administrador']))):
+    """Marcas de agua, modo y resultado de la última sincronización incremental."""
+    return {
+        "intervalo_minutos": MONGO_SYNC_INTERVAL_MINUTES,
+        **marcas_de_agua.estado()
+    }
+
+
+@app.delete("/api/v1/geographic-records/sync-mongodb-data/estado")
+def reiniciar_sync_mongodb(current_user: models.User = Depends(check_role(['administrador']))):
+    """Borra las marcas de agua: la próxima sincronización incremental lee todo."""
+    marcas_de_agua.reiniciar()
+    return {"status": "success", "message": "Marcas de agua reiniciadas"}
+
+
+# Sincronización periódica (MONGO_SYNC_INTERVAL_MINUTES > 0); un solo worker ejecuta
+mongo_sync_scheduler = MongoSyncScheduler(
+    sync_cache, SessionLocal, crear_analizador_desde_env, MONGO_SYNC_INTERVAL_MINUTES
+)
+
+
+@app.on_event("startup")
+def iniciar_sync_mongodb():
+    mongo_sync_scheduler.iniciar()
+
+
+@app.on_event("shutdown")
+def detener_sync_mongodb():
+    mongo_sync_scheduler.detener()
+
 if __name__ == "__main__":
     import uvicorn
     # Desactivamos reload para evitar reinicios constantes durante el procesamiento de tiles/uploads
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Table, JSON
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, DateTime, Table, JSON
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from geoalchemy2 import Geometry
@@ -162,3 +163,20 @@ class Measurement(Base):
     # Relaciones
     project = relationship("Project", back_populates="measurements")
     folder = relationship("Folder", back_populates="measurements")
+
+class VectorFeature(Base):
+    """
+    Elementos de capas vectoriales (KML/KMZ, SHP, ...) cargados en PostGIS para
+    servirlos como vector tiles (ST_AsMVT) en lugar de enviar el archivo completo.
+    """
+    __tablename__ = "vector_features"
+
+    id = Column(BigInteger, primary_key=True)
+    layer_id = Column(Integer, ForeignKey("layers.id", ondelete="CASCADE"), nullable=False, index=True)
+    name = Column(String, nullable=True)
+
+    # Atributos del elemento (descripción, campos del SHP, etc.), se publican en el MVT
+    properties = Column(JSONB, nullable=True)
+
+    # En Web Mercator (EPSG:3857): los tiles se recortan sin transformar en cada solicitud
+    geom = Column(Geometry(srid=3857), nullable=False)
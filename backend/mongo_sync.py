@@ -0,0 +1,719 @@
+"""
+Sincronización masiva MongoDB -> PostgreSQL (proyectos, usuarios y asignaciones).
+
+En lugar de consultar la base de datos por cada proyecto, usuario y
+asignación, el motor:
+
+1. Carga una sola vez el estado actual de PostgreSQL en diccionarios
+   (proyectos por mongodb_id/nombre, usuarios por email/mongodb_id/username
+   y el conjunto de asignaciones existentes).
+2. Calcula en memoria el diff contra los documentos de MongoDB (el "plan").
+3. Aplica el plan en una única transacción con INSERT masivos
+   ON CONFLICT y UPDATE por clave primaria en lote.
+
+Con dry_run=True solo se calcula y devuelve el plan, sin escribir nada.
+
+Modo incremental: se guarda una marca de agua por colección (el mayor `_id`
+o fecha de actualización procesado) en un diskcache compartido y solo se leen
+los documentos posteriores. Opcionalmente, si MongoDB es un replica set, se
+puede seguir un change stream y aplicar los cambios en lotes. Un planificador
+en segundo plano (un solo worker a la vez) ejecuta la sincronización cada
+MONGO_SYNC_INTERVAL_MINUTES.
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+import crud
+import models
+from shared import sync_cache
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Filas por sentencia INSERT (PostgreSQL admite como máximo 65535 parámetros)
+TAMANO_LOTE_SQL = 1000
+# Máximo de elementos listados por categoría en el reporte de diff
+MAX_DETALLE = 200
+
+
+def _lotes(filas: List[Any], tamano: int = TAMANO_LOTE_SQL) -> Iterator[List[Any]]:
+    for i in range(0, len(filas), tamano):
+        yield filas[i:i + tamano]
+
+
+def _normalizar_email(email: Optional[str]) -> Optional[str]:
+    if not email:
+        return None
+    email = email.strip().lower()
+    return email if email and '@' in email else None
+
+
+class EstadoPostgres:
+    """Instantánea en memoria de proyectos, usuarios y asignaciones."""
+
+    def __init__(self, db: Session):
+        self.proyectos_por_mongo: Dict[str, Dict[str, Any]] = {}
+        self.proyectos_por_nombre: Dict[str, Dict[str, Any]] = {}
+        for p in db.execute(select(
+            models.Project.id, models.Project.name, models.Project.description, models.Project.mongodb_id
+        )).mappings():
+            p = dict(p)
+            if p["mongodb_id"]:
+                self.proyectos_por_mongo[p["mongodb_id"]] = p
+            # Para la migración por nombre se conserva el primero (como .first())
+            self.proyectos_por_nombre.setdefault(p["name"], p)
+
+        self.usuarios_por_email: Dict[str, Dict[str, Any]] = {}
+        self.usuarios_por_mongo: Dict[str, Dict[str, Any]] = {}
+        self.usernames = set()
+        for u in db.execute(select(
+            models.User.id, models.User.email, models.User.username,
+            models.User.full_name, models.User.mongodb_id
+        )).mappings():
+            u = dict(u)
+            self.usuarios_por_email[u["email"]] = u
+            if u["mongodb_id"]:
+                self.usuarios_por_mongo[u["mongodb_id"]] = u
+            self.usernames.add(u["username"])
+
+        self.asignaciones = set(
+            db.execute(select(models.user_projects.c.user_id, models.user_projects.c.project_id)).all()
+        )
+
+
+def filas_usuarios_nuevos(plan: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Filas para el INSERT de usuarios nuevos.
+
+    Las cuentas sincronizadas se crean con contraseña inutilizable (sin bcrypt):
+    entran con Google o cuando un administrador les asigna una contraseña.
+    """
+    return [{**u, "hashed_password": crud.make_unusable_password()} for u in plan["usuarios_crear"].values()]
+
+
+class MongoSyncEngine:
+    """Calcula y aplica el diff MongoDB -> PostgreSQL en bloque."""
+
+    def __init__(self, db: Session, owner_id: int):
+        self.db = db
+        self.owner_id = owner_id
+
+    # --- 1. Diff en memoria ---
+    def calcular_plan(
+        self,
+        estado: EstadoPostgres,
+        mongo_projects: Iterable[Dict[str, Any]],
+        mongo_users: Iterable[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """
+        Calcula las operaciones necesarias sin tocar la base de datos.
+
+        Los proyectos y usuarios nuevos se identifican por su clave natural
+        (mongodb_id / email) porque aún no tienen id de PostgreSQL; las
+        asignaciones se expresan como pares de esas claves.
+
+        Returns:
+            Plan con proyectos/usuarios a crear y actualizar y asignaciones nuevas
+        """
+        proyectos_crear: Dict[str, Dict[str, Any]] = {}
+        proyectos_actualizar: Dict[int, Dict[str, Any]] = {}
+        usuarios_crear: Dict[str, Dict[str, Any]] = {}
+        usuarios_actualizar: Dict[int, Dict[str, Any]] = {}
+        asignaciones: set = set()
+        errores: List[str] = []
+        proyectos_omitidos: List[str] = []
+
+        # Clave de proyecto en el plan: ("id", pk) si existe, ("mongo", m_id) si es nuevo
+        clave_proyecto: Dict[str, Tuple[str, Any]] = {}
+        proyectos_reclamados = set()
+        usernames = set(estado.usernames)
+
+        def clave_usuario(email: str) -> Tuple[str, Any]:
+            existente = estado.usuarios_por_email.get(email)
+            return ("id", existente["id"]) if existente else ("email", email)
+
+        def agregar_asignacion(k_usuario: Tuple[str, Any], k_proyecto: Tuple[str, Any]):
+            if k_usuario[0] == "id" and k_proyecto[0] == "id" and \
+                    (k_usuario[1], k_proyecto[1]) in estado.asignaciones:
+                return
+            asignaciones.add((k_usuario, k_proyecto))
+
+        # Proyectos y los usuarios listados dentro de cada uno
+        for m_proy in mongo_projects:
+            m_id = str(m_proy["_id"])
+            name = m_proy.get("name", "Sin nombre")
+            description = m_proy.get("description", "")
+
+            # Buscar por mongodb_id, luego por nombre (solo proyectos aún sin mongodb_id)
+            db_proy = estado.proyectos_por_mongo.get(m_id)
+            if db_proy is None:
+                candidato = estado.proyectos_por_nombre.get(name)
+                if candidato and not candidato["mongodb_id"] and candidato["id"] not in proyectos_reclamados:
+                    db_proy = candidato
+
+            if db_proy is None and self.owner_id is None:
+                # Sin propietario el INSERT fallaría (owner_id NOT NULL) y con él toda la transacción
+                proyectos_omitidos.append(m_id)
+                errores.append(f"Proyecto {m_id} ({name}) omitido: no hay propietario (MONGO_SYNC_OWNER_ID o un administrador)")
+                continue
+
+            if db_proy is None:
+                proyectos_crear[m_id] = {
+                    "name": name,
+                    "description": description,
+                    "owner_id": self.owner_id,
+                    "mongodb_id": m_id,
+                }
+                clave_proyecto[m_id] = ("mongo", m_id)
+            else:
+                proyectos_reclamados.add(db_proy["id"])
+                cambios = {}
+                if db_proy["mongodb_id"] != m_id:
+                    cambios["mongodb_id"] = m_id
+                if not db_proy["description"] and description:
+                    cambios["description"] = description
+                if cambios:
+                    proyectos_actualizar[db_proy["id"]] = {"id": db_proy["id"], **cambios}
+                clave_proyecto[m_id] = ("id", db_proy["id"])
+
+            for m_u in m_proy.get("users", []) or []:
+                email = _normalizar_email(m_u.get("email"))
+                if not email:
+                    continue
+                if email not in estado.usuarios_por_email and email not in usuarios_crear:
+                    base_username = email.split('@')[0]
+                    final_username = base_username
+                    contador = 0
+                    while final_username in usernames:
+                        contador += 1
+                        final_username = f"{base_username}{contador}"
+                    usernames.add(final_username)
+                    usuarios_crear[email] = {
+                        "email": email,
+                        "username": final_username,
+                        "full_name": base_username,
+                        "role": "usuario",
+                        "is_active": True,
+                        "mongodb_id": None,
+                    }
+                agregar_asignacion(clave_usuario(email), clave_proyecto[m_id])
+
+        # Perfiles de la colección users (solo usuarios ya existentes o recién creados)
+        mongo_ids_usados = set(estado.usuarios_por_mongo)
+        for m_user in mongo_users:
+            email = _normalizar_email(m_user.get("email"))
+            if not email:
+                continue
+            m_u_id = str(m_user.get("_id", ""))
+            display_name = m_user.get("displayName", "")
+
+            db_user = estado.usuarios_por_mongo.get(m_u_id) or estado.usuarios_por_email.get(email)
+            if db_user is not None:
+                cambios = {}
+                if db_user["mongodb_id"] != m_u_id:
+                    if m_u_id in mongo_ids_usados:
+                        errores.append(f"mongodb_id {m_u_id} ya asignado a otro usuario ({email})")
+                    else:
+                        cambios["mongodb_id"] = m_u_id
+                        mongo_ids_usados.add(m_u_id)
+                if (not db_user["full_name"] or db_user["full_name"] == db_user["username"]) \
+                        and display_name and display_name != db_user["full_name"]:
+                    cambios["full_name"] = display_name
+                if cambios:
+                    usuarios_actualizar.setdefault(db_user["id"], {"id": db_user["id"]}).update(cambios)
+                k_usuario = ("id", db_user["id"])
+            elif email in usuarios_crear:
+                nuevo = usuarios_crear[email]
+                if m_u_id and m_u_id not in mongo_ids_usados:
+                    nuevo["mongodb_id"] = m_u_id
+                    mongo_ids_usados.add(m_u_id)
+                if nuevo["full_name"] == nuevo["username"] and display_name:
+                    nuevo["full_name"] = display_name
+                k_usuario = ("email", email)
+            else:
+                continue
+
+            # También asignar proyectos que el usuario diga tener (en una
+            # sincronización incremental el proyecto puede no venir en el lote)
+            for m_pid in m_user.get("projects", []) or []:
+                k_proyecto = clave_proyecto.get(str(m_pid))
+                if k_proyecto is None and str(m_pid) in estado.proyectos_por_mongo:
+                    k_proyecto = ("id", estado.proyectos_por_mongo[str(m_pid)]["id"])
+                if k_proyecto:
+                    agregar_asignacion(k_usuario, k_proyecto)
+
+        return {
+            "proyectos_crear": proyectos_crear,
+            "proyectos_actualizar": proyectos_actualizar,
+            "usuarios_crear": usuarios_crear,
+            "usuarios_actualizar": usuarios_actualizar,
+            "asignaciones": asignaciones,
+            "proyectos_omitidos": proyectos_omitidos,
+            "errores": errores,
+        }
+
+    # --- 2. Aplicación en bloque ---
+    def aplicar_plan(self, plan: Dict[str, Any]) -> Dict[str, int]:
+        """
+        Aplica el plan en la transacción de la sesión (el commit lo hace el llamador).
+
+        Returns:
+            Conteo de filas afectadas por tipo de operación
+        """
+        db = self.db
+        ids_proyectos: Dict[str, int] = {}
+        ids_usuarios: Dict[str, int] = {}
+
+        # Proyectos nuevos; DO UPDATE (no-op) para que RETURNING incluya
+        # también los que otro proceso haya creado en paralelo
+        filas = list(plan["proyectos_crear"].values())
+        for lote in _lotes(filas):
+            stmt = pg_insert(models.Project).values(lote)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[models.Project.mongodb_id],
+                set_={"mongodb_id": stmt.excluded.mongodb_id}
+            ).returning(models.Project.id, models.Project.mongodb_id)
+            ids_proyectos.update({m_id: pk for pk, m_id in db.execute(stmt)})
+
+        if plan["proyectos_actualizar"]:
+            db.execute(update(models.Project), list(plan["proyectos_actualizar"].values()))
+
+        # Usuarios nuevos
+        filas = filas_usuarios_nuevos(plan)
+        for lote in _lotes(filas):
+            stmt = pg_insert(models.User).values(lote)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[models.User.email],
+                set_={"email": stmt.excluded.email}
+            ).returning(models.User.id, models.User.email)
+            ids_usuarios.update({email: pk for pk, email in db.execute(stmt)})
+
+        if plan["usuarios_actualizar"]:
+            db.execute(update(models.User), list(plan["usuarios_actualizar"].values()))
+
+        # Asignaciones: resolver claves naturales a ids y DO NOTHING si ya existen
+        def resolver(clave: Tuple[str, Any], ids: Dict[str, int]) -> Optional[int]:
+            return clave[1] if clave[0] == "id" else ids.get(clave[1])
+
+        filas = []
+        for k_usuario, k_proyecto in plan["asignaciones"]:
+            user_id = resolver(k_usuario, ids_usuarios)
+            project_id = resolver(k_proyecto, ids_proyectos)
+            if user_id and project_id:
+                filas.append({"user_id": user_id, "project_id": project_id})
+
+        asignaciones_creadas = 0
+        for lote in _lotes(filas):
+            resultado = db.execute(pg_insert(models.user_projects).values(lote).on_conflict_do_nothing())
+            asignaciones_creadas += resultado.rowcount or 0
+
+        return {
+            "projects_created": len(ids_proyectos),
+            "projects_updated": len(plan["proyectos_actualizar"]),
+            "users_created": len(ids_usuarios),
+            "users_updated": len(plan["usuarios_actualizar"]),
+            "assignments_created": asignaciones_creadas,
+        }
+
+    # --- 3. Reporte ---
+    @staticmethod
+    def resumen_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+        """Reporte de diff legible (dry-run): conteos y una muestra de cada categoría."""
+        def muestra(valores):
+            valores = list(valores)
+            return valores[:MAX_DETALLE]
+
+        return {
+            "projects_to_create": len(plan["proyectos_crear"]),
+            "projects_to_update": len(plan["proyectos_actualizar"]),
+            "users_to_create": len(plan["usuarios_crear"]),
+            "users_to_update": len(plan["usuarios_actualizar"]),
+            "assignments_to_create": len(plan["asignaciones"]),
+            "projects_skipped": len(plan["proyectos_omitidos"]),
+            "detalle": {
+                "proyectos_crear": muestra(
+                    {"mongodb_id": m_id, "name": p["name"]} for m_id, p in plan["proyectos_crear"].items()
+                ),
+                "proyectos_actualizar": muestra(plan["proyectos_actualizar"].values()),
+                "usuarios_crear": muestra(
+                    {"email": u["email"], "username": u["username"]} for u in plan["usuarios_crear"].values()
+                ),
+                "usuarios_actualizar": muestra(plan["usuarios_actualizar"].values()),
+            },
+            "errors": plan["errores"],
+        }
+
+    def sincronizar(
+        self,
+        mongo_projects: List[Dict[str, Any]],
+        mongo_users: List[Dict[str, Any]],
+        dry_run: bool = False,
+        tiempos: Optional[Dict[str, float]] = None
+    ) -> Dict[str, Any]:
+        """
+        Ejecuta carga de estado, diff y aplicación en una sola transacción.
+
+        Args:
+            mongo_projects: Documentos de la colección projects
+            mongo_users: Documentos de la colección users
+            dry_run: Si es True solo devuelve el diff y no escribe
+            tiempos: Tiempos previos (p. ej. lectura de MongoDB) a incluir en el reporte
+
+        Returns:
+            Diccionario con el diff, los conteos aplicados y los tiempos por fase
+        """
+        tiempos = dict(tiempos or {})
+        inicio = time.perf_counter()
+
+        t = time.perf_counter()
+        estado = EstadoPostgres(self.db)
+        tiempos["carga_postgres_s"] = round(time.perf_counter() - t, 3)
+
+        t = time.perf_counter()
+        plan = self.calcular_plan(estado, mongo_projects, mongo_users)
+        tiempos["diff_s"] = round(time.perf_counter() - t, 3)
+        if plan["proyectos_omitidos"]:
+            logger.warning(
+                f"⚠️ {len(plan['proyectos_omitidos'])} proyectos nuevos de MongoDB omitidos: "
+                f"no hay propietario (MONGO_SYNC_OWNER_ID o un administrador)"
+            )
+
+        resultado = {"dry_run": dry_run, "diff": self.resumen_plan(plan)}
+
+        if dry_run:
+            self.db.rollback()
+            resultado["results"] = None
+        else:
+            t = time.perf_counter()
+            try:
+                conteos = self.aplicar_plan(plan)
+                self.db.commit()
+                user_cache.invalidar()
+            except Exception:
+                self.db.rollback()
+                raise
+            tiempos["aplicar_s"] = round(time.perf_counter() - t, 3)
+            resultado["results"] = {**conteos, "errors": plan["errores"]}
+
+        tiempos["sincronizacion_s"] = round(time.perf_counter() - inicio, 3)
+        resultado["timings"] = tiempos
+        logger.info(
+            f"🔄 Sincronización MongoDB {'(dry-run) ' if dry_run else ''}completada: "
+            f"{resultado['diff']['projects_to_create']} proyectos nuevos, "
+            f"{resultado['diff']['users_to_create']} usuarios nuevos, "
+            f"{resultado['diff']['assignments_to_create']} asignaciones en {tiempos['sincronizacion_s']}s"
+        )
+        return resultado
+
+
+# --- Sincronización incremental ---
+
+# Campo usado como marca de agua por colección: la fecha de actualización
+# (timestamps de Mongoose), para detectar también documentos modificados, como
+# un usuario agregado a la lista de miembros de un proyecto existente. Con
+# '_id' (ObjectId, creciente) solo se detectarían documentos nuevos.
+CAMPOS_MARCA_AGUA = {
+    "projects": os.getenv("MONGO_SYNC_PROJECTS_FIELD", "updatedAt"),
+    "users": os.getenv("MONGO_SYNC_USERS_FIELD", "updatedAt"),
+}
+MONGO_SYNC_INTERVAL_MINUTES = float(os.getenv("MONGO_SYNC_INTERVAL_MINUTES", 0))
+MONGO_SYNC_CHANGE_STREAMS = os.getenv("MONGO_SYNC_CHANGE_STREAMS", "false").lower() == "true"
+# Máximo de segundos que se acumulan cambios del change stream antes de aplicarlos
+CHANGE_STREAM_LOTE_SEGUNDOS = float(os.getenv("MONGO_SYNC_CHANGE_STREAM_BATCH_SECONDS", 10))
+
+
+class MarcasDeAgua:
+    """Marca de agua por colección persistida en el diskcache compartido."""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def obtener(self, coleccion: str) -> Any:
+        marca = self._cache.get(f"marca:{coleccion}")
+        # Si cambió el campo configurado la marca anterior no es comparable
+        if marca and marca["campo"] == CAMPOS_MARCA_AGUA[coleccion]:
+            return marca["valor"]
+        return None
+
+    def guardar(self, coleccion: str, valor: Any):
+        if valor is not None:
+            self._cache.set(f"marca:{coleccion}", {"campo": CAMPOS_MARCA_AGUA[coleccion], "valor": valor})
+
+    def reiniciar(self):
+        for coleccion in CAMPOS_MARCA_AGUA:
+            self._cache.delete(f"marca:{coleccion}")
+        self.descartar_token_change_stream()
+
+    def token_change_stream(self) -> Optional[Dict[str, Any]]:
+        return self._cache.get("change_stream:token")
+
+    def guardar_token_change_stream(self, token: Optional[Dict[str, Any]]):
+        if token:
+            self._cache.set("change_stream:token", token)
+
+    def descartar_token_change_stream(self):
+        self._cache.delete("change_stream:token")
+
+    def estado(self) -> Dict[str, Any]:
+        return {
+            "marcas": {
+                c: {"campo": CAMPOS_MARCA_AGUA[c], "valor": None if v is None else str(v)}
+                for c, v in ((c, self.obtener(c)) for c in CAMPOS_MARCA_AGUA)
+            },
+            "change_stream_activo": self.token_change_stream() is not None,
+            "ultima_sincronizacion": self._cache.get("ultima_sincronizacion"),
+        }
+
+
+marcas_de_agua = MarcasDeAgua(sync_cache)
+
+
+def _propietario_por_defecto(db: Session) -> Optional[int]:
+    """Propietario de proyectos creados por la sincronización automática."""
+    owner_id = os.getenv("MONGO_SYNC_OWNER_ID")
+    if owner_id:
+        return int(owner_id)
+    return db.execute(
+        select(models.User.id)
+        .where((models.User.role == 'administrador') | (models.User.is_superuser.is_(True)))
+        .order_by(models.User.id)
+        .limit(1)
+    ).scalar()
+
+
+def sincronizar_incremental(
+    analizador,
+    db: Session,
+    owner_id: Optional[int] = None,
+    dry_run: bool = False
+) -> Dict[str, Any]:
+    """
+    Sincroniza solo los documentos posteriores a la marca de agua de cada colección.
+
+    La marca avanza únicamente después de confirmar la transacción, de modo
+    que un fallo vuelve a procesar el mismo lote en la siguiente ejecución.
+    La de projects tampoco avanza si se omitieron proyectos nuevos por falta
+    de propietario: se reintentan cuando exista uno.
+
+    Los miembros de los proyectos leídos se completan con su perfil de la
+    colección users aunque este no haya cambiado: los usuarios se crean a
+    partir de la membresía y su perfil puede haber pasado la marca antes.
+    """
+    from geographic_records import normalizar_proyecto_mongodb, normalizar_usuario_mongodb
+
+    owner_id = owner_id or _propietario_por_defecto(db)
+    tiempos = {}
+    t = time.perf_counter()
+    documentos = {}
+    nuevas_marcas = {}
+    for coleccion, campo in CAMPOS_MARCA_AGUA.items():
+        docs = analizador.obtener_documentos_modificados(coleccion, campo, marcas_de_agua.obtener(coleccion))
+        # Ordenados por el campo: el último tiene la nueva marca
+        nuevas_marcas[coleccion] = docs[-1].get(campo) if docs else None
+        if docs and nuevas_marcas[coleccion] is None:
+            logger.warning(
+                f"⚠️ Los documentos de {coleccion} no tienen el campo '{campo}': la marca de agua "
+                f"no avanza y cada ejecución lee la colección completa"
+            )
+        documentos[coleccion] = docs
+
+    emails_leidos = {_normalizar_email(u.get("email")) for u in documentos["users"]}
+    miembros = {
+        m_u["email"] for p in documentos["projects"] for m_u in p.get("users", []) or []
+        if isinstance(m_u, dict) and _normalizar_email(m_u.get("email")) not in emails_leidos | {None}
+    }
+    perfiles_miembros = analizador.obtener_usuarios_por_email(list(miembros)) if miembros else []
+    tiempos["lectura_mongodb_s"] = round(time.perf_counter() - t, 3)
+
+    mongo_projects = [normalizar_proyecto_mongodb(p) for p in documentos["projects"]]
+    mongo_users = [normalizar_usuario_mongodb(u) for u in documentos["users"] + perfiles_miembros]
+
+    resultado = MongoSyncEngine(db, owner_id).sincronizar(
+        mongo_projects, mongo_users, dry_run=dry_run, tiempos=tiempos
+    )
+    resultado["incremental"] = True
+    resultado["documentos_leidos"] = {c: len(d) for c, d in documentos.items()}
+    resultado["documentos_leidos"]["perfiles_miembros"] = len(perfiles_miembros)
+
+    if not dry_run:
+        if resultado["diff"]["projects_skipped"]:
+            nuevas_marcas["projects"] = None
+        for coleccion, valor in nuevas_marcas.items():
+            marcas_de_agua.guardar(coleccion, valor)
+        sync_cache.set("ultima_sincronizacion", {
+            "fecha": time.time(),
+            "modo": "incremental",
+            "documentos_leidos": resultado["documentos_leidos"],
+            "results": resultado["results"],
+        })
+    return resultado
+
+
+def seguir_change_stream(
+    analizador,
+    session_factory,
+    detener: threading.Event,
+    renovar_liderazgo: Optional[Callable[[], bool]] = None,
+    ponerse_al_dia: Optional[Callable[[], Any]] = None
+):
+    """
+    Sigue el change stream de projects/users y aplica los cambios por lotes.
+
+    Requiere que MongoDB sea un replica set; si no lo es, pymongo lanza
+    OperationFailure y el llamador vuelve al modo por marca de agua. El
+    resume token se guarda después de cada lote confirmado.
+
+    Sin resume token guardado el stream empieza en el momento de abrirlo, así
+    que con el stream ya abierto se llama a ponerse_al_dia (la sincronización
+    por marca de agua) para aplicar lo ocurrido desde la última ejecución; los
+    cambios que lleguen mientras tanto se vuelven a aplicar desde el stream.
+
+    renovar_liderazgo se llama en cada evento y en cada espera sin eventos;
+    si devuelve False se deja de seguir el stream sin aplicar el lote en
+    curso (el nuevo líder lo retoma desde el último resume token guardado).
+    """
+    from geographic_records import (
+        normalizar_proyecto_mongodb, normalizar_usuario_mongodb, PROYECCION_PROYECTOS, PROYECCION_USUARIOS
+    )
+    campos = {"projects": PROYECCION_PROYECTOS, "users": PROYECCION_USUARIOS}
+
+    pipeline = [{"$match": {
+        "ns.coll": {"$in": list(CAMPOS_MARCA_AGUA)},
+        "operationType": {"$in": ["insert", "update", "replace"]},
+    }}]
+
+    token = marcas_de_agua.token_change_stream()
+    with analizador.conexion_mongodb() as mongo_db:
+        with mongo_db.watch(
+            pipeline,
+            full_document="updateLookup",
+            resume_after=token,
+            max_await_time_ms=1000
+        ) as stream:
+            if token is None and ponerse_al_dia is not None:
+                ponerse_al_dia()
+                marcas_de_agua.guardar_token_change_stream(stream.resume_token)
+            logger.info("🔄 Siguiendo change stream de MongoDB (projects, users)")
+            while not detener.is_set():
+                proyectos: Dict[str, Dict[str, Any]] = {}
+                usuarios: Dict[str, Dict[str, Any]] = {}
+                limite = time.monotonic() + CHANGE_STREAM_LOTE_SEGUNDOS
+                while time.monotonic() < limite and not detener.is_set():
+                    cambio = stream.try_next()
+                    if renovar_liderazgo is not None and not renovar_liderazgo():
+                        logger.warning("🔄 Liderazgo de sincronización perdido, se deja de seguir el change stream")
+                        return
+                    if cambio is None:
+                        if proyectos or usuarios:
+                            break
+                        continue
+                    doc = cambio.get("fullDocument")
+                    if not doc:
+                        continue
+                    coleccion = cambio["ns"]["coll"]
+                    doc = {k: doc[k] for k in ("_id", *campos[coleccion]) if k in doc}
+                    if coleccion == "projects":
+                        doc = normalizar_proyecto_mongodb(doc)
+                        proyectos[doc["_id"]] = doc
+                    else:
+                        doc = normalizar_usuario_mongodb(doc)
+                        usuarios[doc["_id"]] = doc
+
+                if not (proyectos or usuarios):
+                    continue
+
+                db = session_factory()
+                try:
+                    MongoSyncEngine(db, _propietario_por_defecto(db)).sincronizar(
+                        list(proyectos.values()), list(usuarios.values())
+                    )
+                finally:
+                    db.close()
+                marcas_de_agua.guardar_token_change_stream(stream.resume_token)
+                sync_cache.set("ultima_sincronizacion", {
+                    "fecha": time.time(),
+                    "modo": "change_stream",
+                    "documentos_leidos": {"projects": len(proyectos), "users": len(usuarios)},
+                })
+
+
+class MongoSyncScheduler:
+    """
+    Ejecuta la sincronización incremental periódicamente en un hilo de fondo.
+
+    Con varios workers de gunicorn solo uno ejecuta la sincronización: el
+    liderazgo se obtiene con un add() atómico en el diskcache compartido y se
+    renueva en cada ciclo (y durante el change stream, en cada evento).
+    """
+
+    def __init__(self, cache, session_factory, crear_analizador, intervalo_minutos: float):
+        self._cache = cache
+        self._session_factory = session_factory
+        self._crear_analizador = crear_analizador
+        self._intervalo = intervalo_minutos * 60
+        self._detener = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+        self._id = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _es_lider(self) -> bool:
+        ttl = self._intervalo * 2 + 60
+        if self._cache.add("lider", self._id, expire=ttl):
+            return True
+        with self._cache.transact():
+            if self._cache.get("lider") == self._id:
+                self._cache.set("lider", self._id, expire=ttl)
+                return True
+        return False
+
+    def iniciar(self):
+        if self._intervalo <= 0 or self._hilo is not None:
+            return
+        self._hilo = threading.Thread(target=self._bucle, name="mongo-sync", daemon=True)
+        self._hilo.start()
+        logger.info(f"🔄 Sincronización MongoDB programada cada {self._intervalo / 60:g} min")
+
+    def detener(self):
+        self._detener.set()
+        if self._cache.get("lider") == self._id:
+            self._cache.delete("lider")
+
+    def _sincronizar_incremental(self, analizador):
+        db = self._session_factory()
+        try:
+            sincronizar_incremental(analizador, db)
+        finally:
+            db.close()
+
+    def _bucle(self):
+        while not self._detener.is_set():
+            if self._es_lider():
+                try:
+                    analizador = self._crear_analizador()
+                    if MONGO_SYNC_CHANGE_STREAMS:
+                        try:
+                            seguir_change_stream(
+                                analizador, self._session_factory, self._detener, self._es_lider,
+                                ponerse_al_dia=lambda: self._sincronizar_incremental(analizador)
+                            )
+                            continue
+                        except Exception as e:
+                            if marcas_de_agua.token_change_stream() is not None:
+                                # Un token fuera del oplog fallaría en cada ciclo: se descarta y
+                                # la marca de agua cubre lo pendiente antes de abrir uno nuevo
+                                marcas_de_agua.descartar_token_change_stream()
+                                logger.warning(f"No se pudo reanudar el change stream, se descarta el resume token: {e}")
+                            else:
+                                logger.warning(f"Change stream no disponible, usando marcas de agua: {e}")
+                    self._sincronizar_incremental(analizador)
+                except Exception as e:
+                    logger.error(f"Error en sincronización programada de MongoDB: {e}", exc_info=True)
+            self._detener.wait(self._intervalo)
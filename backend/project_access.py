@@ -0,0 +1,58 @@
+"""
+Verificación de acceso a proyectos (dueño o usuario asignado).
+
+Antes cada endpoint cargaba el proyecto y evaluaba
+`current_user not in project.assigned_users`, lo que hidrata la lista
+completa de colaboradores del proyecto en cada llamada. Aquí:
+
+1. Se consulta el conjunto de proyectos accesibles del usuario en
+   user_cache (O(1), una consulta por usuario cada USER_CACHE_TTL_SECONDS).
+2. Si el proyecto no está en el conjunto (denegado, inexistente o caché
+   desactualizada) se resuelve con una sola consulta indexada:
+   owner_id = :user OR EXISTS (user_projects por clave primaria).
+"""
+
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import exists, or_, select
+from sqlalchemy.orm import Session
+
+import models
+from user_cache import user_cache
+
+
+def consulta_acceso(project_id: int, user_id: int):
+    """SELECT que devuelve True/False según el acceso, o ninguna fila si el proyecto no existe."""
+    p = models.Project
+    up = models.user_projects
+    asignado = exists().where(up.c.project_id == p.id, up.c.user_id == user_id)
+    return select(or_(p.owner_id == user_id, asignado)).where(p.id == project_id)
+
+
+def estado_acceso_proyecto(db: Session, user: models.User, project_id: int) -> Optional[bool]:
+    """
+    Returns:
+        True si el usuario es dueño o está asignado, False si no, None si el proyecto no existe
+    """
+    if project_id in user_cache.proyectos_accesibles(db, user.id):
+        return True
+    return db.execute(consulta_acceso(project_id, user.id)).scalar_one_or_none()
+
+
+def tiene_acceso_proyecto(db: Session, user: models.User, project_id: int) -> bool:
+    return bool(estado_acceso_proyecto(db, user, project_id))
+
+
+def verificar_acceso_proyecto(
+    db: Session,
+    user: models.User,
+    project_id: int,
+    detail: str = "Access denied"
+):
+    """Lanza 404 si el proyecto no existe y 403 si el usuario no tiene acceso."""
+    acceso = estado_acceso_proyecto(db, user, project_id)
+    if acceso is None:
+        raise HTTPException(status_code=404, detail="Project not found")
+    if not acceso:
+        raise HTTPException(status_code=403, detail=detail)
@@ -0,0 +1,98 @@
+"""
+Consulta de valores de rasters en puntos y perfiles de elevación.
+
+Las medidas solo guardaban geometría: no había forma de saber la cota de un
+punto ni el perfil de una línea sobre un DEM. /layers/{id}/sample y
+/layers/{id}/profile resuelven miles de puntos en una sola llamada:
+
+- las coordenadas (EPSG:4326) se transforman en lote al CRS nativo del
+  raster con un Transformer de pyproj cacheado por CRS;
+- los valores se leen del COG original (sin remuestreo) a través de los
+  handles compartidos de tile_renderer, agrupando los puntos por bloque
+  interno para leer cada bloque una sola vez.
+"""
+
+import logging
+from functools import lru_cache
+from typing import List, Optional, Sequence
+
+import numpy as np
+import shapely
+from pyproj import CRS, Geod, Transformer
+from shapely.geometry import LineString
+
+from tile_renderer import tile_renderer
+
+logger = logging.getLogger(__name__)
+
+# Límites por solicitud
+MUESTREO_MAX_PUNTOS = 100000
+PERFIL_MAX_MUESTRAS = 10000
+
+_geod = Geod(ellps="WGS84")
+
+
+@lru_cache(maxsize=32)
+def _transformador(crs_destino: str) -> Transformer:
+    """Transformer EPSG:4326 -> CRS del raster (crearlos es costoso; se reutilizan)."""
+    return Transformer.from_crs(CRS.from_epsg(4326), CRS.from_user_input(crs_destino), always_xy=True)
+
+
+def _valor_json(valor: float) -> Optional[float]:
+    return None if np.isnan(valor) else float(valor)
+
+
+def muestrear(file_path: str, lons: np.ndarray, lats: np.ndarray, bandas: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Valores (bandas, n) en las coordenadas lon/lat; NaN = sin dato o fuera del raster."""
+    crs = tile_renderer.crs(file_path)
+    if crs is None:
+        raise ValueError("El raster no tiene CRS")
+    xs, ys = lons, lats
+    if crs.to_epsg() != 4326:
+        xs, ys = _transformador(crs.to_string()).transform(lons, lats)
+    return tile_renderer.sample(file_path, xs, ys, list(bandas) if bandas else None)
+
+
+def valores_en_puntos(file_path: str, puntos: List[List[float]], bandas: Optional[Sequence[int]] = None) -> dict:
+    coordenadas = np.asarray(puntos, dtype=np.float64)
+    valores = muestrear(file_path, coordenadas[:, 0], coordenadas[:, 1], bandas)
+    # Una banda: lista plana; varias: una lista de valores por punto
+    if valores.shape[0] == 1:
+        resultado = [_valor_json(v) for v in valores[0]]
+    else:
+        resultado = [[_valor_json(v) for v in punto] for punto in valores.T]
+    return {"count": len(resultado), "values": resultado}
+
+
+def perfil(file_path: str, coordenadas: List[List[float]], muestras: int = 512, banda: int = 1) -> dict:
+    """
+    Perfil a lo largo de una línea lon/lat: `muestras` puntos repartidos a lo
+    largo de la línea, con su distancia geodésica acumulada en metros.
+    """
+    linea = LineString([c[:2] for c in coordenadas])
+    if linea.length == 0:
+        raise ValueError("La línea del perfil no tiene longitud")
+
+    puntos = shapely.line_interpolate_point(linea, np.linspace(0, 1, muestras), normalized=True)
+    lon_lat = shapely.get_coordinates(puntos)
+    lons, lats = lon_lat[:, 0], lon_lat[:, 1]
+    _, _, tramos = _geod.inv(lons[:-1], lats[:-1], lons[1:], lats[1:])
+    distancias = np.concatenate([[0.0], np.cumsum(tramos)])
+    valores = muestrear(file_path, lons, lats, [banda])[0]
+
+    validos = valores[~np.isnan(valores)]
+    diferencias = np.diff(validos)
+    resumen = {
+        "min": _valor_json(validos.min()) if validos.size else None,
+        "max": _valor_json(validos.max()) if validos.size else None,
+        "ascent": float(diferencias[diferencias > 0].sum()),
+        "descent": float(-diferencias[diferencias < 0].sum()),
+    }
+    return {
+        "count": len(valores),
+        "length_m": float(distancias[-1]),
+        "distances": np.round(distancias, 3).tolist(),
+        "coordinates": np.round(lon_lat, 8).tolist(),
+        "values": [_valor_json(v) for v in valores],
+        "stats": resumen,
+    }
@@ -0,0 +1,130 @@
+"""
+Estadísticas por banda de los rasters (calculadas una sola vez al procesar).
+
+Antes cada VRTHandle leía una vista reducida del raster al abrirse y sacaba un
+único min/max global de todas las bandas (excluyendo ceros). Con 4 workers de
+gunicorn ese cálculo se repetía en cada worker y las imágenes multibanda
+quedaban con el mismo estiramiento para todas las bandas.
+
+Ahora convert_to_cog calcula, por banda y respetando nodata/máscaras:
+mínimo, máximo, media, desviación, percentiles e histograma. Se guardan:
+
+- en el GeoTIFF como metadatos GDAL de banda (STATISTICS_MINIMUM, ...,
+  STATISTICS_P2, STATISTICS_P98), que tile_renderer lee al abrir el archivo
+  sin ninguna lectura adicional de píxeles;
+- en Layer.settings["stats"] para el frontend (histograma, leyenda).
+"""
+
+import os
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+import rasterio
+from rasterio.enums import MaskFlags, Resampling
+
+logger = logging.getLogger(__name__)
+
+# Percentiles del estiramiento (recorte de colas)
+STRETCH_PERCENTILES = (2, 98)
+# Lado máximo de la muestra (se lee desde las overviews del COG)
+MUESTRA_MAX = int(os.getenv("RASTER_STATS_MUESTRA", 1024))
+HISTOGRAMA_BINS = 256
+
+_TAG_BAJO = f"STATISTICS_P{STRETCH_PERCENTILES[0]}"
+_TAG_ALTO = f"STATISTICS_P{STRETCH_PERCENTILES[1]}"
+
+
+def _forma_muestra(src, lado_max: int) -> Tuple[int, int]:
+    escala = min(1.0, lado_max / max(src.width, src.height))
+    return max(1, round(src.height * escala)), max(1, round(src.width * escala))
+
+
+def _sin_informacion_de_mascara(src) -> bool:
+    return src.nodata is None and all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums)
+
+
+def calcular_estadisticas(src, lado_max: int = MUESTRA_MAX) -> List[dict]:
+    """
+    Estadísticas por banda de un dataset abierto, sobre una muestra de como
+    máximo lado_max píxeles de lado (GDAL usa las overviews).
+
+    Se excluyen los píxeles nodata / fuera de máscara y los NaN. Si el archivo
+    no trae ninguna información de máscara se excluyen los ceros (los bordes
+    negros de las ortofotos), como hacía el cálculo anterior.
+    """
+    alto, ancho = _forma_muestra(src, lado_max)
+    datos = src.read(out_shape=(src.count, alto, ancho), resampling=Resampling.nearest, masked=True)
+    excluir_ceros = _sin_informacion_de_mascara(src)
+
+    bandas = []
+    for banda in datos:
+        valores = banda.compressed().astype(np.float64, copy=False)
+        valores = valores[np.isfinite(valores)]
+        if excluir_ceros:
+            valores = valores[valores != 0]
+        if valores.size == 0:
+            bandas.append(None)
+            continue
+
+        minimo, maximo = float(valores.min()), float(valores.max())
+        bajo, alto_p = np.percentile(valores, STRETCH_PERCENTILES)
+        conteos, _ = np.histogram(valores, bins=HISTOGRAMA_BINS, range=(minimo, maximo if maximo > minimo else minimo + 1))
+        bandas.append({
+            "min": minimo,
+            "max": maximo,
+            "mean": float(valores.mean()),
+            "std": float(valores.std()),
+            "valid_percent": round(100.0 * valores.size / banda.size, 2),
+            "percentiles": {str(p): float(v) for p, v in zip(STRETCH_PERCENTILES, (bajo, alto_p))},
+            "histogram": {"min": minimo, "max": maximo, "counts": conteos.tolist()},
+        })
+    return bandas
+
+
+def _tags_banda(estadistica: dict) -> dict:
+    bajo, alto = (estadistica["percentiles"][str(p)] for p in STRETCH_PERCENTILES)
+    return {
+        "STATISTICS_MINIMUM": repr(estadistica["min"]),
+        "STATISTICS_MAXIMUM": repr(estadistica["max"]),
+        "STATISTICS_MEAN": repr(estadistica["mean"]),
+        "STATISTICS_STDDEV": repr(estadistica["std"]),
+        "STATISTICS_VALID_PERCENT": repr(estadistica["valid_percent"]),
+        _TAG_BAJO: repr(bajo),
+        _TAG_ALTO: repr(alto),
+    }
+
+
+def guardar_estadisticas(filepath: str) -> List[Optional[dict]]:
+    """Calcula las estadísticas y las escribe como metadatos GDAL de cada banda."""
+    with rasterio.open(filepath, "r+") as dst:
+        bandas = calcular_estadisticas(dst)
+        for indice, estadistica in enumerate(bandas, start=1):
+            if estadistica is not None:
+                dst.update_tags(indice, **_tags_banda(estadistica))
+    logger.info(f"📊 Estadísticas por banda guardadas en {os.path.basename(filepath)}")
+    return bandas
+
+
+def rango_estiramiento(src) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    (bajo, alto) por banda desde los metadatos GDAL, o None si el archivo no
+    los tiene (procesado antes de este cambio). No lee píxeles.
+    """
+    bajos, altos = [], []
+    for indice in range(1, src.count + 1):
+        tags = src.tags(indice)
+        if _TAG_BAJO not in tags or _TAG_ALTO not in tags:
+            return None
+        bajos.append(float(tags[_TAG_BAJO]))
+        altos.append(float(tags[_TAG_ALTO]))
+    return np.array(bajos, dtype=np.float32), np.array(altos, dtype=np.float32)
+
+
+def rango_desde_estadisticas(bandas: List[Optional[dict]]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """(bajo, alto) por banda a partir de calcular_estadisticas()."""
+    if not bandas or any(b is None for b in bandas):
+        return None
+    bajos = [b["percentiles"][str(STRETCH_PERCENTILES[0])] for b in bandas]
+    altos = [b["percentiles"][str(STRETCH_PERCENTILES[1])] for b in bandas]
+    return np.array(bajos, dtype=np.float32), np.array(altos, dtype=np.float32)
@@ -0,0 +1,546 @@
+"""
+Serialización y exportación de reportes de registros geográficos.
+
+Convierte el DataFrame producido por GeographicRecordsAnalyzer.generar_reporte
+a estructuras listas para enviar al frontend (JSON vía orjson o Arrow IPC)
+trabajando columna por columna en lugar de fila por fila, y escribe los
+archivos de descarga (XLSX, KML/KMZ, CSV, Parquet) por lotes con escritores
+de memoria constante.
+"""
+
+import io
+import os
+import logging
+import zipfile
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import orjson
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S"
+COLUMNA_LAT = "Norte (Lat)"
+COLUMNA_LON = "Este (Lon)"
+COLUMNA_GOOGLE = "Coordenadas_Google"
+
+MEDIA_TYPE_ARROW = "application/vnd.apache.arrow.stream"
+
+# Tamaño de lote por defecto para los escritores en streaming
+TAMANO_LOTE = 5000
+
+# Formatos de exportación soportados -> extensión y media type de descarga
+FORMATOS_EXPORTACION = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "kml": (".kml", "application/vnd.google-earth.kml+xml"),
+    "kmz": (".kmz", "application/vnd.google-earth.kmz"),
+    "csv": (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+
+def _valor_a_json(value: Any) -> Any:
+    """Conversión escalar equivalente al bucle original (usada solo en columnas mixtas)."""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if isinstance(value, (pd.Timestamp, np.datetime64)) or hasattr(value, "strftime"):
+        return pd.Timestamp(value).strftime(FORMATO_FECHA)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    return str(value)
+
+
+def _columna_a_lista(serie: pd.Series) -> List[Any]:
+    """
+    Convierte una columna completa a una lista de valores serializables.
+
+    Reglas (idénticas al bucle con iterrows):
+    - Nulos -> None
+    - Fechas -> "YYYY-MM-DD HH:MM:SS"
+    - Números -> float
+    - Resto -> str
+    """
+    nulos = serie.isna()
+
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        valores = serie.dt.strftime(FORMATO_FECHA)
+    elif pd.api.types.is_bool_dtype(serie) or pd.api.types.is_numeric_dtype(serie):
+        valores = serie.astype("float64").astype(object)
+    else:
+        tipo = pd.api.types.infer_dtype(serie, skipna=True)
+        if tipo in ("string", "empty"):
+            valores = serie.astype(object)
+        elif tipo in ("floating", "integer", "mixed-integer-float", "decimal"):
+            valores = serie.astype("float64").astype(object)
+        else:
+            return [_valor_a_json(v) for v in serie.tolist()]
+
+    if nulos.any():
+        valores = valores.where(~nulos, None)
+    return valores.tolist()
+
+
+def _coords_registro(texto: Any, lat: Any, lon: Any) -> Optional[Dict[str, float]]:
+    """coords de un registro o None (sin la clave), igual que al parsear Coordenadas_Google."""
+    if not texto:
+        return None
+    if lat is not None and lon is not None:
+        return {"lat": lat, "lon": lon}
+    try:
+        partes = str(texto).split(",")
+        return {"lat": float(partes[0].strip()), "lon": float(partes[1].strip())}
+    except (ValueError, IndexError):
+        return None
+
+
+def registros_desde_dataframe(
+    df: pd.DataFrame,
+    offset: int = 0,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Convierte el DataFrame del reporte en la lista de registros del frontend.
+
+    Además de las columnas originales añade `_id` como alias de `id` y, como
+    antes, `coords` ({lat, lon}) solo en los registros con Coordenadas_Google
+    válidas, tomada de las columnas numéricas de latitud/longitud (sin
+    re-parsear el texto cuando están).
+
+    Args:
+        df: DataFrame generado por generar_reporte
+        offset: Primer registro a devolver
+        limit: Cantidad máxima de registros (None = todos)
+
+    Returns:
+        Lista de diccionarios con valores nativos de Python
+    """
+    if df is None or len(df) == 0:
+        return []
+
+    fin = None if limit is None else offset + limit
+    if offset or fin is not None:
+        df = df.iloc[offset:fin]
+    if len(df) == 0:
+        return []
+
+    claves = [str(c) for c in df.columns]
+    columnas = [_columna_a_lista(df[c]) for c in df.columns]
+    registros = [dict(zip(claves, fila)) for fila in zip(*columnas)]
+
+    if COLUMNA_GOOGLE in claves:
+        google = columnas[claves.index(COLUMNA_GOOGLE)]
+        sin_valor = [None] * len(registros)
+        lats = columnas[claves.index(COLUMNA_LAT)] if COLUMNA_LAT in claves else sin_valor
+        lons = columnas[claves.index(COLUMNA_LON)] if COLUMNA_LON in claves else sin_valor
+        for registro, texto, lat, lon in zip(registros, google, lats, lons):
+            coords = _coords_registro(texto, lat, lon)
+            if coords is not None:
+                registro["coords"] = coords
+
+    if "id" in claves:
+        for registro in registros:
+            registro["_id"] = registro["id"]  # El frontend usa _id a veces
+
+    return registros
+
+
+def serializar_json(contenido: Dict[str, Any]) -> bytes:
+    """Serializa la respuesta del reporte con orjson (NaN/None ya normalizados)."""
+    return orjson.dumps(contenido, option=orjson.OPT_NON_STR_KEYS)
+
+
+def dataframe_a_arrow_ipc(df: pd.DataFrame, offset: int = 0, limit: Optional[int] = None) -> bytes:
+    """
+    Serializa el DataFrame del reporte como un stream Arrow IPC.
+
+    Los tipos se conservan (fechas como timestamp, coordenadas como float64),
+    lo que permite a clientes como apache-arrow/pyarrow leerlo sin parseo.
+    """
+    import pyarrow as pa
+
+    fin = None if limit is None else offset + limit
+    if offset or fin is not None:
+        df = df.iloc[offset:fin]
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def leer_registros_parquet(ruta: str, offset: int = 0, limit: Optional[int] = None) -> Tuple[pd.DataFrame, int]:
+    """
+    Lee una página de registros de un Parquet escrito por EscritorParquetStreaming.
+
+    Solo se decodifican los row groups que cubren [offset, offset + limit),
+    usando el número de filas de cada uno guardado en los metadatos.
+
+    Returns:
+        (DataFrame de la página, total de registros del archivo)
+    """
+    import pyarrow.parquet as pq
+
+    archivo = pq.ParquetFile(ruta)
+    metadatos = archivo.metadata
+    total = metadatos.num_rows
+    fin = total if limit is None else min(offset + limit, total)
+    if offset >= fin:
+        return archivo.schema_arrow.empty_table().to_pandas(), total
+
+    grupos = []
+    desplazamiento = 0  # fila del archivo donde empieza el primer row group leído
+    inicio = 0
+    for i in range(metadatos.num_row_groups):
+        filas = metadatos.row_group(i).num_rows
+        if inicio + filas <= offset:
+            desplazamiento = inicio + filas
+        elif inicio < fin:
+            grupos.append(i)
+        inicio += filas
+
+    tabla = archivo.read_row_groups(grupos).slice(offset - desplazamiento, fin - offset)
+    return tabla.to_pandas(), total
+
+
+# ============================================================================
+# ESCRITORES EN STREAMING
+# ============================================================================
+
+def iterar_lotes(df: pd.DataFrame, tamano_lote: int = TAMANO_LOTE) -> Iterator[pd.DataFrame]:
+    """Divide el DataFrame en lotes consecutivos (vistas, sin copiar)."""
+    for inicio in range(0, len(df), tamano_lote):
+        yield df.iloc[inicio:inicio + tamano_lote]
+
+
+def _asegurar_directorio(output_path: str):
+    os.makedirs(os.path.dirname(output_path) if os.path.dirname(output_path) else '.', exist_ok=True)
+
+
+class EscritorExcelStreaming:
+    """
+    Escritor XLSX de memoria constante (openpyxl en modo write-only).
+
+    Las filas se vuelcan a disco a medida que se agregan, en lugar de
+    construir todo el libro en memoria como df.to_excel.
+    """
+
+    def __init__(self, output_path: str, sheet_name: str = "Registros"):
+        from openpyxl import Workbook
+
+        _asegurar_directorio(output_path)
+        self.output_path = output_path
+        self._wb = Workbook(write_only=True)
+        self._ws = self._wb.create_sheet(title=sheet_name)
+        self._encabezado_escrito = False
+
+    def agregar_lote(self, lote: pd.DataFrame):
+        if not self._encabezado_escrito:
+            self._ws.append([str(c) for c in lote.columns])
+            self._encabezado_escrito = True
+
+        # Convertir una sola vez por columna: NaN/NaT -> None, numpy -> tipos nativos
+        columnas = []
+        for c in lote.columns:
+            serie = lote[c]
+            valores = serie.astype(object)
+            nulos = serie.isna()
+            if nulos.any():
+                valores = valores.where(~nulos, None)
+            columnas.append(valores.tolist())
+
+        for fila in zip(*columnas):
+            self._ws.append(fila)
+
+    def cerrar(self) -> str:
+        self._wb.save(self.output_path)
+        self._wb.close()
+        return self.output_path
+
+
+# Estilos por clasificación (colores en formato KML aabbggrr)
+_ESTILOS_KML = [
+    ("style-obra", "ff00ff00", "Verde"),
+    ("style-oficina", "ff00ffff", "Amarillo"),
+    ("style-externa", "ff0000ff", "Rojo"),
+]
+
+
+class EscritorKMLStreaming:
+    """
+    Escritor KML/KMZ incremental.
+
+    Escribe el encabezado al abrir, los Placemark por lotes y cierra el
+    documento al final. Con `kmz=True` el KML se comprime directamente dentro
+    del ZIP (doc.kml) sin pasar por un archivo intermedio.
+    """
+
+    def __init__(self, output_path: str, kmz: bool = False, nombre: str = "Reporte de Registros SEGMAB"):
+        _asegurar_directorio(output_path)
+        self.output_path = output_path
+        self._zip = None
+        if kmz:
+            self._zip = zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED)
+            self._fh = self._zip.open("doc.kml", "w")
+        else:
+            self._fh = open(output_path, "wb")
+
+        encabezado = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<kml xmlns="http://www.opengis.net/kml/2.2">',
+            '  <Document>',
+            f'    <name>{nombre}</name>',
+        ]
+        for style_id, color, etiqueta in _ESTILOS_KML:
+            encabezado.extend([
+                f'    <Style id="{style_id}">',
+                '      <IconStyle>',
+                f'        <color>{color}</color> <!-- {etiqueta} -->',
+                '        <scale>1.2</scale>',
+                '        <Icon><href>http://maps.google.com/mapfiles/kml/shapes/placemark_circle.png</href></Icon>',
+                '      </IconStyle>',
+                '    </Style>',
+            ])
+        self._escribir("\n".join(encabezado) + "\n")
+
+    def _escribir(self, texto: str):
+        self._fh.write(texto.encode("utf-8"))
+
+    @staticmethod
+    def _columna_texto(lote: pd.DataFrame, col: str, defecto: str) -> List[str]:
+        if col not in lote.columns:
+            return [defecto] * len(lote)
+        serie = lote[col]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            texto = serie.astype(str)
+        else:
+            texto = serie.astype(object).astype(str)
+        return texto.where(serie.notna(), defecto).tolist()
+
+    def agregar_lote(self, lote: pd.DataFrame):
+        if len(lote) == 0:
+            return
+
+        lats = pd.to_numeric(lote.get("Norte (Lat)"), errors="coerce")
+        lons = pd.to_numeric(lote.get("Este (Lon)"), errors="coerce")
+        validos = (lats.notna() & lons.notna()).to_numpy()
+        if not validos.any():
+            return
+        lote = lote[validos]
+        lats = lats[validos].tolist()
+        lons = lons[validos].tolist()
+
+        clasif = [c.upper() for c in self._columna_texto(lote, "Clasificación", "UBICACIÓN EXTERNA")]
+        fechas = self._columna_texto(lote, "Fecha del registro", "Sin fecha")
+        colaboradores = self._columna_texto(lote, "Colaborador", "Desconocido")
+        proyectos = self._columna_texto(lote, "Proyecto", "N/A")
+        cargos = self._columna_texto(lote, "Cargo", "N/A")
+        correos = self._columna_texto(lote, "Correo", "N/A")
+        formatos = self._columna_texto(lote, "Formato", "N/A")
+        urls = self._columna_texto(lote, "URL Registro", "#")
+
+        partes = []
+        for lat, lon, cl, fecha, colab, proy, cargo, correo, fmt, url in zip(
+            lats, lons, clasif, fechas, colaboradores, proyectos, cargos, correos, formatos, urls
+        ):
+            if "OBRA" in cl:
+                style_id = "#style-obra"
+            elif "OFICINA" in cl:
+                style_id = "#style-oficina"
+            else:
+                style_id = "#style-externa"
+
+            partes.append(
+                '    <Placemark>\n'
+                f'      <name><![CDATA[{fecha} - {colab}]]></name>\n'
+                '      <description><![CDATA[\n'
+                f'            <b>Proyecto:</b> {proy}<br>\n'
+                f'            <b>Colaborador:</b> {colab}<br>\n'
+                f'            <b>Cargo:</b> {cargo}<br>\n'
+                f'            <b>Correo:</b> {correo}<br>\n'
+                f'            <b>Fecha:</b> {fecha}<br>\n'
+                f'            <b>Formato:</b> {fmt}<br>\n'
+                f'            <b>Clasificación:</b> {cl}<br>\n'
+                '            <br>\n'
+                f'            <a href="{url}">Ver registro en SEGMAB</a>\n'
+                '            ]]></description>\n'
+                f'      <styleUrl>{style_id}</styleUrl>\n'
+                f'      <Point>\n        <coordinates>{lon},{lat},0</coordinates>\n      </Point>\n'
+                '    </Placemark>\n'
+            )
+        self._escribir("".join(partes))
+
+    def cerrar(self) -> str:
+        self._escribir("  </Document>\n</kml>\n")
+        self._fh.close()
+        if self._zip is not None:
+            self._zip.close()
+        return self.output_path
+
+
+class EscritorCSVStreaming:
+    """Escritor CSV por lotes (UTF-8 con BOM para que Excel respete los acentos)."""
+
+    def __init__(self, output_path: str):
+        _asegurar_directorio(output_path)
+        self.output_path = output_path
+        self._fh = open(output_path, "w", encoding="utf-8-sig", newline="")
+        self._encabezado_escrito = False
+
+    def agregar_lote(self, lote: pd.DataFrame):
+        lote.to_csv(self._fh, index=False, header=not self._encabezado_escrito, date_format=FORMATO_FECHA)
+        self._encabezado_escrito = True
+
+    def cerrar(self) -> str:
+        self._fh.close()
+        return self.output_path
+
+
+class EscritorParquetStreaming:
+    """
+    Escritor Parquet por lotes (un row group por lote, compresión zstd).
+
+    El esquema se fija una vez para todo el reporte (ver esquema_parquet) y
+    cada lote se convierte a él, de modo que una columna vacía en el primer
+    lote o con nulos solo en lotes posteriores no cambia de tipo a mitad del archivo.
+    """
+
+    def __init__(self, output_path: str, schema=None):
+        _asegurar_directorio(output_path)
+        self.output_path = output_path
+        self._writer = None
+        self._schema = schema
+
+    def agregar_lote(self, lote: pd.DataFrame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._schema is None:
+            self._schema = esquema_parquet(lote)
+        tabla = pa.Table.from_pandas(lote, schema=self._schema, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.output_path, self._schema, compression="zstd")
+        self._writer.write_table(tabla)
+
+    def cerrar(self) -> str:
+        if self._writer is not None:
+            self._writer.close()
+        return self.output_path
+
+
+def esquema_parquet(df: pd.DataFrame):
+    """
+    Esquema Arrow del DataFrame completo; las columnas sin ningún valor
+    (tipo null) se declaran como texto.
+    """
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for i, campo in enumerate(schema):
+        if pa.types.is_null(campo.type):
+            schema = schema.set(i, campo.with_type(pa.string()))
+    return schema
+
+
+def crear_escritor(formato: str, output_path: str, df: Optional[pd.DataFrame] = None):
+    """
+    Factory de escritores en streaming por formato.
+
+    `df` (el reporte completo) solo se usa para fijar el esquema Parquet.
+    """
+    if formato == "xlsx":
+        return EscritorExcelStreaming(output_path)
+    if formato == "kml":
+        return EscritorKMLStreaming(output_path)
+    if formato == "kmz":
+        return EscritorKMLStreaming(output_path, kmz=True)
+    if formato == "csv":
+        return EscritorCSVStreaming(output_path)
+    if formato == "parquet":
+        return EscritorParquetStreaming(output_path, esquema_parquet(df) if df is not None else None)
+    raise ValueError(f"Formato de exportación no soportado: {formato}")
+
+
+def _eliminar_parcial(ruta: str):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"No se pudo eliminar el archivo parcial {ruta}: {e}")
+
+
+def exportar_reporte(
+    df: pd.DataFrame,
+    ruta_base: str,
+    formatos: List[str],
+    tamano_lote: int = TAMANO_LOTE,
+    progress_callback: Optional[Callable[[int, int], None]] = None
+) -> Dict[str, str]:
+    """
+    Exporta el reporte a varios formatos recorriendo el DataFrame una sola vez.
+
+    Cada lote se entrega a todos los escritores abiertos, de modo que la
+    memoria adicional depende del tamaño del lote y no del total de registros.
+    Pensado para ejecutarse fuera del event loop (threadpool o job).
+
+    Args:
+        df: DataFrame del reporte
+        ruta_base: Ruta sin extensión (ej: report/Reporte_Registros_20250101_120000)
+        formatos: Lista de formatos (xlsx, kml, kmz, csv, parquet)
+        tamano_lote: Filas por lote
+        progress_callback: Función (procesados, total) llamada tras cada lote
+
+    Returns:
+        Diccionario formato -> ruta del archivo generado
+    """
+    for formato in dict.fromkeys(formatos):
+        if formato not in FORMATOS_EXPORTACION:
+            raise ValueError(f"Formato de exportación no soportado: {formato}")
+
+    escritores = {}
+    rutas = {}
+    try:
+        for formato in dict.fromkeys(formatos):
+            extension = FORMATOS_EXPORTACION[formato][0]
+            escritores[formato] = crear_escritor(formato, ruta_base + extension, df)
+
+        total = len(df)
+        procesados = 0
+        for lote in iterar_lotes(df, tamano_lote):
+            for escritor in escritores.values():
+                escritor.agregar_lote(lote)
+            procesados += len(lote)
+            if progress_callback:
+                progress_callback(procesados, total)
+
+        for formato, escritor in escritores.items():
+            rutas[formato] = escritor.cerrar()
+    except Exception:
+        # Cerrar lo que quede abierto y no dejar archivos parciales en report/
+        for formato, escritor in escritores.items():
+            if formato not in rutas:
+                try:
+                    escritor.cerrar()
+                except Exception:
+                    pass
+            _eliminar_parcial(escritor.output_path)
+        raise
+
+    for formato, ruta in rutas.items():
+        logger.info(f"✅ Archivo {formato.upper()} guardado: {ruta}")
+    return rutas
+
+
+def media_type_para(filename: str) -> str:
+    """Media type de descarga según la extensión del archivo de reporte."""
+    extension = os.path.splitext(filename)[1].lower()
+    for ext, media_type in FORMATOS_EXPORTACION.values():
+        if ext == extension:
+            return media_type
+    if extension == ".json":
+        return "application/json"
+    if extension == ".arrow":
+        return MEDIA_TYPE_ARROW
+    return "application/octet-stream"
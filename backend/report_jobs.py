@@ -0,0 +1,256 @@
+"""
+Trabajos asíncronos de generación de reportes.
+
+El estado de cada trabajo vive en un diskcache compartido (shared.job_cache),
+de modo que cualquier worker de gunicorn puede consultar el progreso,
+cancelar o descargar el resultado aunque el trabajo se esté ejecutando en
+otro proceso. La ejecución ocurre en un ThreadPoolExecutor del proceso que
+recibió la solicitud.
+
+Estados: pendiente -> procesando -> completado | sin_datos | error | cancelado
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import orjson
+
+from shared import job_cache
+
+logger = logging.getLogger(__name__)
+
+ESTADOS_ACTIVOS = ("pendiente", "procesando")
+ESTADOS_TERMINADOS_REUTILIZABLES = ("completado", "sin_datos")
+
+# Tiempo de vida del estado del trabajo (el resultado se puede descargar mientras tanto)
+JOB_TTL_SECONDS = int(os.getenv("REPORT_JOB_TTL_SECONDS", 86400))
+# Segundos que un trabajo terminado se reutiliza para solicitudes idénticas:
+# un rango de fechas que incluye hoy sigue recibiendo registros nuevos
+JOB_REUSE_SECONDS = int(os.getenv("REPORT_JOB_REUSE_SECONDS", 300))
+# Si un trabajo activo no reporta progreso en este tiempo se considera perdido
+# (p. ej. el worker que lo ejecutaba fue reiniciado). Los trabajos en cola
+# ("pendiente") se mantienen vigentes con un latido del proceso que los encoló.
+JOB_STALE_SECONDS = int(os.getenv("REPORT_JOB_STALE_SECONDS", 1800))
+
+
+class TrabajoCancelado(Exception):
+    """Se lanza dentro del trabajo cuando el usuario solicitó la cancelación."""
+
+
+class ReportJobManager:
+    """Gestor de trabajos de reporte con deduplicación por parámetros."""
+
+    def __init__(self, cache, max_workers: int = 2):
+        self._cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="report-job")
+        # Trabajos encolados en este proceso que aún no empiezan
+        self._en_cola = set()
+        self._lock = threading.Lock()
+        self._latido = None
+
+    # --- Claves ---
+    @staticmethod
+    def clave_parametros(parametros: Dict[str, Any]) -> str:
+        """Hash estable de los parámetros efectivos del reporte."""
+        contenido = orjson.dumps(parametros, option=orjson.OPT_SORT_KEYS, default=str)
+        return hashlib.sha256(contenido).hexdigest()
+
+    @staticmethod
+    def _clave_job(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    @staticmethod
+    def _clave_cancelacion(job_id: str) -> str:
+        return f"cancel:{job_id}"
+
+    @staticmethod
+    def _clave_dedup(hash_parametros: str) -> str:
+        return f"params:{hash_parametros}"
+
+    # --- Estado ---
+    def _guardar(self, job: Dict[str, Any]):
+        job["actualizado"] = time.time()
+        self._cache.set(self._clave_job(job["id"]), job, expire=JOB_TTL_SECONDS)
+
+    def obtener(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._cache.get(self._clave_job(job_id))
+        if job and job["estado"] in ESTADOS_ACTIVOS and time.time() - job["actualizado"] > JOB_STALE_SECONDS:
+            job["estado"] = "error"
+            job["mensaje"] = "El trabajo dejó de reportar progreso (el proceso que lo ejecutaba se detuvo)"
+            self._guardar(job)
+        return job
+
+    def actualizar(self, job_id: str, **campos):
+        # transact() serializa la lectura-modificación-escritura entre procesos
+        with self._cache.transact():
+            job = self._cache.get(self._clave_job(job_id))
+            if not job:
+                return
+            job.update(campos)
+            self._guardar(job)
+
+    def actualizar_progreso(self, job_id: str, progreso: int, mensaje: Optional[str] = None):
+        """Actualiza el progreso y lanza TrabajoCancelado si se pidió cancelar."""
+        self.verificar_cancelacion(job_id)
+        campos = {"progreso": max(0, min(100, int(progreso)))}
+        if mensaje:
+            campos["mensaje"] = mensaje
+        self.actualizar(job_id, **campos)
+
+    def verificar_cancelacion(self, job_id: str):
+        if self._cache.get(self._clave_cancelacion(job_id)):
+            raise TrabajoCancelado(job_id)
+
+    @staticmethod
+    def _reutilizable(job: Dict[str, Any]) -> bool:
+        if job["estado"] in ESTADOS_ACTIVOS:
+            return True
+        return (job["estado"] in ESTADOS_TERMINADOS_REUTILIZABLES
+                and time.time() - job.get("terminado", 0) < JOB_REUSE_SECONDS)
+
+    # --- Ciclo de vida ---
+    def enviar(
+        self,
+        parametros: Dict[str, Any],
+        ejecutar: Callable[[str, Dict[str, Any]], Dict[str, Any]],
+        usuario_id: int
+    ) -> Dict[str, Any]:
+        """
+        Encola un trabajo o reutiliza uno con los mismos parámetros que siga
+        activo o haya terminado hace menos de JOB_REUSE_SECONDS.
+
+        Args:
+            parametros: Parámetros efectivos (ya resueltos los permisos)
+            ejecutar: Función (job_id, parametros) -> resultado, corre en el pool
+            usuario_id: Usuario que solicita el reporte
+
+        Returns:
+            Estado del trabajo, con `deduplicado=True` si se reutilizó uno existente
+        """
+        hash_parametros = self.clave_parametros(parametros)
+        clave_dedup = self._clave_dedup(hash_parametros)
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "estado": "pendiente",
+            "progreso": 0,
+            "mensaje": "En cola",
+            "creado": time.time(),
+            "usuarios": [usuario_id],
+            "parametros": parametros,
+            "hash_parametros": hash_parametros,
+            "resultado": None,
+        }
+        # El registro se guarda antes de publicar la clave de deduplicación:
+        # quien lea la clave siempre encuentra el trabajo
+        self._guardar(job)
+
+        for _ in range(2):
+            # add() es atómico entre procesos: solo un worker gana la clave
+            if self._cache.add(clave_dedup, job["id"], expire=JOB_TTL_SECONDS):
+                break
+
+            existente_id = self._cache.get(clave_dedup)
+            existente = self.obtener(existente_id) if existente_id else None
+            if existente and self._reutilizable(existente):
+                self._cache.delete(self._clave_job(job["id"]))
+                if usuario_id not in existente["usuarios"]:
+                    self.actualizar(existente_id, usuarios=existente["usuarios"] + [usuario_id])
+                    existente = self.obtener(existente_id)
+                return {**existente, "deduplicado": True}
+
+            # El trabajo anterior falló, fue cancelado, expiró o su resultado ya
+            # es viejo: liberar la clave
+            # (solo si sigue apuntando a ese trabajo; otro worker pudo reemplazarla)
+            if existente_id:
+                self._liberar_dedup(existente_id, hash_parametros)
+        else:
+            self._cache.delete(self._clave_job(job["id"]))
+            raise RuntimeError("No se pudo registrar el trabajo de reporte")
+
+        with self._lock:
+            self._en_cola.add(job["id"])
+            if self._latido is None:
+                self._latido = threading.Thread(target=self._bucle_latido, name="report-job-latido", daemon=True)
+                self._latido.start()
+        self._executor.submit(self._ejecutar, job["id"], parametros, ejecutar)
+        return {**job, "deduplicado": False}
+
+    def _bucle_latido(self):
+        """
+        Renueva `actualizado` de los trabajos que esperan en la cola: detrás de
+        dos reportes largos un trabajo pendiente no debe darse por perdido. Si
+        el proceso muere el latido se detiene y el trabajo sí queda vencido.
+        """
+        while True:
+            time.sleep(max(JOB_STALE_SECONDS / 3, 1))
+            with self._lock:
+                en_cola = list(self._en_cola)
+            for job_id in en_cola:
+                try:
+                    with self._cache.transact():
+                        job = self._cache.get(self._clave_job(job_id))
+                        if job and job["estado"] == "pendiente":
+                            self._guardar(job)
+                except Exception as e:
+                    logger.warning(f"No se pudo renovar el trabajo en cola {job_id}: {e}")
+
+    def cancelar(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self.obtener(job_id)
+        if not job:
+            return None
+        if job["estado"] in ESTADOS_ACTIVOS:
+            self._cache.set(self._clave_cancelacion(job_id), True, expire=JOB_TTL_SECONDS)
+            if job["estado"] == "pendiente":
+                job["estado"] = "cancelado"
+                job["mensaje"] = "Cancelado por el usuario"
+                self._guardar(job)
+                self._liberar_dedup(job_id, job["hash_parametros"])
+        return job
+
+    def _liberar_dedup(self, job_id: str, hash_parametros: str):
+        """Permite que una nueva solicitud con los mismos parámetros cree otro trabajo."""
+        clave = self._clave_dedup(hash_parametros)
+        with self._cache.transact():
+            if self._cache.get(clave) == job_id:
+                self._cache.delete(clave)
+
+    def _ejecutar(self, job_id: str, parametros: Dict[str, Any], ejecutar: Callable):
+        with self._lock:
+            self._en_cola.discard(job_id)
+        job = self.obtener(job_id)
+        if not job or job["estado"] != "pendiente":
+            return  # Cancelado antes de empezar
+
+        inicio = time.perf_counter()
+        self.actualizar(job_id, estado="procesando", mensaje="Iniciando")
+        try:
+            resultado = ejecutar(job_id, parametros)
+            estado = "sin_datos" if resultado.get("total_registros", 0) == 0 else "completado"
+            self.actualizar(
+                job_id,
+                estado=estado,
+                progreso=100,
+                mensaje=resultado.get("mensaje", "Reporte generado"),
+                resultado=resultado,
+                terminado=time.time(),
+                duracion_segundos=round(time.perf_counter() - inicio, 2)
+            )
+            logger.info(f"Trabajo de reporte {job_id} terminado ({estado}) en {time.perf_counter() - inicio:.1f}s")
+        except TrabajoCancelado:
+            self.actualizar(job_id, estado="cancelado", mensaje="Cancelado por el usuario")
+            self._liberar_dedup(job_id, job["hash_parametros"])
+            logger.info(f"Trabajo de reporte {job_id} cancelado")
+        except Exception as e:
+            logger.error(f"Error en trabajo de reporte {job_id}: {e}", exc_info=True)
+            self.actualizar(job_id, estado="error", mensaje=f"Error al generar reporte: {str(e)}")
+            self._liberar_dedup(job_id, job["hash_parametros"])
+
+
+report_jobs = ReportJobManager(job_cache, max_workers=int(os.getenv("REPORT_JOB_WORKERS", 2)))
@@ -181,6 +181,26 @@ class ProjectRead(ProjectBase):
     class Config:
         from_attributes = True
 
+class ProjectSummary(BaseModel):
+    id: int
+    name: str
+    layer_count: int = 0
+    member_count: int = 0
+    bbox: Optional[List[float]] = None  # [minx, miny, maxx, maxy] en EPSG:4326
+    # include=details
+    description: Optional[str] = None
+    contract_number: Optional[str] = None
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+    photo_url: Optional[str] = None
+    owner_id: Optional[int] = None
+    # include=members
+    assigned_user_ids: Optional[List[int]] = None
+
+class ProjectSummaryPage(BaseModel):
+    items: List[ProjectSummary]
+    next_cursor: Optional[str] = None
+
 class ProjectAssign(BaseModel):
     user_id: int
     project_id: int
@@ -189,3 +209,15 @@ class ProjectAssign(BaseModel):
 # Update ProjectRead to include measurements
 class ProjectReadFull(ProjectRead):
     measurements: List[MeasurementRead] = []
+
+
+# Consulta de valores de rasters (coordenadas [lon, lat] en EPSG:4326)
+class RasterSampleRequest(BaseModel):
+    points: List[List[float]]
+    bands: Optional[List[int]] = None  # por defecto, todas
+
+class RasterProfileRequest(BaseModel):
+    coordinates: Optional[List[List[float]]] = None  # LineString
+    measurement_id: Optional[int] = None  # o la geometría de una medida del proyecto
+    samples: int = 512
+    band: int = 1
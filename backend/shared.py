@@ -13,3 +13,18 @@ BACKUP_DIR = "uploads_backup"
 
 # Cache de tiles en disco
 tile_cache = Cache("tile_cache")
+
+# Estado de trabajos en segundo plano (compartido entre workers de gunicorn)
+job_cache = Cache("job_cache")
+
+# Geocercas compiladas (WKB) para que los workers arranquen sin re-parsear KML/KMZ
+geofence_disk_cache = Cache("geofence_cache")
+
+# Marcas de agua y liderazgo de la sincronización incremental MongoDB -> PostgreSQL
+sync_cache = Cache("sync_cache")
+
+# Generación de la caché de usuarios/permisos (invalidación entre workers)
+auth_cache = Cache("auth_cache")
+
+# Estadísticas del dashboard (TTL corto, compartidas entre workers)
+stats_cache = Cache("stats_cache")
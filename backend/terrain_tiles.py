@@ -0,0 +1,133 @@
+"""
+Productos de terreno para capas de elevación (DEM/DSM de los vuelos de dron).
+
+Los rasters de una banda se mostraban solo como escala de grises, lo que no
+sirve para análisis ni para terreno 3D. /layers/{id}/terrain/{modo}/{z}/{x}/{y}
+genera al vuelo, desde los valores crudos de elevación (sin estiramiento):
+
+- terrain-rgb: elevación codificada en RGB (formato Mapbox Terrain-RGB,
+  altura = -10000 + (R*65536 + G*256 + B) * 0.1) en PNG sin pérdida.
+  MapLibre lo lee directamente (raster-dem, encoding "mapbox"); Cesium no
+  trae un proveedor Terrain-RGB, así que el visor 3D lo decodifica en un
+  CustomHeightmapTerrainProvider (Map3dService.setDemTerrain).
+- hillshade: sombreado (método de Horn, sol a 315° y 45° por defecto).
+- slope: pendiente en grados con rampa de color (verde plano, rojo empinado).
+
+Sombreado y pendiente usan kernels 3x3 vectorizados en NumPy sobre una
+ventana leída con un píxel de margen, así que los bordes de tiles vecinos
+coinciden. Los tiles se cachean con la versión del archivo (mtime + tamaño):
+reprocesar el DEM no sirve tiles viejos.
+"""
+
+import math
+from typing import Optional
+
+import numpy as np
+
+from tile_normalize import rampa, empaquetar
+from tile_renderer import TILE_SIZE, EARTH_HALF_CIRC, file_version
+
+MODOS = ("terrain-rgb", "hillshade", "slope")
+
+TERRAIN_RGB_BASE = -10000.0
+TERRAIN_RGB_PASO = 0.1
+_TERRAIN_RGB_MAX = 256 ** 3 - 1
+
+# Pendiente que satura la rampa de color (grados)
+PENDIENTE_MAX = 45.0
+_COLOR_PENDIENTE = empaquetar(rampa("rdylgn")[::-1])
+
+
+def version_archivo(path: str) -> str:
+    """Versión del raster para la clave de caché (cambia al reprocesarlo)."""
+    return file_version(path)
+
+
+def resolucion_suelo(z: int, y: int) -> float:
+    """Metros en el terreno por píxel del tile (Web Mercator corregido por latitud)."""
+    n = math.pi - 2 * math.pi * (y + 0.5) / 2 ** z
+    latitud = math.atan(math.sinh(n))
+    return EARTH_HALF_CIRC * 2 / 2 ** z / TILE_SIZE * math.cos(latitud)
+
+
+def terrain_rgb(elevacion: np.ndarray) -> np.ndarray:
+    """Elevación (float32, NaN = sin dato) -> RGBA Terrain-RGB."""
+    validos = np.isfinite(elevacion)
+    codigo = np.zeros(elevacion.shape, dtype=np.float64)
+    np.subtract(elevacion, TERRAIN_RGB_BASE, out=codigo, where=validos)
+    np.divide(codigo, TERRAIN_RGB_PASO, out=codigo)
+    np.rint(codigo, out=codigo)
+    np.clip(codigo, 0, _TERRAIN_RGB_MAX, out=codigo)
+    codigo = codigo.astype(np.uint32)
+
+    salida = np.empty(elevacion.shape + (4,), dtype=np.uint8)
+    salida[..., 0] = codigo >> 16
+    salida[..., 1] = (codigo >> 8) & 0xFF
+    salida[..., 2] = codigo & 0xFF
+    salida[..., 3] = np.where(validos, 255, 0)
+    return salida
+
+
+def _gradientes(elevacion: np.ndarray, resolucion: float):
+    """
+    dz/dx y dz/dy (método de Horn) de una ventana con 1 píxel de margen.
+    Devuelve arreglos del tamaño interior; y crece hacia el sur (filas).
+    """
+    a, b, c = elevacion[:-2, :-2], elevacion[:-2, 1:-1], elevacion[:-2, 2:]
+    d, f = elevacion[1:-1, :-2], elevacion[1:-1, 2:]
+    g, h, i = elevacion[2:, :-2], elevacion[2:, 1:-1], elevacion[2:, 2:]
+    dzdx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * resolucion)
+    dzdy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * resolucion)
+    return dzdx, dzdy
+
+
+def _alfa(valores: np.ndarray) -> np.ndarray:
+    """Transparente donde el kernel tocó un píxel sin dato (NaN se propaga)."""
+    return np.where(np.isfinite(valores), 255, 0).astype(np.uint8)
+
+
+def hillshade(elevacion: np.ndarray, resolucion: float, azimut: float = 315.0,
+              altitud: float = 45.0, exageracion: float = 1.0) -> np.ndarray:
+    """Sombreado en escala de grises de una ventana con 1 píxel de margen."""
+    dzdx, dzdy = _gradientes(elevacion, resolucion)
+    az, alt = math.radians(azimut), math.radians(altitud)
+    # Producto escalar entre la normal de la superficie y la dirección del sol
+    # (norte = -y en filas), sin trigonometría por píxel
+    luz = (math.sin(alt)
+           - exageracion * math.cos(alt) * (math.sin(az) * dzdx - math.cos(az) * dzdy))
+    luz /= np.sqrt(1 + exageracion ** 2 * (dzdx * dzdx + dzdy * dzdy))
+    gris = np.nan_to_num(np.clip(luz * 255, 0, 255), nan=0).astype(np.uint8)
+
+    salida = np.empty(gris.shape + (4,), dtype=np.uint8)
+    salida[..., 0] = gris
+    salida[..., 1] = gris
+    salida[..., 2] = gris
+    salida[..., 3] = _alfa(luz)
+    return salida
+
+
+def pendiente(elevacion: np.ndarray, resolucion: float) -> np.ndarray:
+    """Pendiente en grados coloreada (0° verde ... PENDIENTE_MAX rojo)."""
+    dzdx, dzdy = _gradientes(elevacion, resolucion)
+    grados = np.degrees(np.arctan(np.sqrt(dzdx * dzdx + dzdy * dzdy)))
+    indices = np.nan_to_num(np.clip(grados * (255 / PENDIENTE_MAX), 0, 255), nan=0).astype(np.uint8)
+
+    salida = np.empty(indices.shape + (4,), dtype=np.uint8)
+    np.take(_COLOR_PENDIENTE, indices, out=salida.view(np.uint32)[..., 0])
+    salida[..., 3] = _alfa(grados)
+    return salida
+
+
+def renderizar(renderer, path: str, modo: str, z: int, x: int, y: int) -> Optional[np.ndarray]:
+    """RGBA del producto de terreno o None si el tile no tiene datos."""
+    if modo == "terrain-rgb":
+        elevacion = renderer.render_elevation(path, z, x, y)
+        return None if elevacion is None else terrain_rgb(elevacion)
+
+    elevacion = renderer.render_elevation(path, z, x, y, pad=1)
+    if elevacion is None:
+        return None
+    resolucion = resolucion_suelo(z, y)
+    if modo == "hillshade":
+        return hillshade(elevacion, resolucion)
+    return pendiente(elevacion, resolucion)
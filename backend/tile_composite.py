@@ -0,0 +1,193 @@
+"""
+Composición de ortofotos de un proyecto en un único flujo de tiles.
+
+Con varios rasters superpuestos el navegador pedía un tile por capa y por
+posición (30 ortofotos = 30 peticiones por tile de pantalla) y mezclaba las
+imágenes en el cliente. /tiles/composite/{project_id}/{z}/{x}/{y} entrega un
+solo tile ya compuesto respetando el orden (z_index), la visibilidad y la
+opacidad guardados en la base de datos.
+
+- Las capas raster del proyecto y su extensión (EPSG:3857) se cargan con una
+  sola consulta y se indexan en memoria con un STRtree; cada tile consulta el
+  índice en lugar de abrir todos los rasters.
+- La mezcla se hace en NumPy de arriba hacia abajo (operador "under"): en
+  cuanto el tile queda completamente opaco no se leen las capas inferiores.
+- La versión del conjunto de capas (hash de id, orden, opacidad y fecha de
+  actualización) forma parte de la clave de caché, así que cambiar el orden o
+  la opacidad de una capa no sirve tiles viejos.
+"""
+
+import os
+import time
+import hashlib
+import logging
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+
+import models
+from shared import UPLOAD_DIR
+from tile_renderer import tile_renderer, tile_bounds_3857, TILE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se reutiliza el índice en memoria antes de volver a consultar la base de datos
+COMPOSITE_INDEX_TTL_SECONDS = float(os.getenv("COMPOSITE_INDEX_TTL_SECONDS", 5))
+# Alfa acumulado a partir del cual un píxel se considera opaco
+_OPACO = 254.5 / 255
+
+# Latitud máxima de Web Mercator
+_LAT_MAX = 85.05112878
+
+_a_3857 = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+
+
+@dataclass(frozen=True)
+class CapaRaster:
+    id: int
+    path: str
+    z_index: int
+    opacidad: float  # 0-1
+
+
+class IndiceComposicion:
+    """Capas raster visibles de un proyecto con un índice espacial de su extensión."""
+
+    def __init__(self, capas: List[CapaRaster], extensiones: List[Tuple[float, float, float, float]], version: str):
+        self.capas = capas
+        self.version = version
+        self._arbol = shapely.STRtree([shapely.box(*e) for e in extensiones]) if capas else None
+
+    def capas_en_tile(self, z: int, x: int, y: int) -> List[CapaRaster]:
+        """Capas que intersecan el tile, de la superior a la inferior."""
+        if self._arbol is None:
+            return []
+        indices = self._arbol.query(shapely.box(*tile_bounds_3857(z, x, y)), predicate="intersects")
+        return sorted((self.capas[i] for i in indices), key=lambda c: (c.z_index, c.id), reverse=True)
+
+
+def resolver_archivo(file_path: str) -> str:
+    """Ruta del raster: file_path tal cual o, si no existe, el mismo nombre dentro de UPLOAD_DIR."""
+    if os.path.exists(file_path):
+        return file_path
+    return os.path.join(UPLOAD_DIR, os.path.basename(file_path))
+
+
+def _extension_3857(xmin, ymin, xmax, ymax, path: str) -> Optional[Tuple[float, float, float, float]]:
+    if xmin is not None:
+        ymin, ymax = max(ymin, -_LAT_MAX), min(ymax, _LAT_MAX)
+        return _a_3857.transform_bounds(xmin, ymin, xmax, ymax)
+    # Capas antiguas sin Layer.bounds: la extensión sale del propio raster
+    try:
+        b = tile_renderer.bounds_3857(path)
+        return b.left, b.bottom, b.right, b.top
+    except Exception as e:
+        logger.warning(f"⚠️ Raster sin extensión, se omite de la composición ({path}): {e}")
+        return None
+
+
+def cargar_indice(db: Session, project_id: int) -> IndiceComposicion:
+    L = models.Layer
+    filas = db.execute(
+        select(
+            L.id, L.file_path, L.z_index, L.opacity, L.updated_at,
+            func.ST_XMin(L.bounds).label("xmin"), func.ST_YMin(L.bounds).label("ymin"),
+            func.ST_XMax(L.bounds).label("xmax"), func.ST_YMax(L.bounds).label("ymax"),
+        )
+        .where(
+            L.project_id == project_id,
+            L.layer_type == "raster",
+            L.visible.is_(True),
+            L.opacity > 0,
+            or_(L.processing_status.is_(None), L.processing_status == "completed"),
+        )
+        .order_by(L.z_index, L.id)
+    ).all()
+
+    capas, extensiones, firma = [], [], []
+    for fila in filas:
+        path = resolver_archivo(fila.file_path)
+        extension = _extension_3857(fila.xmin, fila.ymin, fila.xmax, fila.ymax, path)
+        if extension is None:
+            continue
+        capas.append(CapaRaster(fila.id, path, fila.z_index, min(fila.opacity, 100) / 100))
+        extensiones.append(extension)
+        firma.append(f"{fila.id}:{fila.z_index}:{fila.opacity}:{fila.updated_at}:{fila.file_path}")
+
+    version = hashlib.sha1("|".join(firma).encode()).hexdigest()[:16]
+    return IndiceComposicion(capas, extensiones, version)
+
+
+class CompositorTiles:
+    """Índices por proyecto con TTL corto (cada worker mantiene los suyos)."""
+
+    def __init__(self, ttl: float = COMPOSITE_INDEX_TTL_SECONDS):
+        self.ttl = ttl
+        self._indices: Dict[int, Tuple[float, IndiceComposicion]] = {}
+        self._lock = Lock()
+
+    def indice(self, db: Session, project_id: int) -> IndiceComposicion:
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._indices.get(project_id)
+        if entrada and entrada[0] > ahora:
+            return entrada[1]
+        indice = cargar_indice(db, project_id)
+        with self._lock:
+            self._indices[project_id] = (ahora + self.ttl, indice)
+        return indice
+
+    def invalidar(self, project_id: int):
+        """Descarta el índice del proyecto (cambio de orden, visibilidad u opacidad)."""
+        with self._lock:
+            self._indices.pop(project_id, None)
+
+    def componer(self, capas: List[CapaRaster], z: int, x: int, y: int) -> Optional[np.ndarray]:
+        """
+        Mezcla las capas (de la superior a la inferior) en un RGBA uint8.
+        Devuelve None si ninguna tiene datos en el tile.
+        """
+        color = alfa = None
+        for capa in capas:
+            try:
+                rgba = tile_renderer.render_rgba(capa.path, z, x, y)
+            except Exception as e:
+                logger.error(f"Error leyendo capa {capa.id} para tile compuesto {z}/{x}/{y}: {e}")
+                continue
+            if rgba is None:
+                continue
+
+            if color is None:
+                # Caso frecuente: una sola capa opaca cubre todo el tile
+                if capa.opacidad >= 1 and rgba[..., 3].min() == 255:
+                    return rgba
+                a = rgba[..., 3] * np.float32(capa.opacidad / 255)
+                color = rgba[..., :3] * a[..., None]
+                alfa = a
+            else:
+                peso = (1 - alfa) * rgba[..., 3] * np.float32(capa.opacidad / 255)
+                color += rgba[..., :3] * peso[..., None]
+                alfa += peso
+
+            if alfa.min() >= _OPACO:
+                break
+
+        if color is None:
+            return None
+
+        salida = np.empty((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        # Color premultiplicado -> color directo
+        np.divide(color, alfa[..., None], out=color, where=alfa[..., None] > 0)
+        np.clip(color + 0.5, 0, 255, out=color)
+        salida[..., :3] = color
+        salida[..., 3] = np.clip(alfa * 255 + 0.5, 0, 255)
+        return salida
+
+
+compositor = CompositorTiles()
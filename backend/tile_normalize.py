@@ -0,0 +1,151 @@
+"""
+Normalización de tiles a RGBA uint8 (ruta caliente del render).
+
+Antes read_tile hacía en cada tile np.nan_to_num, np.clip, una resta, una
+división, una multiplicación y astype(np.uint8), creando varios arreglos
+float temporales del tamaño del tile. Aquí cada handle tiene un Normalizador
+preparado una sola vez con el estiramiento de sus bandas:
+
+- 8 y 16 bits: tablas de consulta (LUT) de 256/65536 entradas; cada banda
+  se resuelve con un solo np.take sin aritmética por píxel, escribiendo el
+  RGBA como uint32 empaquetado.
+- float y enteros de 32 bits: operaciones in-place sobre un búfer float32
+  reservado por hilo (threadpool de FastAPI), sin temporales nuevos. fmax
+  descarta los NaN en el mismo paso del recorte.
+- Una banda (DEM): la salida se escribe como uint32 empaquetado (RGBA) con
+  una sola consulta a una LUT de color, así que una rampa de color
+  (COLORMAPS) cuesta lo mismo que la escala de grises.
+"""
+
+import threading
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Rampas de color para rasters de una banda: puntos de control (posición 0-1, RGB)
+COLORMAPS: Dict[str, Tuple[Tuple[float, Tuple[int, int, int]], ...]] = {
+    "gray": ((0.0, (0, 0, 0)), (1.0, (255, 255, 255))),
+    # Hipsométrica: tierras bajas verdes, piedemonte ocre, páramo y nieve
+    "terrain": (
+        (0.0, (0, 97, 71)), (0.15, (16, 122, 47)), (0.3, (232, 215, 125)),
+        (0.5, (161, 67, 0)), (0.75, (130, 30, 30)), (0.9, (110, 110, 110)), (1.0, (255, 255, 255)),
+    ),
+    "viridis": (
+        (0.0, (68, 1, 84)), (0.25, (59, 82, 139)), (0.5, (33, 145, 140)),
+        (0.75, (94, 201, 98)), (1.0, (253, 231, 37)),
+    ),
+    # Divergente rojo-amarillo-verde (pendientes, índices de vegetación)
+    "rdylgn": (
+        (0.0, (165, 0, 38)), (0.25, (244, 109, 67)), (0.5, (255, 255, 191)),
+        (0.75, (102, 189, 99)), (1.0, (0, 104, 55)),
+    ),
+}
+
+_hilos = threading.local()
+
+
+def _buffer(forma: tuple, dtype) -> np.ndarray:
+    """Búfer reutilizable del hilo actual (un tile a la vez por hilo)."""
+    buffers = getattr(_hilos, "buffers", None)
+    if buffers is None:
+        buffers = _hilos.buffers = {}
+    clave = (forma, np.dtype(dtype).str)
+    buf = buffers.get(clave)
+    if buf is None:
+        buf = buffers[clave] = np.empty(forma, dtype=dtype)
+    return buf
+
+
+def empaquetar(rgb: np.ndarray) -> np.ndarray:
+    """(N, 3) uint8 -> (N,) uint32 con los bytes RGBA en orden de memoria (alfa 255)."""
+    rgba = np.empty((len(rgb), 4), dtype=np.uint8)
+    rgba[:, :3] = rgb
+    rgba[:, 3] = 255
+    return rgba.view(np.uint32).ravel()
+
+
+def rampa(nombre: str) -> np.ndarray:
+    """Colormap como LUT (256, 3) uint8."""
+    puntos = COLORMAPS[nombre]
+    posiciones = np.array([p for p, _ in puntos]) * 255
+    colores = np.array([c for _, c in puntos], dtype=np.float64)
+    x = np.arange(256)
+    return np.stack([np.interp(x, posiciones, colores[:, i]) for i in range(3)], axis=1).round().astype(np.uint8)
+
+
+class Normalizador:
+    """
+    Convierte los datos leídos (bandas, alto, ancho) en un RGBA uint8 nuevo.
+
+    bajo/alto: estiramiento por banda, forma (bandas, 1, 1), o None si los
+    datos ya son uint8. El colormap solo aplica a rasters de 1-2 bandas.
+    """
+
+    def __init__(self, dtype, bandas: int, estiramiento: Optional[Tuple[np.ndarray, np.ndarray]],
+                 colormap: Optional[str] = None):
+        self.dtype = np.dtype(dtype)
+        self.una_banda = bandas < 3
+        self._usadas = usadas = 1 if self.una_banda else 3
+
+        if estiramiento is None:
+            bajo, alto = np.zeros(usadas, np.float32), np.full(usadas, 255, np.float32)
+        else:
+            bajo, alto = (np.asarray(v, np.float32).ravel()[:usadas] for v in estiramiento)
+        # Igual que antes: (v - bajo) / (alto - bajo) * 255, truncado; rango nulo -> 0
+        self._bajo = bajo.reshape(-1, 1, 1)
+        self._escala = np.where(alto > bajo, 255 / np.where(alto > bajo, alto - bajo, 1), 0).astype(np.float32).reshape(-1, 1, 1)
+
+        self._color = empaquetar(rampa(colormap or "gray")) if self.una_banda else None
+        self._lut = None
+        if self.dtype.itemsize <= 2 and self.dtype.kind in "ui":
+            self._lut = self._construir_lut(estiramiento is None)
+
+    def _construir_lut(self, identidad: bool) -> np.ndarray:
+        entradas = 256 if self.dtype.itemsize == 1 else 65536
+        # Los índices son los bits del valor (int16 se ve como uint16)
+        valores = np.arange(entradas, dtype=np.uint8 if entradas == 256 else np.uint16).view(self.dtype)
+        valores = valores.astype(np.float32)
+        if identidad:
+            indices = np.repeat(np.clip(valores, 0, 255).astype(np.uint8)[None, :], self._usadas, axis=0)
+        else:
+            indices = np.clip((valores - self._bajo[:, 0]) * self._escala[:, 0], 0, 255).astype(np.uint8)
+        if self.una_banda:
+            return self._color[indices[0]]
+        # Multibanda: una LUT uint32 por banda con el valor ya en el byte de su canal,
+        # la salida se arma con OR sin escribir en vistas intercaladas (lentas)
+        luts = np.zeros((3, entradas, 4), dtype=np.uint8)
+        for b in range(3):
+            luts[b, :, b] = indices[b]
+        return luts.view(np.uint32)[..., 0]
+
+    def aplicar(self, data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        alto, ancho = data.shape[1:]
+        salida = np.empty((alto, ancho, 4), dtype=np.uint8)
+
+        if self._lut is not None:
+            indices = data.view(np.uint8 if self.dtype.itemsize == 1 else np.uint16)
+            salida32 = salida.view(np.uint32)[..., 0]
+            if self.una_banda:
+                np.take(self._lut, indices[0], out=salida32, mode="clip")
+            else:
+                np.take(self._lut[0], indices[0], out=salida32, mode="clip")
+                canal = _buffer((alto, ancho), np.uint32)
+                for b in (1, 2):
+                    np.take(self._lut[b], indices[b], out=canal, mode="clip")
+                    np.bitwise_or(salida32, canal, out=salida32)
+        else:
+            buf = _buffer((self._usadas, alto, ancho), np.float32)
+            np.subtract(data[:self._usadas], self._bajo, out=buf, casting="unsafe")
+            np.multiply(buf, self._escala, out=buf)
+            np.fmax(buf, 0, out=buf)  # también reemplaza NaN por 0
+            np.minimum(buf, 255, out=buf)
+            if self.una_banda:
+                indices = _buffer((alto, ancho), np.uint8)
+                np.copyto(indices, buf[0], casting="unsafe")
+                np.take(self._color, indices, out=salida.view(np.uint32)[..., 0], mode="clip")
+            else:
+                for b in range(3):
+                    np.copyto(salida[..., b], buf[b], casting="unsafe")
+
+        salida[..., 3] = mask
+        return salida
@@ -5,8 +5,11 @@ Key optimizations:
 1. Uses WarpedVRT to let GDAL read from internal overviews automatically
 2. Keeps file handles open via LRU cache (avoids re-open per tile)
 3. Reads only the needed window, not the full raster
-4. Uses WEBP output (much smaller than PNG, ~70% savings)
-5. Global min/max normalization (computed once per file, cached)
+4. WEBP output by default (much smaller than PNG, ~70% savings); PNG/JPEG and
+   lossless WEBP (DEMs) via format negotiation, with fast/seed encode profiles
+5. Per-band percentile stretch read from the COG's GDAL metadata (computed
+   once by convert_to_cog, no pixel reads when a handle opens), applied with
+   precomputed LUTs / in-place ops (tile_normalize), optional colormaps
 6. Transparent tile returned instantly for out-of-bounds requests
 """
 
@@ -17,6 +20,7 @@ import hashlib
 import numpy as np
 from functools import lru_cache
 from threading import Lock
+from typing import NamedTuple
 
 import rasterio
 from rasterio.vrt import WarpedVRT
@@ -25,6 +29,9 @@ from rasterio.transform import from_bounds
 from rasterio.warp import transform_bounds
 from PIL import Image
 
+from raster_stats import calcular_estadisticas, rango_estiramiento, rango_desde_estadisticas
+from tile_normalize import Normalizador
+
 logger = logging.getLogger(__name__)
 
 # --- Constants ---
@@ -44,18 +51,56 @@ _EMPTY_BUF_PNG = io.BytesIO()
 _EMPTY_IMG.save(_EMPTY_BUF_PNG, format="PNG")
 EMPTY_TILE_PNG = _EMPTY_BUF_PNG.getvalue()
 
+# --- Output formats ---
+# "lossless" is WEBP lossless: exact values for DEMs at a fraction of PNG's size
+TILE_FORMATS = ("webp", "png", "jpeg", "lossless")
+MEDIA_TYPES = {
+    "webp": "image/webp",
+    "lossless": "image/webp",
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+}
+FORMAT_ALIASES = {"jpg": "jpeg"}
+
+# Pillow save() options per profile.
+# "fast" is used for on-demand rendering (request latency matters),
+# "seed" for background cache seeding (tiles are served many times, size matters).
+# See bench_tile_encoding.py for the numbers behind these settings.
+ENCODE_PROFILES = {
+    "fast": {
+        "webp": {"format": "WEBP", "quality": 80, "method": 0},
+        "lossless": {"format": "WEBP", "lossless": True, "quality": 25, "method": 1},
+        "png": {"format": "PNG", "compress_level": 1},
+        "jpeg": {"format": "JPEG", "quality": 85},
+    },
+    "seed": {
+        "webp": {"format": "WEBP", "quality": 82, "method": 4},
+        "lossless": {"format": "WEBP", "lossless": True, "quality": 80, "method": 4},
+        "png": {"format": "PNG", "optimize": True},
+        "jpeg": {"format": "JPEG", "quality": 85, "optimize": True},
+    },
+}
+
+
+def file_version(file_path: str) -> str:
+    """Version of a raster file (mtime + size); changes when it is rewritten or its stats are saved."""
+    st = os.stat(file_path)
+    return f"{st.st_mtime_ns:x}{st.st_size:x}"
+
 
 class VRTHandle:
     """Wraps a rasterio dataset opened through WarpedVRT for efficient tile reads."""
     
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, version: str | None = None):
         self.file_path = file_path
+        self.version = version
         self.lock = Lock()
         self._src = None
         self._vrt = None
         self._bounds_3857 = None
         self._band_count = 0
-        self._stats = None  # (global_min, global_max) per band or overall
+        self._stats = None  # (low, high) per band, shape (bands, 1, 1)
+        self._normalizers = {}  # colormap -> Normalizador
         self._open()
     
     def _open(self):
@@ -74,7 +119,8 @@ class VRTHandle:
                 self._bounds_3857 = self._vrt.bounds
                 self._band_count = self._vrt.count
                 
-                self._compute_stats()
+                self._load_stats()
+                self._normalizers = {}
                 
                 logger.info(
                     f"VRTHandle opened: {os.path.basename(self.file_path)}, "
@@ -91,10 +137,12 @@ class VRTHandle:
         logger.error(f"Failed to open VRT for {self.file_path} after 3 attempts: {last_error}")
         raise last_error
 
-    def _compute_stats(self):
+    def _load_stats(self):
         """
-        Compute global min/max for normalization using the lowest-res overview.
-        This is fast because it reads from the smallest overview layer.
+        Per-band stretch range (low/high percentiles) for non-uint8 rasters.
+        Read from the GDAL band metadata written by convert_to_cog, so opening
+        a handle costs no pixel reads. Files processed before that fall back to
+        computing them from a small overview read.
         """
         try:
             if self._vrt.dtypes[0] == 'uint8':
@@ -102,29 +150,25 @@ class VRTHandle:
                 self._stats = None
                 return
             
-            # Read from the lowest resolution overview for speed
-            # Use a very small output shape (like 256x256) to force overview usage
-            overview_data = self._vrt.read(
-                out_shape=(self._band_count, 256, 256),
-                resampling=Resampling.average
-            )
-            # Exclude nodata/zeros for better range
-            mask = overview_data != 0
-            if mask.any():
-                self._stats = (
-                    float(np.nanmin(overview_data[mask])),
-                    float(np.nanmax(overview_data[mask]))
-                )
-            else:
-                self._stats = (0.0, 255.0)
+            stretch = rango_estiramiento(self._src)
+            source = "metadata"
+            if stretch is None:
+                stretch = rango_desde_estadisticas(calcular_estadisticas(self._src, lado_max=TILE_SIZE))
+                source = "overview"
+            if stretch is None:
+                stretch = (np.zeros(self._band_count, np.float32), np.full(self._band_count, 255, np.float32))
+                source = "default"
+            low, high = stretch
+            self._stats = (low.reshape(-1, 1, 1), high.reshape(-1, 1, 1))
                 
             logger.info(
-                f"Stats for {os.path.basename(self.file_path)}: "
-                f"min={self._stats[0]:.2f}, max={self._stats[1]:.2f}"
+                f"Stats for {os.path.basename(self.file_path)} ({source}): "
+                f"low={np.round(low, 2).tolist()}, high={np.round(high, 2).tolist()}"
             )
         except Exception as e:
-            logger.warning(f"Could not compute stats: {e}, defaulting")
-            self._stats = (0.0, 255.0)
+            logger.warning(f"Could not load stats: {e}, defaulting")
+            self._stats = (np.zeros((self._band_count, 1, 1), np.float32),
+                           np.full((self._band_count, 1, 1), 255, np.float32))
     
     def close(self):
         """Close datasets safely with locking."""
@@ -142,6 +186,14 @@ class VRTHandle:
                     pass
                 self._src = None
     
+    def _normalizer(self, colormap: str | None) -> Normalizador:
+        """Per-colormap normalizer (LUTs built once per handle)."""
+        normalizer = self._normalizers.get(colormap)
+        if normalizer is None:
+            normalizer = Normalizador(self._vrt.dtypes[0], self._band_count, self._stats, colormap)
+            self._normalizers[colormap] = normalizer
+        return normalizer
+    
     @property
     def bounds(self):
         return self._bounds_3857
@@ -150,6 +202,11 @@ class VRTHandle:
     def band_count(self):
         return self._band_count
     
+    @property
+    def is_dem(self):
+        """Single-band non-uint8 raster (elevation model)."""
+        return self._band_count == 1 and self.needs_normalization
+    
     @property
     def needs_normalization(self):
         return self._stats is not None
@@ -158,17 +215,14 @@ class VRTHandle:
     def stats(self):
         return self._stats
     
-    def read_tile(self, z: int, x: int, y: int) -> bytes | None:
+    def _read_window(self, z: int, x: int, y: int, indexes=None, pad: int = 0):
         """
-        Read a single tile. Returns WEBP bytes or None if tile is empty/OOB.
+        Read the pixels of a tile (plus `pad` pixels on every side) and the mask.
+        Returns (data, mask) or None if the tile is out of bounds or unreadable.
         """
         import time
         # 1. Tile bounds in EPSG:3857
-        tile_size_m = EARTH_HALF_CIRC * 2 / (2 ** z)
-        tile_left = -EARTH_HALF_CIRC + x * tile_size_m
-        tile_top = EARTH_HALF_CIRC - y * tile_size_m
-        tile_right = tile_left + tile_size_m
-        tile_bottom = tile_top - tile_size_m
+        tile_left, tile_bottom, tile_right, tile_top = tile_bounds_3857(z, x, y)
         
         # 2. Quick bounds check
         rb = self._bounds_3857
@@ -176,6 +230,11 @@ class VRTHandle:
             tile_top <= rb.bottom or tile_bottom >= rb.top):
             return None  # Out of bounds
         
+        margin = (tile_right - tile_left) / TILE_SIZE * pad
+        size = TILE_SIZE + 2 * pad
+        if indexes is None:
+            indexes = list(range(1, self._band_count + 1))
+        
         # Retry loop for reading
         for attempt in range(3):
             try:
@@ -185,26 +244,27 @@ class VRTHandle:
                         self._open()
 
                     window = rasterio.windows.from_bounds(
-                        tile_left, tile_bottom, tile_right, tile_top,
+                        tile_left - margin, tile_bottom - margin, tile_right + margin, tile_top + margin,
                         transform=self._vrt.transform
                     )
                     
                     data = self._vrt.read(
+                        indexes,
                         window=window,
-                        out_shape=(self._band_count, TILE_SIZE, TILE_SIZE),
+                        out_shape=(len(indexes), size, size),
                         resampling=Resampling.bilinear
                     )
                     
                     mask = self._vrt.read_masks(
                         1,
                         window=window,
-                        out_shape=(1, TILE_SIZE, TILE_SIZE),
+                        out_shape=(1, size, size),
                         resampling=Resampling.nearest
                     )
                     if mask.ndim == 3:
                         mask = mask[0]
                 
-                break  # Success
+                return data, mask
             except Exception as e:
                 # If it's a file lock error, wait and retry
                 if attempt < 2:
@@ -213,43 +273,171 @@ class VRTHandle:
                 logger.error(f"Error reading tile {z}/{x}/{y} from {os.path.basename(self.file_path)}: {e}")
                 return None
 
-        # 4. Check if tile is completely empty
+    def read_rgba(self, z: int, x: int, y: int, colormap: str | None = None) -> np.ndarray | None:
+        """
+        Read a single tile as an RGBA uint8 array (TILE_SIZE x TILE_SIZE x 4).
+        colormap (COLORMAPS) applies to single-band rasters only.
+        Returns None if the tile is empty/OOB.
+        """
+        result = self._read_window(z, x, y)
+        if result is None:
+            return None
+        data, mask = result
+
+        # 3. Check if tile is completely empty
         if not mask.any():
             return None
         
+        # 4. Normalize to uint8 and assemble RGBA (LUT / in-place, mask as alpha)
         try:
-            data = np.nan_to_num(data)
-            
-            # 5. Normalize to uint8 if needed
-            if self.needs_normalization:
-                g_min, g_max = self._stats
-                if g_max > g_min:
-                    data = np.clip(data, g_min, g_max)
-                    data = ((data - g_min) / (g_max - g_min) * 255).astype(np.uint8)
-                else:
-                    data = np.zeros_like(data, dtype=np.uint8)
-            else:
-                data = data.astype(np.uint8)
-            
-            # 6. Create image
-            if self._band_count >= 3:
-                img_data = np.transpose(data[:3], (1, 2, 0))
-                img = Image.fromarray(img_data, mode='RGB')
-            else:
-                img = Image.fromarray(data[0], mode='L').convert('RGB')
-            
-            # Apply alpha mask
-            img.putalpha(Image.fromarray(mask, mode='L'))
-            
-            # 7. Encode to WEBP
-            buf = io.BytesIO()
-            img.save(buf, format="WEBP", quality=82, method=4)
-            return buf.getvalue()
-            
+            return self._normalizer(colormap).aplicar(data, mask)
         except Exception as e:
-            logger.error(f"Error encoding/processing tile {z}/{x}/{y}: {e}")
+            logger.error(f"Error processing tile {z}/{x}/{y}: {e}")
             return None
 
+    def read_elevation(self, z: int, x: int, y: int, pad: int = 0) -> np.ndarray | None:
+        """
+        Raw values of band 1 as float32 ((TILE_SIZE + 2*pad)² , NaN = nodata),
+        without any stretch. `pad` extra pixels let 3x3 kernels (hillshade,
+        slope) see past the tile edge so neighbouring tiles join seamlessly.
+        Returns None if the tile is empty/OOB.
+        """
+        result = self._read_window(z, x, y, indexes=[1], pad=pad)
+        if result is None:
+            return None
+        data, mask = result
+        if not mask.any():
+            return None
+        elevation = data[0].astype(np.float32, copy=False)
+        elevation[mask == 0] = np.nan
+        return elevation
+
+    def sample(self, xs: np.ndarray, ys: np.ndarray, indexes=None) -> np.ndarray:
+        """
+        Pixel values at points given in the raster's own CRS (no warping).
+        Points are grouped by internal block so each COG block touched is read
+        once. Returns float64 (bands, n); NaN = nodata / outside the raster.
+        """
+        if indexes is None:
+            indexes = list(range(1, self._band_count + 1))
+        values = np.full((len(indexes), len(xs)), np.nan)
+        
+        src = self._src
+        cols, rows = ~src.transform * (np.asarray(xs, np.float64), np.asarray(ys, np.float64))
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        points = np.flatnonzero(inside)
+        if not len(points):
+            return values
+        rows = rows[points].astype(np.int64)
+        cols = cols[points].astype(np.int64)
+        
+        block_h, block_w = src.block_shapes[0]
+        blocks_x = -(-src.width // block_w)
+        block_ids = (rows // block_h) * blocks_x + cols // block_w
+        order = np.argsort(block_ids, kind="stable")
+        block_ids, points, rows, cols = block_ids[order], points[order], rows[order], cols[order]
+        starts = np.flatnonzero(np.r_[True, block_ids[1:] != block_ids[:-1]])
+        ends = np.r_[starts[1:], len(block_ids)]
+        
+        for start, end in zip(starts, ends):
+            row0 = int(rows[start] // block_h * block_h)
+            col0 = int(cols[start] // block_w * block_w)
+            window = rasterio.windows.Window(
+                col0, row0, min(block_w, src.width - col0), min(block_h, src.height - row0)
+            )
+            with self.lock:
+                if self._src.closed:
+                    self._open()
+                    src = self._src
+                block = src.read(indexes, window=window, masked=True)
+            picked = block[:, rows[start:end] - row0, cols[start:end] - col0]
+            values[:, points[start:end]] = picked.astype(np.float64).filled(np.nan)
+        return values
+
+    def read_tile(self, z: int, x: int, y: int, fmt: str = "webp", profile: str = "fast",
+                  colormap: str | None = None) -> bytes | None:
+        """
+        Read a single tile. Returns encoded bytes or None if tile is empty/OOB.
+        """
+        rgba = self.read_rgba(z, x, y, colormap)
+        if rgba is None:
+            return None
+        try:
+            return encode_tile(rgba, fmt, profile)
+        except Exception as e:
+            logger.error(f"Error encoding tile {z}/{x}/{y}: {e}")
+            return None
+
+
+def tile_bounds_3857(z: int, x: int, y: int) -> tuple:
+    """(left, bottom, right, top) of an XYZ tile in EPSG:3857."""
+    tile_size_m = EARTH_HALF_CIRC * 2 / (2 ** z)
+    left = -EARTH_HALF_CIRC + x * tile_size_m
+    top = EARTH_HALF_CIRC - y * tile_size_m
+    return left, top - tile_size_m, left + tile_size_m, top
+
+
+def encode_tile(rgba: np.ndarray, fmt: str = "webp", profile: str = "fast") -> bytes:
+    """
+    Encode an RGBA uint8 array. JPEG has no alpha channel, so tiles with
+    transparent pixels fall back to PNG; fully opaque PNG/JPEG tiles drop alpha.
+    """
+    if fmt == "jpeg" and rgba[..., 3].min() < 255:
+        fmt = "png"
+    img = Image.fromarray(rgba, mode='RGBA')
+    if fmt in ("png", "jpeg") and (fmt == "jpeg" or rgba[..., 3].min() == 255):
+        img = img.convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, **ENCODE_PROFILES[profile][fmt])
+    return buf.getvalue()
+
+
+def tile_cache_key(name: str, z: int, x: int, y: int, fmt: str = "webp") -> str:
+    """Disk cache key of a tile (WEBP keeps the historical format-less key)."""
+    key = f"{name}-{z}-{x}-{y}"
+    return key if fmt == "webp" else f"{key}.{fmt}"
+
+
+def media_type_for(data: bytes) -> str:
+    """Media type of encoded tile bytes (cached tiles may be in any format)."""
+    if data[:4] == b'RIFF':
+        return "image/webp"
+    if data[:2] == b'\xff\xd8':
+        return "image/jpeg"
+    return "image/png"
+
+
+def empty_tile(fmt: str) -> bytes:
+    """Transparent tile in the requested format (JPEG can't be transparent -> PNG)."""
+    return EMPTY_TILE_BYTES if MEDIA_TYPES.get(fmt) == "image/webp" else EMPTY_TILE_PNG
+
+
+def negotiate_format(requested: str | None, accept: str | None, dem: bool = False) -> str:
+    """
+    Pick the output format for a tile request.
+
+    - requested: explicit format (webp, png, jpg/jpeg, lossless), always
+      honoured; None = auto. The historical ".png" route without ?format=
+      is negotiated, so its caller passes None (browsers loading <img>
+      accept WEBP).
+    - DEM rasters get lossless WEBP in auto mode (no compression artifacts
+      in the elevation ramp).
+    """
+    requested = FORMAT_ALIASES.get(requested, requested)
+    webp_ok = accept is None or "image/webp" in accept or "*/*" in accept
+    if requested in TILE_FORMATS:
+        return requested
+    if not webp_ok:
+        return "png"
+    return "lossless" if dem else "webp"
+
+
+class RasterInfo(NamedTuple):
+    """What the tile endpoint needs before its cache lookup (kept per file version)."""
+    version: str
+    needs_normalization: bool
+    is_dem: bool
+
 
 class TileRenderer:
     """
@@ -257,18 +445,31 @@ class TileRenderer:
     Keeps file handles open to avoid repeated open/close overhead.
     """
     
-    def __init__(self, max_handles: int = 20):
+    def __init__(self, max_handles: int = 20, max_info: int = 1024):
         self._handles: dict[str, VRTHandle] = {}
         self._lock = Lock()
         self._max_handles = max_handles
+        # Outlives the handles (evicted FIFO at max_handles): tile cache hits
+        # resolve format and cache key without opening the file with GDAL
+        self._info: dict[str, RasterInfo] = {}
+        self._max_info = max_info
     
     def _get_handle(self, file_path: str) -> VRTHandle:
-        """Get or create a VRT handle for a file."""
+        """
+        Get or create a VRT handle for a file.
+        A handle opened on an older version of the file (e.g. before another
+        worker saved its stats) is reopened so it picks up the new stretch.
+        """
         abs_path = os.path.abspath(file_path)
+        version = file_version(abs_path)
         
         with self._lock:
-            if abs_path in self._handles:
-                return self._handles[abs_path]
+            handle = self._handles.get(abs_path)
+            if handle is not None:
+                if handle.version == version:
+                    return handle
+                handle.close()
+                del self._handles[abs_path]
             
             # Evict oldest if at capacity
             if len(self._handles) >= self._max_handles:
@@ -276,17 +477,79 @@ class TileRenderer:
                 self._handles[oldest_key].close()
                 del self._handles[oldest_key]
             
-            handle = VRTHandle(abs_path)
+            handle = VRTHandle(abs_path, version)
             self._handles[abs_path] = handle
             return handle
     
-    def render_tile(self, file_path: str, z: int, x: int, y: int) -> bytes | None:
+    def render_tile(self, file_path: str, z: int, x: int, y: int,
+                    fmt: str = "webp", profile: str = "fast", colormap: str | None = None) -> bytes | None:
         """
         Render a tile from a raster file.
-        Returns WEBP bytes or None if tile is empty.
+        Returns encoded bytes (WEBP by default) or None if tile is empty.
+        """
+        handle = self._get_handle(file_path)
+        return handle.read_tile(z, x, y, fmt, profile, colormap)
+    
+    def raster_info(self, file_path: str) -> RasterInfo:
+        """Version / normalization / DEM flags of a raster; only opens it on a new file version."""
+        abs_path = os.path.abspath(file_path)
+        info = self._info.get(abs_path)
+        if info is not None and info.version == file_version(abs_path):
+            return info
+        
+        handle = self._get_handle(abs_path)
+        info = RasterInfo(handle.version, handle.needs_normalization, handle.is_dem)
+        with self._lock:
+            self._info.pop(abs_path, None)
+            if len(self._info) >= self._max_info:
+                del self._info[next(iter(self._info))]
+            self._info[abs_path] = info
+        return info
+    
+    def is_dem(self, file_path: str) -> bool:
+        return self.raster_info(file_path).is_dem
+    
+    def band_count(self, file_path: str) -> int:
+        return self._get_handle(file_path).band_count
+    
+    def cache_name(self, file_path: str, colormap: str | None = None) -> str:
+        """
+        Cache name of a raster's tiles (see tile_cache_key). Normalized
+        (non-uint8) rasters include the file version, so tiles rendered with
+        an older stretch are never served next to new ones; uint8 rasters keep
+        the historical name.
+        """
+        info = self.raster_info(file_path)
+        name = os.path.basename(file_path)
+        if colormap:
+            name = f"{name}~{colormap}"
+        return f"{name}@{info.version}" if info.needs_normalization else name
+    
+    def crs(self, file_path: str):
+        """Native CRS of the raster (before warping to EPSG:3857)."""
+        handle = self._get_handle(file_path)
+        with handle.lock:
+            return handle._src.crs
+    
+    def sample(self, file_path: str, xs, ys, indexes=None) -> np.ndarray:
+        """Pixel values at points in the raster's native CRS (see VRTHandle.sample)."""
+        return self._get_handle(file_path).sample(xs, ys, indexes)
+    
+    def render_elevation(self, file_path: str, z: int, x: int, y: int, pad: int = 0) -> np.ndarray | None:
+        """Raw elevation tile (float32, NaN = nodata) for terrain products."""
+        return self._get_handle(file_path).read_elevation(z, x, y, pad)
+
+    def render_rgba(self, file_path: str, z: int, x: int, y: int) -> np.ndarray | None:
+        """
+        Render a tile as an RGBA array (for server-side compositing).
+        Returns None if tile is empty.
         """
         handle = self._get_handle(file_path)
-        return handle.read_tile(z, x, y)
+        return handle.read_rgba(z, x, y)
+    
+    def bounds_3857(self, file_path: str):
+        """Raster bounds in EPSG:3857 (opens the handle if needed)."""
+        return self._get_handle(file_path).bounds
     
     def invalidate(self, file_path: str):
         """Close and remove a cached handle (e.g., after file update)."""
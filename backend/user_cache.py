@@ -0,0 +1,159 @@
+"""
+Caché en proceso de autenticación y permisos.
+
+get_current_user se ejecuta en cada solicitud autenticada (los mapas disparan
+decenas por segundo). Este módulo evita repetir trabajo:
+
+- Tokens: JWT ya validado -> username (hasta su expiración).
+- Usuarios: username -> User desacoplado de la sesión (TTL corto). Cada
+  solicitud recibe una copia adjunta a su sesión con merge(load=False), sin
+  consultar la base de datos; las relaciones se siguen cargando bajo demanda.
+- Accesos: user_id -> frozenset de ids de proyectos propios o asignados, para
+  que las verificaciones de permisos sean una búsqueda O(1).
+
+Invalidación: crud.update_user/delete_user y los cambios de asignaciones
+llaman a user_cache.invalidar(). Como hay varios workers de gunicorn, la
+invalidación incrementa además un contador de generación en un diskcache
+compartido; cada worker lo compara antes de usar su caché local.
+"""
+
+import os
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock
+from typing import FrozenSet, Optional, Tuple
+
+from sqlalchemy import select, union
+from sqlalchemy.orm import Session
+
+import models
+from shared import auth_cache
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 30))
+USER_CACHE_MAX_ITEMS = int(os.getenv("USER_CACHE_MAX_ITEMS", 2048))
+
+_CLAVE_GENERACION = "generacion"
+
+
+class _TTLCache:
+    """LRU con expiración por entrada (no thread-safe; se usa bajo el lock del dueño)."""
+
+    def __init__(self, max_items: int):
+        self._datos: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self._max_items = max_items
+
+    def get(self, clave):
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        expira, valor = entrada
+        if expira < time.monotonic():
+            del self._datos[clave]
+            return None
+        self._datos.move_to_end(clave)
+        return valor
+
+    def set(self, clave, valor, ttl: float):
+        self._datos[clave] = (time.monotonic() + ttl, valor)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self._max_items:
+            self._datos.popitem(last=False)
+
+    def clear(self):
+        self._datos.clear()
+
+
+class UserCache:
+    """Caché de tokens, usuarios y conjuntos de acceso a proyectos."""
+
+    def __init__(self, shared_cache, ttl: float = USER_CACHE_TTL_SECONDS, max_items: int = USER_CACHE_MAX_ITEMS):
+        self._shared = shared_cache
+        self._ttl = ttl
+        self._lock = Lock()
+        self._tokens = _TTLCache(max_items)
+        self._usuarios = _TTLCache(max_items)
+        self._accesos = _TTLCache(max_items)
+        self._generacion = self._leer_generacion()
+
+    # --- Invalidación ---
+    def _leer_generacion(self) -> int:
+        return self._shared.get(_CLAVE_GENERACION, 0) if self._shared is not None else 0
+
+    def _sincronizar_generacion(self):
+        """Vacía la caché local si otro worker (o este) invalidó desde la última lectura."""
+        generacion = self._leer_generacion()
+        if generacion != self._generacion:
+            with self._lock:
+                self._usuarios.clear()
+                self._accesos.clear()
+                self._generacion = generacion
+
+    def invalidar(self):
+        """Invalida usuarios y accesos en todos los workers (tras editar usuarios o asignaciones)."""
+        if self._shared is not None:
+            self._shared.incr(_CLAVE_GENERACION, default=0)
+        with self._lock:
+            self._usuarios.clear()
+            self._accesos.clear()
+            self._generacion = self._leer_generacion()
+
+    # --- Tokens ---
+    def username_de_token(self, token: str) -> Optional[str]:
+        with self._lock:
+            return self._tokens.get(token)
+
+    def guardar_token(self, token: str, username: str, exp: Optional[float]):
+        restante = (exp - time.time()) if exp else self._ttl
+        if restante > 0:
+            with self._lock:
+                self._tokens.set(token, username, restante)
+
+    # --- Usuarios ---
+    def obtener_usuario(self, db: Session, username: str) -> Optional[models.User]:
+        """
+        Devuelve el usuario adjunto a la sesión `db`, consultándolo solo si no está en caché.
+        """
+        self._sincronizar_generacion()
+        with self._lock:
+            cacheado = self._usuarios.get(username)
+
+        if cacheado is None:
+            usuario = db.query(models.User).filter(models.User.username == username).first()
+            if usuario is None:
+                return None
+            # Desacoplar una copia con las columnas cargadas para compartirla entre solicitudes
+            db.expunge(usuario)
+            with self._lock:
+                self._usuarios.set(username, usuario, self._ttl)
+            cacheado = usuario
+
+        # merge(load=False) copia el estado sin emitir SELECT
+        return db.merge(cacheado, load=False)
+
+    # --- Accesos a proyectos ---
+    def proyectos_accesibles(self, db: Session, user_id: int) -> FrozenSet[int]:
+        """Ids de proyectos donde el usuario es dueño o está asignado."""
+        self._sincronizar_generacion()
+        with self._lock:
+            accesos = self._accesos.get(user_id)
+        if accesos is not None:
+            return accesos
+
+        consulta = union(
+            select(models.Project.id).where(models.Project.owner_id == user_id),
+            select(models.user_projects.c.project_id).where(models.user_projects.c.user_id == user_id),
+        )
+        accesos = frozenset(db.execute(consulta).scalars().all())
+        with self._lock:
+            self._accesos.set(user_id, accesos, self._ttl)
+        return accesos
+
+    def tiene_acceso(self, db: Session, user: models.User, project_id: int) -> bool:
+        """Dueño o asignado (los administradores se verifican aparte en cada endpoint)."""
+        return project_id in self.proyectos_accesibles(db, user.id)
+
+
+user_cache = UserCache(auth_cache)
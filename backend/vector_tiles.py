@@ -0,0 +1,429 @@
+"""
+Vector tiles (Mapbox Vector Tile) para capas vectoriales.
+
+Los KML/KMZ, SHP/GeoJSON/GPKG y DXF se servían crudos (o no se mostraban) y
+el navegador los parseaba completos, lo que congela el mapa con archivos de
+varios MB. Ahora el pipeline de procesamiento carga los elementos en la tabla
+vector_features (EPSG:3857, índice GiST) y /vtiles/{layer_id}/{z}/{x}/{y}.mvt
+genera con ST_AsMVT solo la geometría visible del tile, simplificada a la
+resolución del zoom y recortada al tile (más un margen para los bordes).
+
+Los tiles generados se guardan en tile_cache con una etiqueta por capa, de
+modo que una re-ingesta invalida únicamente los tiles de esa capa.
+"""
+
+import io
+import os
+import csv
+import json
+import time
+import logging
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+from shapely.geometry import LineString, Point, shape
+from shapely.geometry.base import BaseGeometry
+from sqlalchemy import delete, text
+from sqlalchemy.orm import Session
+
+import models
+from layer_bounds import extension_vector_features
+from shared import tile_cache
+
+logger = logging.getLogger(__name__)
+
+# Nombre de la capa dentro del MVT (el frontend lo usa para los estilos)
+MVT_CAPA = "features"
+MVT_EXTENT = 4096
+MVT_BUFFER = 64
+# Vigencia de los tiles vectoriales en el caché de disco
+MVT_CACHE_SEGUNDOS = 86400 * 30
+# Elementos por lote de reproyección + COPY durante la ingesta
+INGESTA_LOTE = 10000
+
+# CRS de los dibujos CAD cuando la capa no indica uno (MAGNA-SIRGAS / Origen-Nacional)
+CAD_DEFAULT_CRS = os.getenv("CAD_DEFAULT_CRS", "EPSG:9377")
+# Entidades del modelspace que se convierten a geometría (bloques INSERT no se expanden)
+CAD_TIPOS = ["LINE", "LWPOLYLINE", "POLYLINE", "CIRCLE", "ARC", "ELLIPSE", "SPLINE",
+             "POINT", "TEXT", "MTEXT", "HATCH", "SOLID", "TRACE", "3DFACE"]
+# Distancia máxima (unidades del dibujo) al aproximar arcos y curvas con tramos rectos
+CAD_TOLERANCIA = float(os.getenv("CAD_TOLERANCIA", 0.1))
+
+# Circunferencia de Web Mercator en metros
+_MUNDO_METROS = 40075016.68557849
+
+# Latitud máxima de Web Mercator
+_LAT_MAX = 85.05112878
+
+_features = models.VectorFeature.__table__
+
+_COPY_FEATURES = "COPY vector_features (layer_id, name, properties, geom) FROM STDIN WITH (FORMAT csv)"
+
+_CONSULTA_MVT = text(f"""
+    WITH limites AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+    ),
+    mvtgeom AS (
+        SELECT
+            f.id,
+            f.name,
+            f.properties,
+            ST_AsMVTGeom(
+                ST_SimplifyPreserveTopology(f.geom, :tolerancia),
+                limites.geom, {MVT_EXTENT}, {MVT_BUFFER}, true
+            ) AS geom
+        FROM vector_features f, limites
+        WHERE f.layer_id = :layer_id
+          AND f.geom && ST_Expand(limites.geom, :margen)
+    )
+    SELECT ST_AsMVT(mvtgeom.*, '{MVT_CAPA}', {MVT_EXTENT}, 'geom', 'id')
+    FROM mvtgeom
+    WHERE geom IS NOT NULL
+""")
+
+
+def etiqueta_cache(layer_id: int) -> str:
+    return f"mvt-{layer_id}"
+
+
+def clave_cache(layer_id: int, z: int, x: int, y: int) -> str:
+    return f"mvt-{layer_id}-{z}-{x}-{y}"
+
+
+def resolucion_tile(z: int) -> float:
+    """Metros por unidad del MVT a ese zoom (tamaño del tile / extent)."""
+    return _MUNDO_METROS / (2 ** z) / MVT_EXTENT
+
+
+@lru_cache(maxsize=32)
+def _transformador(crs_origen: str) -> Transformer:
+    """Transformer origen -> EPSG:3857 (crearlos es costoso; se reutilizan)."""
+    return Transformer.from_crs(CRS.from_user_input(crs_origen), CRS.from_epsg(3857), always_xy=True)
+
+
+def _a_web_mercator(geometrias: np.ndarray, crs_origen: str) -> np.ndarray:
+    """Reproyecta un lote de geometrías shapely a EPSG:3857 en una sola llamada vectorizada."""
+    geometrias = shapely.force_2d(geometrias)
+    if crs_origen.upper() != "EPSG:3857":
+        transformador = _transformador(crs_origen)
+        geometrias = shapely.transform(
+            geometrias, lambda c: np.column_stack(transformador.transform(c[:, 0], c[:, 1]))
+        )
+    return shapely.set_srid(geometrias, 3857)
+
+
+def _copiar_lote(cursor, layer_id: int, lote: List[Tuple[Dict, BaseGeometry]], crs_origen: str) -> int:
+    """COPY de un lote a vector_features (CSV con la geometría como EWKB hexadecimal)."""
+    geometrias = _a_web_mercator(np.array([g for _, g in lote], dtype=object), crs_origen)
+    validas = ~(shapely.is_missing(geometrias) | shapely.is_empty(geometrias))
+    ewkb = shapely.to_wkb(geometrias, hex=True, include_srid=True)
+
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    filas = 0
+    for (propiedades, _), geom_hex, valida in zip(lote, ewkb, validas):
+        if not valida:
+            continue
+        propiedades = dict(propiedades or {})
+        nombre = propiedades.pop("name", None)
+        escritor.writerow((
+            layer_id,
+            None if nombre is None else str(nombre),
+            json.dumps(propiedades, default=str) if propiedades else None,
+            geom_hex,
+        ))
+        filas += 1
+    buffer.seek(0)
+    cursor.copy_expert(_COPY_FEATURES, buffer)
+    return filas
+
+
+def copiar_features(
+    db: Session,
+    layer_id: int,
+    features: Iterable[Tuple[Dict, BaseGeometry]],
+    crs_origen: str = "EPSG:4326"
+) -> int:
+    """
+    Agrega elementos a una capa. `features` entrega (propiedades, geometría shapely
+    en `crs_origen`); la clave 'name' de las propiedades va a su propia columna.
+
+    Los elementos se reproyectan a EPSG:3857 por lotes (pyproj vectorizado) y se
+    cargan con COPY, sin construir un INSERT por fila. La memoria queda acotada
+    a un lote de INGESTA_LOTE elementos. No hace commit.
+    """
+    # Conexión DBAPI (psycopg2) de la misma transacción de la sesión
+    conexion = db.connection().connection
+    total = 0
+    lote = []
+    with conexion.cursor() as cursor:
+        for propiedades, geometria in features:
+            if geometria is None or geometria.is_empty:
+                continue
+            lote.append((propiedades, geometria))
+            if len(lote) >= INGESTA_LOTE:
+                total += _copiar_lote(cursor, layer_id, lote, crs_origen)
+                lote = []
+        if lote:
+            total += _copiar_lote(cursor, layer_id, lote, crs_origen)
+    return total
+
+
+def features_kml(path: str) -> Iterable[Tuple[Dict, BaseGeometry]]:
+    """Placemarks de un KML/KMZ como (propiedades, geometría EPSG:4326)."""
+    from geofence_cache import leer_contenido_kml, iterar_placemarks_kml
+
+    contenido = leer_contenido_kml(path)
+    if not contenido:
+        return
+    for placemark, geometria in iterar_placemarks_kml(contenido):
+        propiedades = {"name": getattr(placemark, "name", None)}
+        descripcion = getattr(placemark, "description", None)
+        if descripcion:
+            propiedades["description"] = descripcion
+        yield propiedades, geometria
+
+
+def _nombre_feature(propiedades: Dict):
+    for campo in ("name", "Name", "NAME", "nombre", "Nombre", "NOMBRE"):
+        if propiedades.get(campo) not in (None, ""):
+            return propiedades[campo]
+    return None
+
+
+def _geometria_fiona(geometria) -> BaseGeometry:
+    """
+    Geometría de fiona a shapely. Pasar tipo y coordenadas como dict es el
+    doble de rápido que shape(geometria) vía __geo_interface__.
+    """
+    if geometria.type == "GeometryCollection":
+        return shape(geometria)
+    return shape({"type": geometria.type, "coordinates": geometria.coordinates})
+
+
+def fuentes_vector(path: str) -> Iterator[Tuple[Iterator[Tuple[Dict, BaseGeometry]], str]]:
+    """
+    Capas de un SHP/GeoJSON/GPKG leídas en streaming con fiona, como (features, crs).
+    Cada fuente debe consumirse antes de pedir la siguiente (el archivo sigue abierto).
+    """
+    import fiona
+
+    for nombre_capa in fiona.listlayers(path):
+        with fiona.open(path, layer=nombre_capa) as src:
+            crs = src.crs_wkt or "EPSG:4326"
+
+            def features(src=src):
+                for feature in src:
+                    if feature.geometry is None:
+                        continue
+                    propiedades = dict(feature.properties or {})
+                    propiedades["name"] = _nombre_feature(propiedades)
+                    yield propiedades, _geometria_fiona(feature.geometry)
+
+            yield features(), crs
+
+
+def _geometria_dxf(entidad) -> Optional[BaseGeometry]:
+    """Entidad DXF a shapely (textos como punto en su inserción; curvas aproximadas por tramos)."""
+    from ezdxf.addons import geo
+
+    tipo = entidad.dxftype()
+    # Atajos para las entidades más comunes en planos (evitan el proxy genérico de ezdxf)
+    if tipo == "LINE":
+        inicio, fin = entidad.dxf.start, entidad.dxf.end
+        return LineString([(inicio.x, inicio.y), (fin.x, fin.y)])
+    if tipo == "LWPOLYLINE" and not any(entidad.get_points("b")):
+        puntos = list(entidad.get_points("xy"))
+        if entidad.closed:
+            puntos.append(puntos[0])
+        return LineString(puntos) if len(puntos) > 1 else None
+    if tipo in ("TEXT", "MTEXT", "POINT"):
+        punto = entidad.dxf.location if tipo == "POINT" else entidad.dxf.insert
+        return Point(punto.x, punto.y)
+    # force_line_string: los contornos cerrados se dibujan como líneas (no tapan la ortofoto)
+    return shape(geo.proxy(entidad, distance=CAD_TOLERANCIA, force_line_string=True).__geo_interface__)
+
+
+def _propiedades_dxf(entidad) -> Dict:
+    propiedades = {"cad_layer": entidad.dxf.get("layer", "0"), "dxftype": entidad.dxftype()}
+    color = entidad.dxf.get("color")
+    if color is not None:
+        propiedades["color_index"] = color
+    if entidad.dxftype() == "TEXT":
+        propiedades["name"] = entidad.dxf.get("text")
+    elif entidad.dxftype() == "MTEXT":
+        propiedades["name"] = entidad.plain_text()
+    return propiedades
+
+
+def _entidades_dxf(path: str, progreso: Optional[Callable[[float], None]]) -> Iterator:
+    """
+    Entidades del modelspace en streaming con iterdxf (solo se indexa el archivo;
+    las entidades se cargan una a una). Los DXF binarios, que iterdxf no soporta,
+    se leen completos con ezdxf.readfile.
+    """
+    import ezdxf
+    from ezdxf.addons import iterdxf
+
+    try:
+        doc = iterdxf.opendxf(path)
+    except (ezdxf.DXFStructureError, UnicodeDecodeError):
+        logger.warning(f"⚠️ {os.path.basename(path)} no admite lectura por streaming; se carga completo")
+        yield from ezdxf.readfile(path).modelspace().query(" ".join(CAD_TIPOS))
+        return
+
+    tamano = os.path.getsize(path) or 1
+    try:
+        for i, entidad in enumerate(doc.modelspace(types=CAD_TIPOS)):
+            if progreso and i % 10000 == 0:
+                progreso(doc.file.tell() / tamano)
+            yield entidad
+    finally:
+        doc.close()
+
+
+def features_dxf(path: str, progreso: Optional[Callable[[float], None]] = None) -> Iterator[Tuple[Dict, BaseGeometry]]:
+    """Entidades del modelspace de un DXF como (propiedades, geometría en el CRS del dibujo)."""
+    omitidas = 0
+    for entidad in _entidades_dxf(path, progreso):
+        try:
+            geometria = _geometria_dxf(entidad)
+        except Exception:
+            omitidas += 1
+            continue
+        yield _propiedades_dxf(entidad), geometria
+    if omitidas:
+        logger.info(f"📐 {os.path.basename(path)}: {omitidas} entidades sin geometría convertible omitidas")
+
+
+def fuentes_para_capa(
+    layer_type: str,
+    path: str,
+    crs: Optional[str] = None,
+    progreso: Optional[Callable[[float], None]] = None
+) -> Iterable[Tuple[Iterable, str]]:
+    """
+    Lector de elementos según el tipo de capa.
+
+    Args:
+        crs: CRS de las coordenadas del DXF (los dibujos CAD no lo declaran); por defecto CAD_DEFAULT_CRS
+        progreso: callback con la fracción leída del archivo (solo CAD)
+    """
+    if layer_type == "kml":
+        return [(features_kml(path), "EPSG:4326")]
+    if layer_type == "vector":
+        return fuentes_vector(path)
+    if layer_type == "cad":
+        if not path.lower().endswith(".dxf"):
+            raise ValueError("Los archivos DWG deben convertirse a DXF para generar vector tiles")
+        return [(features_dxf(path, progreso), crs or CAD_DEFAULT_CRS)]
+    raise ValueError(f"Tipo de capa sin vector tiles: {layer_type}")
+
+
+def ingerir_capa(db: Session, layer: models.Layer, fuentes: Iterable[Tuple[Iterable, str]]) -> int:
+    """
+    Reemplaza los elementos de la capa, la marca como lista para vector tiles e
+    invalida su caché. `fuentes` entrega (features, crs_origen), una por capa del
+    archivo (un GPKG puede traer varias con CRS distintos).
+    """
+    db.execute(delete(_features).where(_features.c.layer_id == layer.id))
+    total = 0
+    for features, crs_origen in fuentes:
+        total += copiar_features(db, layer.id, features, crs_origen)
+    if total >= INGESTA_LOTE * 10:
+        # Actualizar estadísticas para que el planificador use el índice GiST con la tabla recién cargada
+        db.execute(text("ANALYZE vector_features"))
+
+    layer.bounds = extension_vector_features(layer.id)
+    layer.settings = {
+        **(layer.settings or {}),
+        # version: el frontend la agrega a la URL para no reutilizar tiles del navegador tras una re-ingesta
+        "vector_tiles": {"ready": True, "features": total, "layer": MVT_CAPA, "version": int(time.time())},
+    }
+    db.commit()
+    tile_cache.evict(etiqueta_cache(layer.id))
+    return total
+
+
+def renderizar_tile(db: Session, layer_id: int, z: int, x: int, y: int) -> bytes:
+    """MVT del tile (bytes vacíos si no hay geometría)."""
+    resolucion = resolucion_tile(z)
+    fila = db.execute(_CONSULTA_MVT, {
+        "z": z, "x": x, "y": y,
+        "layer_id": layer_id,
+        # Simplificar a media unidad del tile: no cambia nada visible tras la cuantización
+        "tolerancia": resolucion / 2,
+        "margen": resolucion * MVT_BUFFER,
+    }).first()
+    return bytes(fila[0]) if fila and fila[0] is not None else b""
+
+
+def obtener_tile(db: Session, layer_id: int, z: int, x: int, y: int) -> bytes:
+    """Tile desde tile_cache o generado con ST_AsMVT (también se cachean los vacíos)."""
+    clave = clave_cache(layer_id, z, x, y)
+    tile = tile_cache.get(clave)
+    if tile is not None:
+        return tile
+    tile = renderizar_tile(db, layer_id, z, x, y)
+    tile_cache.set(clave, tile, expire=MVT_CACHE_SEGUNDOS, tag=etiqueta_cache(layer_id))
+    return tile
+
+
+# Se lee una fila de más (n = limite + 1) para saber si el resultado quedó truncado
+_CONSULTA_GEOJSON = text("""
+    SELECT CAST(json_build_object(
+        'type', 'FeatureCollection',
+        'features', coalesce(json_agg(json_build_object(
+            'type', 'Feature',
+            'id', f.id,
+            'geometry', CAST(ST_AsGeoJSON(ST_Transform(
+                ST_SimplifyPreserveTopology(f.geom, :tolerancia), 4326
+            ), :decimales) AS json),
+            'properties', coalesce(f.properties, '{}'::jsonb) || jsonb_build_object('name', f.name)
+        ) ORDER BY f.id) FILTER (WHERE f.n <= :limite), '[]'::json),
+        'truncated', count(*) > :limite,
+        'next_cursor', CASE WHEN count(*) > :limite THEN max(f.id) FILTER (WHERE f.n <= :limite) END
+    ) AS TEXT)
+    FROM (
+        SELECT id, name, properties, geom, row_number() OVER (ORDER BY id) AS n
+        FROM vector_features
+        WHERE layer_id = :layer_id
+          AND id > :despues
+          AND (CAST(:sin_bbox AS boolean) OR geom && ST_Transform(ST_MakeEnvelope(:minx, :miny, :maxx, :maxy, 4326), 3857))
+        ORDER BY id
+        LIMIT :limite + 1
+    ) f
+""")
+
+
+def features_geojson(
+    db: Session,
+    layer_id: int,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    zoom: Optional[int] = None,
+    limite: int = 10000,
+    cursor: Optional[int] = None
+) -> str:
+    """
+    FeatureCollection (EPSG:4326) de los elementos de una capa que intersectan
+    el bbox, armada por PostGIS y simplificada para el zoom si se indica.
+
+    Si hay más de `limite` elementos, `truncated` es true y `next_cursor` (id
+    del último elemento devuelto) se pasa como `cursor` para la página siguiente.
+    """
+    tolerancia = resolucion_tile(zoom) * MVT_EXTENT / 256 / 2 if zoom is not None else 0.0
+    minx, miny, maxx, maxy = bbox or (0.0, 0.0, 0.0, 0.0)
+    # ±90° no tiene imagen en EPSG:3857; se recorta al límite de Web Mercator
+    miny, maxy = max(miny, -_LAT_MAX), min(maxy, _LAT_MAX)
+    return db.execute(_CONSULTA_GEOJSON, {
+        "layer_id": layer_id,
+        "tolerancia": tolerancia,
+        "decimales": 7 if zoom is None or zoom >= 16 else 6,
+        "sin_bbox": bbox is None,
+        "minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy,
+        "limite": limite,
+        "despues": cursor or 0,
+    }).scalar_one()
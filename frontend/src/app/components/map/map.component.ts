@@ -2,6 +2,7 @@ import { Component, OnInit, AfterViewInit, OnDestroy, inject } from '@angular/co
 import { ProjectContextService } from '../../services/project-context.service';
 import { ApiService } from '../../services/api.service';
 import { Project } from '../../models/models';
+import { Subscription } from 'rxjs';
 import { MapService } from '../../services/map.service';
 import { LayerService } from '../../services/layer.service';
 
@@ -24,6 +25,7 @@ import { LayerService } from '../../services/layer.service';
 export class MapComponent implements OnInit, AfterViewInit {
   private layerService = inject(LayerService);
   private subscriptions: any[] = [];
+  private tileTokenSubscription: Subscription | null = null;
 
   constructor(
     private mapService: MapService,
@@ -40,14 +42,71 @@ export class MapComponent implements OnInit, AfterViewInit {
     this.subscriptions.push(
       this.projectContext.activeProject$.subscribe(project => {
         if (project) {
-          this.loadLayers(project.layers || []);
+          this.loadProjectLayers(project);
         }
       })
     );
   }
 
-  private loadLayers(layers: any[]) {
+  // Las vector tiles y los tiles compuestos requieren el token de tiles del proyecto,
+  // que se renueva antes de expirar actualizando las URLs de esas capas
+  private loadProjectLayers(project: Project) {
+    this.tileTokenSubscription?.unsubscribe();
+    this.tileTokenSubscription = null;
+
+    const layers = project.layers || [];
+    const usesVectorTiles = layers.some((l: any) => (l.settings || l.metadata)?.vector_tiles?.ready);
+    if (!usesVectorTiles && this.rasterLayers(layers).length < 2) {
+      this.loadLayers(project.id, layers, null);
+      return;
+    }
+    let loaded = false;
+    this.tileTokenSubscription = this.apiService.watchTileToken(project.id).subscribe({
+      next: (token) => {
+        if (this.projectContext.getActiveProjectId() !== project.id) return;
+        if (loaded) {
+          this.updateTileToken(project.id, layers, token);
+        } else {
+          loaded = true;
+          this.loadLayers(project.id, layers, token);
+        }
+      },
+      error: (err) => {
+        // Sin token se cargan los archivos originales (KML/vector) y un flujo de tiles por raster
+        console.error('Error obteniendo token de tiles', err);
+        if (!loaded && this.projectContext.getActiveProjectId() === project.id) this.loadLayers(project.id, layers, null);
+      }
+    });
+  }
+
+  private updateTileToken(projectId: number, layers: any[], tileToken: string) {
+    layers.forEach(layer => {
+      if ((layer.settings || layer.metadata)?.vector_tiles?.ready) {
+        this.mapService.setLayerSourceUrl(layer.id, this.vectorTileUrl(layer, tileToken));
+      }
+    });
+    this.mapService.setLayerSourceUrl(`composite-${projectId}`, this.apiService.getCompositeTilesUrl(projectId, tileToken));
+  }
+
+  private vectorTileUrl(layer: any, tileToken: string): string {
+    const version = (layer.settings || layer.metadata).vector_tiles.version || 0;
+    return `${this.apiService.getApiUrl()}/vtiles/${layer.id}/{z}/{x}/{y}.mvt?v=${version}&token=${encodeURIComponent(tileToken)}`;
+  }
+
+  private rasterLayers(layers: any[]): any[] {
+    return layers.filter(l => l.layer_type === 'raster' && !(l.settings || l.metadata)?.vector_tiles?.ready);
+  }
+
+  private loadLayers(projectId: number, layers: any[], tileToken: string | null) {
     this.mapService.clearLayers();
+
+    // Con varias ortofotos se pide un solo tile compuesto en el servidor; las capas
+    // individuales quedan ocultas (sin pedir tiles) para activarlas o compararlas
+    const composite = !!tileToken && this.rasterLayers(layers).length > 1;
+    if (composite) {
+      this.mapService.addCompositeRasterLayer(projectId, this.apiService.getCompositeTilesUrl(projectId, tileToken!));
+    }
+
     layers.forEach(layer => {
       // El backend devuelve 'settings', pero el frontend a veces usaba 'metadata'.
       // Usamos settings como fuente principal.
@@ -56,7 +115,10 @@ export class MapComponent implements OnInit, AfterViewInit {
       // Si no hay metadatos, intentamos seguir si es vector o kml
       if (!metadata && layer.layer_type !== 'vector' && layer.layer_type !== 'kml') return;
 
-      if (layer.layer_type === 'raster') {
+      if (metadata?.vector_tiles?.ready && tileToken) {
+        // Elementos cargados en PostGIS: vector tiles en lugar del archivo completo
+        this.mapService.addVectorTileLayer(layer.name, this.vectorTileUrl(layer, tileToken), layer.id, layer.folder_id, layer.layer_type);
+      } else if (layer.layer_type === 'raster') {
         const filename = layer.file_path.split(/[\\/]/).pop();
         const tileUrl = `${this.apiService.getApiUrl()}/tiles/${filename}/{z}/{x}/{y}.png`;
 
@@ -86,7 +148,7 @@ export class MapComponent implements OnInit, AfterViewInit {
           extent = undefined;
         }
 
-        this.mapService.addRasterLayer(layer.name, tileUrl, extent, layer.id, layer.folder_id);
+        this.mapService.addRasterLayer(layer.name, tileUrl, extent, layer.id, layer.folder_id, !composite);
       } else if (layer.layer_type === 'vector') {
         this.mapService.addVectorLayer(layer.name, metadata, layer.id, layer.folder_id);
       } else if (layer.layer_type === 'kml') {
@@ -114,5 +176,6 @@ export class MapComponent implements OnInit, AfterViewInit {
   }
   ngOnDestroy(): void {
     this.subscriptions.forEach(s => s.unsubscribe());
+    this.tileTokenSubscription?.unsubscribe();
   }
 }
@@ -4,6 +4,7 @@ import { ProjectContextService } from '../../services/project-context.service';
 import { ApiService } from '../../services/api.service';
 import { LayerService } from '../../services/layer.service';
 import { Project } from '../../models/models';
+import { Subscription } from 'rxjs';
 
 @Component({
   selector: 'app-map3d',
@@ -20,6 +21,7 @@ import { Project } from '../../models/models';
 export class Map3dComponent implements OnInit, AfterViewInit, OnDestroy {
   private layerService = inject(LayerService);
   private subscriptions: any[] = [];
+  private tileTokenSubscription: Subscription | null = null;
 
   constructor(
     private map3dService: Map3dService,
@@ -42,11 +44,38 @@ export class Map3dComponent implements OnInit, AfterViewInit, OnDestroy {
       this.projectContext.activeProject$.subscribe(project => {
         if (project) {
           this.loadLayers(project.layers || []);
+          this.loadDemTerrain(project);
         }
       })
     );
   }
 
+  // Primer DEM del proyecto (raster de una banda no uint8) como terreno del globo
+  private loadDemTerrain(project: Project) {
+    this.tileTokenSubscription?.unsubscribe();
+    this.tileTokenSubscription = null;
+
+    const dem = (project.layers || []).find((l: any) => {
+      const metadata = l.settings || l.metadata;
+      return l.layer_type === 'raster' && metadata?.count === 1 && metadata?.dtype && metadata.dtype !== 'uint8';
+    });
+    if (!dem) {
+      this.map3dService.setDemTerrain(null);
+      return;
+    }
+    // El token renovado solo cambia la URL: el proveedor de terreno se conserva
+    this.tileTokenSubscription = this.apiService.watchTileToken(project.id).subscribe({
+      next: (token) => {
+        if (this.projectContext.getActiveProjectId() !== project.id) return;
+        this.map3dService.setDemTerrain(dem.id, this.apiService.getTerrainTilesUrl(dem.id, 'terrain-rgb', token));
+      },
+      error: (err) => {
+        console.error('Error obteniendo token de tiles', err);
+        this.map3dService.setDemTerrain(null);
+      }
+    });
+  }
+
   private loadLayers(layers: any[]) {
     console.log('Map3D: Cargando capas...', layers);
     this.map3dService.clearLayers();
@@ -128,5 +157,6 @@ export class Map3dComponent implements OnInit, AfterViewInit, OnDestroy {
 
   ngOnDestroy(): void {
     this.subscriptions.forEach(s => s.unsubscribe());
+    this.tileTokenSubscription?.unsubscribe();
   }
 }
@@ -6,9 +6,12 @@ import { ProjectService } from '../../services/project.service';
 import { ToastService } from '../../services/toast.service';
 import { ProjectContextService } from '../../services/project-context.service';
 import { AuthService } from '../../services/auth.service';
-import { Project, User } from '../../models/models';
+import { Project, ProjectSummary, User } from '../../models/models';
 import { finalize } from 'rxjs/operators';
 
+// Proyectos por página del listado resumido (/projects/summary)
+const PAGE_SIZE = 50;
+
 @Component({
   selector: 'app-project-manager',
   standalone: true,
@@ -17,8 +20,12 @@ import { finalize } from 'rxjs/operators';
   styleUrl: './project-manager.css',
 })
 export class ProjectManager implements OnInit {
-  projects: Project[] = [];
+  projects: ProjectSummary[] = [];
+  nextCursor: string | null = null;
+  isLoadingMore = false;
   users: User[] = [];
+  // Incluye inactivos: al editar no se deben perder miembros que no aparecen en la lista
+  private allUsers: User[] = [];
   isLoading = false;
   showCreateForm = false;
   isEditing = false;
@@ -55,17 +62,19 @@ export class ProjectManager implements OnInit {
     this.loadUsers();
   }
 
+  // Primera página del listado liviano; las siguientes con loadMoreProjects()
   loadProjects() {
     this.isLoading = true;
     this.cdr.detectChanges();
-    this.projectService.getProjects()
+    this.projectService.getProjectSummaries({ limit: PAGE_SIZE, include: ['details', 'members'] })
       .pipe(finalize(() => {
         this.isLoading = false;
         this.cdr.detectChanges();
       }))
       .subscribe({
-        next: (data) => {
-          this.projects = data;
+        next: (page) => {
+          this.projects = page.items;
+          this.nextCursor = page.next_cursor;
           this.cdr.detectChanges();
         },
         error: (err) => {
@@ -75,9 +84,51 @@ export class ProjectManager implements OnInit {
       });
   }
 
+  loadMoreProjects() {
+    if (!this.nextCursor || this.isLoadingMore) return;
+    this.isLoadingMore = true;
+    this.cdr.detectChanges();
+    this.projectService.getProjectSummaries({ limit: PAGE_SIZE, cursor: this.nextCursor, include: ['details', 'members'] })
+      .pipe(finalize(() => {
+        this.isLoadingMore = false;
+        this.cdr.detectChanges();
+      }))
+      .subscribe({
+        next: (page) => {
+          const loaded = new Set(this.projects.map(p => p.id));
+          this.projects = [...this.projects, ...page.items.filter(p => !loaded.has(p.id))];
+          this.nextCursor = page.next_cursor;
+          this.cdr.detectChanges();
+        },
+        error: (err) => {
+          console.error('Error loading projects', err);
+          this.toastService.show('Error al cargar más proyectos.', 'error');
+        }
+      });
+  }
+
+  // Proyecto completo (respuesta de crear/editar) -> fila del listado resumido
+  private toSummary(project: Project): ProjectSummary {
+    return {
+      id: project.id,
+      name: project.name,
+      layer_count: project.layers?.length || 0,
+      member_count: project.assigned_users?.length || 0,
+      bbox: null,
+      description: project.description,
+      contract_number: project.contract_number,
+      start_date: project.start_date,
+      end_date: project.end_date,
+      photo_url: project.photo_url,
+      owner_id: project.owner_id,
+      assigned_user_ids: (project.assigned_users || []).map(u => u.id)
+    };
+  }
+
   loadUsers() {
     this.authService.getUsers().subscribe({
       next: (data) => {
+        this.allUsers = data;
         this.users = data.filter(u => u.is_active);
         this.cdr.detectChanges();
       },
@@ -142,7 +193,8 @@ export class ProjectManager implements OnInit {
         }))
         .subscribe({
           next: (updatedProject) => {
-            this.projects = this.projects.map(p => p.id === updatedProject.id ? updatedProject : p);
+            const summary = this.toSummary(updatedProject);
+            this.projects = this.projects.map(p => p.id === summary.id ? { ...summary, bbox: p.bbox } : p);
             this.toastService.show('Proyecto actualizado exitosamente', 'success');
             this.showCreateForm = false;
             this.cdr.detectChanges();
@@ -159,7 +211,7 @@ export class ProjectManager implements OnInit {
         }))
         .subscribe({
           next: (project) => {
-            this.projects = [project, ...this.projects];
+            this.projects = [this.toSummary(project), ...this.projects];
             this.toastService.show('Proyecto creado exitosamente', 'success');
             this.showCreateForm = false;
             this.cdr.detectChanges();
@@ -171,7 +223,7 @@ export class ProjectManager implements OnInit {
     }
   }
 
-  editProject(project: Project) {
+  editProject(project: ProjectSummary) {
     this.isEditing = true;
     this.showCreateForm = true;
     this.editingProjectId = project.id;
@@ -184,12 +236,13 @@ export class ProjectManager implements OnInit {
     this.newProjectEnd = project.end_date ? new Date(project.end_date).toISOString().split('T')[0] : '';
 
     // Load existing users into staged list
-    this.stagedUsers = [...(project.assigned_users || [])];
+    const memberIds = new Set(project.assigned_user_ids || []);
+    this.stagedUsers = this.allUsers.filter(u => memberIds.has(u.id));
 
     this.cdr.detectChanges();
   }
 
-  deleteProject(project: Project) {
+  deleteProject(project: ProjectSummary) {
     if (!confirm(`¿Eliminar el proyecto "${project.name}"? Esta acción borrará todas sus capas.`)) return;
 
     this.isLoading = true;
@@ -222,9 +275,25 @@ export class ProjectManager implements OnInit {
     this.cdr.detectChanges();
   }
 
-  selectProject(project: Project) {
-    this.projectContext.setActiveProject(project);
-    this.toastService.show(`Proyecto "${project.name}" seleccionado`, 'info');
-    this.router.navigate(['/map']);
+  // El listado es resumido: el proyecto completo (capas, carpetas) se carga al abrirlo
+  selectProject(project: ProjectSummary) {
+    this.isLoading = true;
+    this.cdr.detectChanges();
+    this.projectService.getProjectById(project.id)
+      .pipe(finalize(() => {
+        this.isLoading = false;
+        this.cdr.detectChanges();
+      }))
+      .subscribe({
+        next: (fullProject) => {
+          this.projectContext.setActiveProject(fullProject);
+          this.toastService.show(`Proyecto "${fullProject.name}" seleccionado`, 'info');
+          this.router.navigate(['/map']);
+        },
+        error: (err) => {
+          console.error('Error loading project', err);
+          this.toastService.show('Error al abrir el proyecto.', 'error');
+        }
+      });
   }
 }
@@ -34,6 +34,26 @@ export interface Project {
     assigned_user_ids?: number[];
 }
 
+export interface ProjectSummary {
+    id: number;
+    name: string;
+    layer_count: number;
+    member_count: number;
+    bbox: [number, number, number, number] | null;
+    description?: string;
+    contract_number?: string;
+    start_date?: string;
+    end_date?: string;
+    photo_url?: string;
+    owner_id?: number;
+    assigned_user_ids?: number[];
+}
+
+export interface ProjectSummaryPage {
+    items: ProjectSummary[];
+    next_cursor: string | null;
+}
+
 export interface Layer {
     id?: number;
     name: string;
@@ -1,6 +1,6 @@
 import { Injectable } from '@angular/core';
 import { HttpClient, HttpRequest, HttpEvent, HttpEventType } from '@angular/common/http';
-import { Observable, map } from 'rxjs';
+import { Observable, map, expand, timer, switchMap, retry } from 'rxjs';
 
 /**
  * Servicio para comunicación con el backend
@@ -54,6 +54,41 @@ export class ApiService {
         return `${this.baseUrl}/tiles/${filename}/{z}/{x}/{y}.png`;
     }
 
+    /**
+     * Token de tiles del proyecto: los clientes de mapas piden las imágenes sin
+     * encabezados, así que las rutas de tiles por id lo reciben como ?token=
+     */
+    getTileToken(projectId: number): Observable<{ token: string; expires_in: number }> {
+        return this.http.get<{ token: string; expires_in: number }>(`${this.baseUrl}/projects/${projectId}/tile-token`);
+    }
+
+    /**
+     * Token de tiles del proyecto renovado antes de que expire: emite el primero
+     * y uno nuevo al consumirse el 80% de la vigencia del anterior
+     */
+    watchTileToken(projectId: number): Observable<string> {
+        return this.getTileToken(projectId).pipe(
+            expand(({ expires_in }) => timer(Math.max(expires_in * 0.8, 30) * 1000).pipe(
+                switchMap(() => this.getTileToken(projectId).pipe(retry({ count: 3, delay: 30000 })))
+            )),
+            map(({ token }) => token)
+        );
+    }
+
+    /**
+     * Obtiene la URL de tiles compuestos con todas las ortofotos visibles del proyecto
+     */
+    getCompositeTilesUrl(projectId: number, tileToken: string): string {
+        return `${this.baseUrl}/tiles/composite/${projectId}/{z}/{x}/{y}?token=${encodeURIComponent(tileToken)}`;
+    }
+
+    /**
+     * Obtiene la URL de tiles de terreno de una capa de elevación (DEM/DSM)
+     */
+    getTerrainTilesUrl(layerId: number, mode: 'terrain-rgb' | 'hillshade' | 'slope', tileToken: string): string {
+        return `${this.baseUrl}/layers/${layerId}/terrain/${mode}/{z}/{x}/{y}?token=${encodeURIComponent(tileToken)}`;
+    }
+
     /**
      * Obtiene la URL directa de un archivo cargado
      */
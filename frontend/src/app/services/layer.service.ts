@@ -23,6 +23,15 @@ export interface Layer {
   processing_progress?: number;
 }
 
+export interface LayerProfile {
+  count: number;
+  length_m: number;
+  distances: number[];
+  coordinates: number[][];
+  values: (number | null)[];
+  stats: { min: number | null; max: number | null; ascent: number; descent: number };
+}
+
 export interface LayerUpdate {
   name?: string;
   visible?: boolean;
@@ -43,14 +52,31 @@ export class LayerService {
   constructor(private http: HttpClient) { }
 
   /**
-   * Obtener todas las capas de un proyecto
+   * Obtener las capas de un proyecto.
+   * Con bbox [minx, miny, maxx, maxy] (EPSG:4326) solo llegan las capas que intersectan la vista
+   * (más las que aún no tienen extensión calculada).
    */
-  getProjectLayers(projectId: number): Observable<Layer[]> {
-    return this.http.get<Layer[]>(`${this.apiUrl}/projects/${projectId}/layers`).pipe(
+  getProjectLayers(projectId: number, bbox?: number[]): Observable<Layer[]> {
+    const params: any = bbox ? { bbox: bbox.join(',') } : {};
+    return this.http.get<Layer[]>(`${this.apiUrl}/projects/${projectId}/layers`, { params }).pipe(
       tap(layers => this.layersSubject.next(layers))
     );
   }
 
+  /**
+   * Valores del raster en puntos [lon, lat] (null = sin dato)
+   */
+  sampleLayer(layerId: number, points: number[][], bands?: number[]): Observable<{ count: number; values: any[] }> {
+    return this.http.post<{ count: number; values: any[] }>(`${this.apiUrl}/layers/${layerId}/sample`, { points, bands });
+  }
+
+  /**
+   * Perfil de elevación a lo largo de una línea [lon, lat][] o de una medida
+   */
+  getLayerProfile(layerId: number, line: { coordinates?: number[][]; measurement_id?: number }, samples = 512): Observable<LayerProfile> {
+    return this.http.post<LayerProfile>(`${this.apiUrl}/layers/${layerId}/profile`, { ...line, samples });
+  }
+
   /**
    * Actualizar una capa
    */
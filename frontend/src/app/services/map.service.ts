@@ -10,6 +10,9 @@ import XYZ from 'ol/source/XYZ';
 import VectorSource from 'ol/source/Vector';
 import GeoJSON from 'ol/format/GeoJSON';
 import KML from 'ol/format/KML';
+import MVT from 'ol/format/MVT';
+import VectorTileLayer from 'ol/layer/VectorTile';
+import VectorTileSource from 'ol/source/VectorTile';
 import { register } from 'ol/proj/proj4';
 import proj4 from 'proj4';
 import { Subject, BehaviorSubject, Observable } from 'rxjs';
@@ -152,8 +155,9 @@ export class MapService {
 
     /**
      * Agrega una capa raster (XYZ/Tiles)
+     * @param visible Las capas ocultas no piden tiles hasta que se activan
      */
-    addRasterLayer(name: string, url: string, extent?: number[], id?: number, folderId?: number | null) {
+    addRasterLayer(name: string, url: string, extent?: number[], id?: number, folderId?: number | null, visible: boolean = true) {
         // Transformar extent a la proyección del mapa (3857) si se proporciona en 4326
         let transformedExtent = extent;
         if (extent) {
@@ -171,6 +175,7 @@ export class MapService {
                 maxZoom: 24
             }),
             extent: transformedExtent,
+            visible: visible,
             properties: {
                 name: name,
                 id: id || name + Date.now(),
@@ -187,6 +192,30 @@ export class MapService {
         }
     }
 
+    /**
+     * Agrega la capa con todas las ortofotos del proyecto compuestas en el servidor
+     * (un solo flujo de tiles en lugar de uno por capa)
+     */
+    addCompositeRasterLayer(projectId: number, url: string) {
+        const id = `composite-${projectId}`;
+        if (this.getLayerById(id)) return;
+
+        const layer = new TileLayer({
+            source: new XYZ({
+                url: url,
+                crossOrigin: 'anonymous',
+                maxZoom: 24
+            }),
+            properties: {
+                name: 'Ortofotos del proyecto',
+                id: id,
+                type: 'raster'
+            }
+        });
+
+        this.addLayer(layer, 'raster');
+    }
+
     addVectorLayer(name: string, geojson: any, id?: number, folderId?: number | null) {
         // Si es la capa de registros (ID 9999), guardarla para persistencia
         if (id === 9999) {
@@ -268,6 +297,16 @@ export class MapService {
         return this.layers.find(l => l.id == id);
     }
 
+    /**
+     * Cambia la URL de tiles de una capa (p. ej. al renovar el token de tiles)
+     */
+    setLayerSourceUrl(layerId: string | number, url: string) {
+        const source = this.getLayerById(layerId)?.instance.getSource();
+        if (source && typeof source.setUrl === 'function') {
+            source.setUrl(url);
+        }
+    }
+
     /**
      * Agrega una capa KML
      */
@@ -387,6 +426,33 @@ export class MapService {
         }
     }
 
+    /**
+     * Agrega una capa vectorial servida como vector tiles (MVT) por el backend.
+     * Solo se descargan los elementos visibles, ya simplificados para el zoom.
+     */
+    addVectorTileLayer(name: string, url: string, id?: number, folderId?: number | null, type: string = 'kml') {
+        if (id && this.getLayerById(id)) return;
+
+        const layer = new VectorTileLayer({
+            source: new VectorTileSource({
+                format: new MVT(),
+                url: url,
+                maxZoom: 22
+            }),
+            style: (feature: any) => this.getKMLStyle(feature),
+            declutter: true,
+            properties: {
+                name: name,
+                id: id || name + Date.now(),
+                type: type,
+                folder_id: folderId
+            }
+        });
+
+        this.addLayer(layer, type);
+        layer.setZIndex(100);
+    }
+
     /**
      * Limpia todas las capas no base del mapa
      * @param force Si es true, limpia incluso las capas de sesión (heatmaps, etc)
@@ -14,6 +14,9 @@ export class Map3dService {
     public localModeEnabled = true; // Default to Studio
     private gridPrimitive: any = null;
     private axesPrimitive: any = null;
+    private demTerrainLayerId: number | null = null;
+    private demTerrainUrl: string | null = null;
+    private worldTerrain: Promise<Cesium.TerrainProvider> | null = null;
 
     constructor() {
         // Configurar base path para assets de Cesium
@@ -40,8 +43,10 @@ export class Map3dService {
         });
 
         // Set terrain provider asynchronously to match types
-        Cesium.createWorldTerrainAsync().then(tp => {
-            if (this.viewer && !this.viewer.isDestroyed()) {
+        this.demTerrainLayerId = null;
+        this.worldTerrain = Cesium.createWorldTerrainAsync();
+        this.worldTerrain.then(tp => {
+            if (this.viewer && !this.viewer.isDestroyed() && this.demTerrainLayerId === null) {
                 (this.viewer as any).terrainProvider = tp;
             }
         });
@@ -161,6 +166,79 @@ export class Map3dService {
         return layer;
     }
 
+    /**
+     * Usa como terreno una capa de elevación (DEM/DSM) servida por el backend en
+     * terrain-rgb (altura = -10000 + (R*65536 + G*256 + B) * 0.1).
+     * Cesium no trae un proveedor Terrain-RGB: los tiles se decodifican a un
+     * heightmap en un CustomHeightmapTerrainProvider. Con layerId null se
+     * vuelve al terreno mundial.
+     * @param url Plantilla {z}/{x}/{y} de los tiles terrain-rgb (con el token de tiles)
+     */
+    setDemTerrain(layerId: number | null, url: string | null = null) {
+        if (!this.viewer) return;
+
+        if (layerId === null || !url) {
+            if (this.demTerrainLayerId === null) return;
+            this.demTerrainLayerId = null;
+            this.demTerrainUrl = null;
+            this.worldTerrain?.then(tp => {
+                if (this.viewer && !this.viewer.isDestroyed() && this.demTerrainLayerId === null) {
+                    (this.viewer as any).terrainProvider = tp;
+                }
+            });
+            return;
+        }
+
+        // Misma capa con otra URL (token renovado): los tiles siguientes usan la nueva
+        this.demTerrainUrl = url;
+        if (this.demTerrainLayerId === layerId) return;
+        this.demTerrainLayerId = layerId;
+
+        const size = 65;
+        (this.viewer as any).terrainProvider = new Cesium.CustomHeightmapTerrainProvider({
+            width: size,
+            height: size,
+            tilingScheme: new Cesium.WebMercatorTilingScheme(),
+            callback: (x: number, y: number, level: number) => this.loadTerrainRgbTile(x, y, level, size)
+        });
+    }
+
+    private async loadTerrainRgbTile(x: number, y: number, level: number, size: number): Promise<Float32Array> {
+        const heights = new Float32Array(size * size);
+        const url = this.demTerrainUrl;
+        if (!url) return heights;
+
+        try {
+            const tileUrl = url.replace('{z}', String(level)).replace('{x}', String(x)).replace('{y}', String(y));
+            const response = await fetch(tileUrl);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const bitmap = await createImageBitmap(await response.blob());
+
+            const canvas = document.createElement('canvas');
+            canvas.width = bitmap.width;
+            canvas.height = bitmap.height;
+            const ctx = canvas.getContext('2d', { willReadFrequently: true })!;
+            ctx.drawImage(bitmap, 0, 0);
+            const pixels = ctx.getImageData(0, 0, bitmap.width, bitmap.height).data;
+
+            // Los bordes del heightmap coinciden con los bordes del tile
+            for (let row = 0; row < size; row++) {
+                const py = Math.min(bitmap.height - 1, Math.round(row * (bitmap.height - 1) / (size - 1)));
+                for (let col = 0; col < size; col++) {
+                    const px = Math.min(bitmap.width - 1, Math.round(col * (bitmap.width - 1) / (size - 1)));
+                    const i = (py * bitmap.width + px) * 4;
+                    // Píxeles transparentes: fuera del DEM
+                    if (pixels[i + 3] === 0) continue;
+                    heights[row * size + col] = -10000 + (pixels[i] * 65536 + pixels[i + 1] * 256 + pixels[i + 2]) * 0.1;
+                }
+            }
+            bitmap.close();
+        } catch (error) {
+            console.warn(`Error cargando tile de terreno ${level}/${x}/${y}:`, error);
+        }
+        return heights;
+    }
+
     /**
      * Agrega una capa KML/KMZ al visor 3D
      */
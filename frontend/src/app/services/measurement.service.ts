@@ -212,9 +212,14 @@ export class MeasurementService {
 
     async loadMeasurements(projectId: number) {
         try {
-            const measurements = await firstValueFrom(
-                this.http.get<Measurement[]>(`${this.api.getApiUrl()}/projects/${projectId}/measurements`)
+            // FeatureCollection armada en PostGIS (una sola consulta, sin serializar objeto por objeto)
+            const collection = await firstValueFrom(
+                this.http.get<any>(`${this.api.getApiUrl()}/projects/${projectId}/measurements/geojson`)
             );
+            const measurements: Measurement[] = collection.features.map((f: any) => ({
+                ...f.properties,
+                geometry: f.geometry
+            }));
             console.log(`[MeasurementService] ${measurements.length} medidas cargadas:`, measurements);
             this.ngZone.run(() => {
                 this.measurementsSubject.next(measurements);
@@ -1,7 +1,7 @@
 import { Injectable } from '@angular/core';
-import { HttpClient } from '@angular/common/http';
+import { HttpClient, HttpParams } from '@angular/common/http';
 import { Observable } from 'rxjs';
-import { Project, Folder, Layer } from '../models/models';
+import { Project, ProjectSummaryPage, Folder, Layer } from '../models/models';
 
 @Injectable({
     providedIn: 'root'
@@ -24,6 +24,16 @@ export class ProjectService {
         return this.http.get<Project[]>(`${this.baseUrl}/projects/`);
     }
 
+    // Listado liviano y paginado para el selector de proyectos
+    getProjectSummaries(options: { limit?: number; cursor?: string | null; q?: string; include?: string[] } = {}): Observable<ProjectSummaryPage> {
+        let params = new HttpParams();
+        if (options.limit) params = params.set('limit', options.limit);
+        if (options.cursor) params = params.set('cursor', options.cursor);
+        if (options.q) params = params.set('q', options.q);
+        if (options.include?.length) params = params.set('include', options.include.join(','));
+        return this.http.get<ProjectSummaryPage>(`${this.baseUrl}/projects/summary`, { params });
+    }
+
     getProjectById(projectId: number): Observable<Project> {
         return this.http.get<Project>(`${this.baseUrl}/projects/by-id/${projectId}`);
     }